@@ -60,6 +60,9 @@ def create_app() -> Flask:
     set_error_handlers(app)
     register_blueprints(app)
 
+    # Registers the listeners that publish commit statuses.
+    import armonaut.statuses  # noqa: F401
+
     return app
 
 
@@ -0,0 +1,152 @@
+# Copyright (C) 2017 Seth Michael Larson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Packs jobs onto the runner hosts of a `Pool` by their `container_units`.
+
+The packing itself works on plain `Host` objects so that strategies can
+be compared against a simulated fleet (see `tools/bench_allocator.py`),
+`PoolAllocator` connects it to the pools and jobs in the database and
+is used by `armonaut.scheduler.dispatch_jobs()` once any pools exist.
+"""
+
+import datetime
+import typing
+from sqlalchemy import func
+from armonaut import db
+from armonaut.models import Pool, Job
+from armonaut.scheduler import ACTIVE_STATUSES
+
+
+class Host(object):
+    __slots__ = ('name', 'capacity', 'used')
+
+    def __init__(self, name: str, capacity: int, used: int = 0):
+        self.name = name
+        self.capacity = capacity
+        self.used = used
+
+    @property
+    def free(self) -> int:
+        return self.capacity - self.used
+
+    def __repr__(self):
+        return f'<Host {self.name} {self.used}/{self.capacity}>'
+
+
+def first_fit(hosts: typing.List[Host], units: int) -> typing.Union[None, Host]:
+    """The first host that the job fits on."""
+    for host in hosts:
+        if host.free >= units:
+            return host
+    return None
+
+
+def best_fit(hosts: typing.List[Host], units: int) -> typing.Union[None, Host]:
+    """The host with the least free units that the job fits on. Keeps
+    whole hosts free for large jobs at the cost of packing small ones tightly."""
+    fits = [host for host in hosts if host.free >= units]
+    return min(fits, key=lambda host: host.free) if fits else None
+
+
+def worst_fit(hosts: typing.List[Host], units: int) -> typing.Union[None, Host]:
+    """The host with the most free units, spreads jobs out evenly."""
+    fits = [host for host in hosts if host.free >= units]
+    return max(fits, key=lambda host: host.free) if fits else None
+
+
+STRATEGIES = {'first_fit': first_fit,
+              'best_fit': best_fit,
+              'worst_fit': worst_fit}
+
+
+def place(hosts: typing.List[Host], units: int, strategy: str = 'best_fit') -> typing.Union[None, Host]:
+    """Places a job of `units` onto one of the hosts and returns it,
+    returns None if the job doesn't fit on any host."""
+    host = STRATEGIES[strategy](hosts, units)
+    if host is not None:
+        host.used += units
+    return host
+
+
+def fleet_metrics(hosts: typing.List[Host], min_units: int = 1) -> typing.Dict[str, float]:
+    """Returns capacity metrics of a fleet.
+
+    `fragmentation` is the share of free units that aren't on the host
+    with the most free units, so 0 means all free capacity is in one
+    place. `stranded_units` are free units on hosts that can't fit a
+    job of `min_units`.
+    """
+    capacity = sum(host.capacity for host in hosts)
+    idle = sum(host.free for host in hosts)
+    largest = max((host.free for host in hosts), default=0)
+    return {'hosts': len(hosts),
+            'capacity_units': capacity,
+            'idle_units': idle,
+            'idle_hosts': sum(1 for host in hosts if host.used == 0),
+            'utilization': (capacity - idle) / capacity if capacity else 0.0,
+            'fragmentation': 1 - largest / idle if idle else 0.0,
+            'stranded_units': sum(host.free for host in hosts if host.free < min_units)}
+
+
+def pool_hosts(pool: Pool) -> typing.List[Host]:
+    """Returns the hosts of a pool with the units used by its active jobs."""
+    used = dict(db.session.query(Job.runner_host, func.sum(Job.container_units))
+                .filter(Job.pool_id == pool.id, Job.status.in_(ACTIVE_STATUSES))
+                .group_by(Job.runner_host).all())
+    return [Host(name, pool.host_units, used.get(name, 0)) for name in pool.host_names()]
+
+
+class PoolAllocator(object):
+    """Places jobs onto the hosts of the pools in the database. Jobs of
+    public projects go to community pools and jobs of private projects to
+    the other pools. The fleet is loaded once per allocator.
+    """
+    def __init__(self, strategy: str = 'best_fit'):
+        if strategy not in STRATEGIES:
+            raise ValueError(f'Unknown allocation strategy: {strategy!r}')
+        self.strategy = strategy
+        self._pools = None
+
+    def _load_pools(self) -> typing.Dict[bool, typing.List[typing.Tuple[Pool, typing.List[Host]]]]:
+        pools = {True: [], False: []}
+        for pool in Pool.query.order_by(Pool.id).all():
+            pools[pool.community].append((pool, pool_hosts(pool)))
+        return pools
+
+    def __call__(self, job: Job) -> bool:
+        """Assigns the job to a pool and host, returns False if it doesn't fit
+        anywhere. A job that is larger than every host it could be placed on
+        would never leave the queue so it errors instead."""
+        if self._pools is None:
+            self._pools = self._load_pools()
+        pools = self._pools[not job.build.project.private]
+        for pool, hosts in pools:
+            host = place(hosts, job.container_units, self.strategy)
+            if host is not None:
+                job.pool = pool
+                job.runner_host = host.name
+                return True
+        if all(job.container_units > pool.host_units for pool, _ in pools):
+            job.status = 'error'
+            job.finish_time = datetime.datetime.utcnow()
+        return False
+
+    def metrics(self) -> typing.Dict[str, typing.Dict[str, float]]:
+        """Returns `fleet_metrics()` of every pool, including placements
+        that this allocator has made but that aren't committed yet."""
+        if self._pools is None:
+            self._pools = self._load_pools()
+        return {pool.name: fleet_metrics(hosts)
+                for pools in self._pools.values() for pool, hosts in pools}
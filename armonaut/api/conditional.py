@@ -0,0 +1,80 @@
+# Copyright (C) 2017 Seth Michael Larson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Conditional GET support for the API. Every response about a project is
+derived from the project row and its builds and jobs, all of which bump
+`Project.version` when they change. The validators are computed from that
+counter alone so that a matching `If-None-Match` or `If-Modified-Since`
+can be answered with a 304 before any builds are loaded or serialized.
+
+The durations of running jobs grow with every second that passes without
+bumping `Project.version`, so no validators are sent for a project while
+any of its builds are unfinished.
+"""
+
+import hashlib
+import typing
+from flask import request, make_response
+from armonaut import __version__, db
+from armonaut.models import Project, Build, TERMINAL_STATUSES
+
+
+def project_etag(project: Project) -> str:
+    """Returns the strong ETag of the current request's representation."""
+    key = '|'.join([__version__,
+                    request.path,
+                    '&'.join(f'{k}={v}' for k, v in sorted(request.args.items(multi=True))),
+                    str(project.id),
+                    str(project.version)])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def project_last_modified(project: Project):
+    return project.update_time or project.create_time
+
+
+def is_cacheable(project: Project) -> bool:
+    """Returns True if all of the project's builds are finished."""
+    unfinished = Build.query.filter(Build.project_id == project.id,
+                                    Build.status.notin_(TERMINAL_STATUSES))
+    return not db.session.query(unfinished.exists()).scalar()
+
+
+def check_not_modified(project: Project) -> typing.Union[None, object]:
+    """Returns a 304 response if the client's cached representation of the
+    project is still current, otherwise returns None.
+    """
+    if not is_cacheable(project):
+        return None
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(project_etag(project))
+    elif request.if_modified_since is not None:
+        last_modified = project_last_modified(project).replace(microsecond=0)
+        not_modified = last_modified <= request.if_modified_since.replace(tzinfo=None)
+    else:
+        return None
+    if not not_modified:
+        return None
+    response = make_response('', 304)
+    return set_validators(response, project)
+
+
+def set_validators(response, project: Project):
+    """Adds the `ETag` and `Last-Modified` validators to a response."""
+    if not is_cacheable(project):
+        return response
+    response.set_etag(project_etag(project))
+    response.last_modified = project_last_modified(project)
+    return response
@@ -13,10 +13,22 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from flask import Blueprint, jsonify, request
+import json
+import typing
+from flask import Blueprint, jsonify, request, current_app, stream_with_context, g
 from flask_login import current_user
+from sqlalchemy import tuple_
+from sqlalchemy.orm import undefer
 from armonaut import limiter
-from armonaut.models import Project, Build, STATUSES
+from armonaut.models import Project, Build, STATUSES, builds_to_json_text, builds_to_sparse_json, \
+    projects_to_json, load_jobs, write_snapshots
+from armonaut.api.export import iter_builds_ndjson
+from armonaut.api.conditional import check_not_modified, set_validators
+from armonaut.api.pagination import decode_cursor, paginate_builds
+
+# Maximum number of projects and builds per project in a batch request.
+MAX_BATCH_PROJECTS = 500
+MAX_BATCH_BUILDS = 50
 
 
 def api_rate_limit_func() -> str:
@@ -33,12 +45,17 @@ limiter.limit(api_rate_limit_func)(api)
 @api.route('/projects/<string:host>/<string:owner>/<string:name>', methods=['GET'])
 def get_project(host, owner, name):
     """Gets information about a models"""
-    project = Project.query.filter(Project.remote_host == host,
-                                   Project.owner == owner,
-                                   Project.name == name).first()
+    try:
+        fields, embed = parse_fieldset(Project.JSON_FIELDS, Project.JSON_EMBEDS)
+    except ValueError as e:
+        return jsonify(message=str(e)), 400
+    project = Project.get_by_slug(host, owner, name)
     if project is None:
         return jsonify(message='Could not find a models with those parameters'), 404
-    return jsonify(project=project.project_to_json())
+    not_modified = check_not_modified(project)
+    if not_modified is not None:
+        return not_modified
+    return set_validators(jsonify(project=project.project_to_json(fields=fields, embed=embed)), project)
 
 
 @api.route('/projects/<string:host>/<string:owner>/<string:name>/builds', methods=['GET'])
@@ -48,47 +65,215 @@ def get_builds(host, owner, name):
     except ValueError:
         return jsonify(message='Parameter `count` must be an integer'), 400
     try:
-        page = min(int(request.args.get('page', 1)), 1)
+        page = max(int(request.args.get('page', 1)), 1)
     except ValueError:
         return jsonify(message='Parameter `page` must be an integer'), 400
-    branch = request.args.get('branch', None)
-    status = request.args.get('status', None)
-    if status is not None and status not in STATUSES:
-        return jsonify(message='Parameter `status` must be a valid status string'), 400
-    pull_request = request.args.get('pull_request', None)
-    if pull_request is not None:
-        try:
-            pull_request = int(pull_request)
-        except ValueError:
-            return jsonify(message='Parameter `pull_request` must be an integer'), 400
+    after = request.args.get('after', None)
+    before = request.args.get('before', None)
+    if after is not None and before is not None:
+        return jsonify(message='Parameters `after` and `before` are mutually exclusive'), 400
+    try:
+        for cursor in (after, before):
+            if cursor is not None:
+                decode_cursor(cursor)
+    except ValueError:
+        return jsonify(message='Parameters `after` and `before` must be cursors from a previous response'), 400
+    try:
+        filters = parse_build_filters()
+        fields, embed = parse_fieldset(Build.JSON_FIELDS, Build.JSON_EMBEDS)
+    except ValueError as e:
+        return jsonify(message=str(e)), 400
 
-    project = Project.query.filter(Project.remote_host == host,
-                                   Project.owner == owner,
-                                   Project.name == name).first()
+    project = Project.get_by_slug(host, owner, name)
     if project is None:
         return jsonify(message='Could not find a models with those parameters'), 404
+    not_modified = check_not_modified(project)
+    if not_modified is not None:
+        return not_modified
 
-    query = Build.query.filter(Build.project_id == project.id).order_by(Build.start_time.desc())
-    if branch is not None:
-        query = query.filter(Build.commit_branch == branch)
-    if status is not None:
-        query = query.filter(Build.status == status)
-    if pull_request is not None:
-        query = query.filter(Build.pull_request_number == pull_request)
-    builds = query.offset((page - 1) * count).limit(count).all()
+    query = Build.history(project.id, **filters).options(undefer(Build.snapshot))
+    if after is None and before is None and page > 1:
+        # Legacy offset pagination, only supported for compatibility.
+        # Deep pages should be walked with the `after` cursor instead.
+        query = query.offset((page - 1) * count)
+    builds, after, before = paginate_builds(query, count, after=after, before=before)
+
+    cursors = {'after': after, 'before': before}
+    if fields is None and embed == Build.JSON_EMBEDS:
+        response = json_response(f'{{"builds":{builds_to_json_text(builds, project)},'
+                                 f'"cursors":{json.dumps(cursors)}}}')
+    else:
+        response = jsonify(builds=builds_to_sparse_json(builds, project, fields, embed), cursors=cursors)
+    return save_snapshots(set_validators(response, project))
 
-    return jsonify(builds=[build.build_to_json(project) for build in builds])
+
+@api.route('/projects/<string:host>/<string:owner>/<string:name>/builds/export', methods=['GET'])
+def export_builds(host, owner, name):
+    """Streams the full build history of a project, oldest first, as
+    newline-delimited JSON. Accepts the same filters as `get_builds`."""
+    try:
+        filters = parse_build_filters()
+    except ValueError as e:
+        return jsonify(message=str(e)), 400
+    project = Project.get_by_slug(host, owner, name)
+    if project is None:
+        return jsonify(message='Could not find a models with those parameters'), 404
+    return current_app.response_class(stream_with_context(iter_builds_ndjson(project.id, **filters)),
+                                      mimetype='application/x-ndjson')
 
 
 @api.route('/projects/<string:host>/<string:owner>/<string:name>/builds/<int:build_number>', methods=['GET'])
 def get_build(host, owner, name, build_number):
-    project = Project.query.filter(Project.remote_host == host,
-                                   Project.owner == owner,
-                                   Project.name == name).first()
+    try:
+        fields, embed = parse_fieldset(Build.JSON_FIELDS, Build.JSON_EMBEDS)
+    except ValueError as e:
+        return jsonify(message=str(e)), 400
+    project = Project.get_by_slug(host, owner, name)
     if project is None:
         return jsonify(message='Could not find a models with those parameters'), 404
-    build = Build.query.filter(Build.project_id == project.id,
-                               Build.number == build_number).first()
+    not_modified = check_not_modified(project)
+    if not_modified is not None:
+        return not_modified
+    build = Build.query.options(undefer(Build.snapshot))\
+        .filter(Build.project_id == project.id,
+                Build.number == build_number).first()
     if build is None:
         return jsonify(message='Could not find a build with those parameters'), 404
-    return jsonify(build=build.build_to_json(project))
+    if fields is None and embed == Build.JSON_EMBEDS:
+        response = json_response(f'{{"build":{builds_to_json_text([build], project)[1:-1]}}}')
+    else:
+        response = jsonify(build=builds_to_sparse_json([build], project, fields, embed)[0])
+    return save_snapshots(set_validators(response, project))
+
+
+@api.route('/batch', methods=['POST'])
+def get_batch():
+    """Gets many projects and builds in a single request. The request body is
+    `{"projects": [{"host": ..., "owner": ..., "name": ..., "builds": [<number>, ...]}, ...]}`
+    and every project and build requested is charged against the rate limit.
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get('projects'), list):
+        return jsonify(message='Request body must be a JSON object with a `projects` list'), 400
+    items = body['projects']
+    if len(items) > MAX_BATCH_PROJECTS:
+        return jsonify(message=f'Parameter `projects` must have at most {MAX_BATCH_PROJECTS} items'), 400
+    slugs = []
+    numbers = []
+    for item in items:
+        try:
+            slug = (item['host'], item['owner'], item['name'])
+            build_numbers = item.get('builds', [])
+        except (TypeError, KeyError):
+            return jsonify(message='Every item of `projects` must have `host`, `owner` and `name`'), 400
+        if not all(isinstance(x, str) for x in slug):
+            return jsonify(message='Every item of `projects` must have `host`, `owner` and `name`'), 400
+        if not isinstance(build_numbers, list) or not all(type(x) is int for x in build_numbers) or \
+                len(build_numbers) > MAX_BATCH_BUILDS:
+            return jsonify(message=f'Parameter `builds` must be a list of at most {MAX_BATCH_BUILDS} integers'), 400
+        slugs.append(slug)
+        numbers.append(build_numbers)
+
+    # The request itself was already charged as the first item.
+    if not charge_rate_limit(len(slugs) + sum(len(x) for x in numbers) - 1):
+        return jsonify(message='Rate limit exceeded: Batch request costs more than the remaining '
+                               'rate limit. See https://armonaut.io/docs/rate-limit for more information'), 429
+
+    projects = {}
+    if slugs:
+        query = Project.query.filter(tuple_(Project.remote_host, Project.owner, Project.name).in_(set(slugs)))
+        projects = {(p.remote_host, p.owner, p.name): p for p in query}
+
+    builds = {}
+    build_keys = {(projects[slug].id, number)
+                  for slug, build_numbers in zip(slugs, numbers) if slug in projects
+                  for number in build_numbers}
+    if build_keys:
+        query = Build.query.options(undefer(Build.snapshot))\
+            .filter(tuple_(Build.project_id, Build.number).in_(build_keys))
+        builds = {(b.project_id, b.number): b for b in query}
+        load_jobs([b for b in builds.values() if b.stored_snapshot is None])
+
+    project_json = dict(zip(projects.keys(), projects_to_json(list(projects.values()))))
+    results = []
+    for slug, build_numbers in zip(slugs, numbers):
+        project = projects.get(slug)
+        if project is None:
+            project_text = 'null'
+            builds_text = '[]'
+        else:
+            project_text = json.dumps(project_json[slug], separators=(',', ':'))
+            builds_text = builds_to_json_text([builds[project.id, number] for number in build_numbers
+                                               if (project.id, number) in builds],
+                                              project, project_json[slug])
+        host, owner, name = (json.dumps(x) for x in slug)
+        results.append(f'{{"host":{host},"owner":{owner},"name":{name},'
+                       f'"project":{project_text},"builds":{builds_text}}}')
+
+    return save_snapshots(json_response(f'{{"projects":[{",".join(results)}]}}'))
+
+
+def charge_rate_limit(cost: int) -> bool:
+    """Charges `cost` additional hits for a request against the same
+    rate limit that the API Blueprint charged it to. Returns False
+    without charging anything if the remaining limit is too low."""
+    view_rate_limit = getattr(g, 'view_rate_limit', None)
+    if not limiter.enabled or not view_rate_limit or cost <= 0:
+        return True
+    limit, *identifiers = view_rate_limit
+    if limiter.limiter.get_window_stats(limit, *identifiers)[1] < cost:
+        return False
+    # limits doesn't support a cost per hit so every item is a hit.
+    for _ in range(cost):
+        limiter.limiter.hit(limit, *identifiers)
+    return True
+
+
+def parse_build_filters() -> dict:
+    """Parses the `branch`, `status` and `pull_request` filters of a builds
+    request. Raises `ValueError` with a message for the caller if invalid.
+    """
+    branch = request.args.get('branch', None)
+    status = request.args.get('status', None)
+    if status is not None and status not in STATUSES:
+        raise ValueError('Parameter `status` must be a valid status string')
+    pull_request = request.args.get('pull_request', None)
+    if pull_request is not None:
+        try:
+            pull_request = int(pull_request)
+        except ValueError:
+            raise ValueError('Parameter `pull_request` must be an integer')
+    return {'branch': branch, 'status': status, 'pull_request': pull_request}
+
+
+def parse_fieldset(allowed_fields: typing.Set[str], allowed_embeds: typing.Set[str]):
+    """Parses the comma-separated `fields` and `embed` parameters of a request.
+    Returns `None` for `fields` if every field is requested and all embeds by
+    default. Raises `ValueError` with a message for the caller if invalid.
+    """
+    fields = request.args.get('fields', None)
+    if fields is not None:
+        fields = {x for x in fields.split(',') if x}
+        if not fields.issubset(allowed_fields):
+            raise ValueError(f'Parameter `fields` must be a comma-separated list of: '
+                             f'{", ".join(sorted(allowed_fields))}')
+    embed = request.args.get('embed', None)
+    if embed is None:
+        embed = allowed_embeds
+    else:
+        embed = {x for x in embed.split(',') if x}
+        if not embed.issubset(allowed_embeds):
+            raise ValueError(f'Parameter `embed` must be a comma-separated list of: '
+                             f'{", ".join(sorted(allowed_embeds))}')
+    return fields, embed
+
+
+def json_response(text: str):
+    """Creates a JSON response from an already serialized document."""
+    return current_app.response_class(text, mimetype='application/json')
+
+
+def save_snapshots(response):
+    """Persists any build snapshots that were created while serializing."""
+    write_snapshots()
+    return response
@@ -0,0 +1,48 @@
+# Copyright (C) 2017 Seth Michael Larson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import typing
+from sqlalchemy.orm import undefer
+from armonaut.models import Build, load_jobs
+
+
+def iter_builds_ndjson(project_id: int, branch: str = None, status: str = None,
+                       pull_request: int = None, chunk_size: int = 500) -> typing.Iterator[str]:
+    """Yields every build of a project, oldest first, as one line of JSON
+    each. Builds are read through a server-side cursor and serialized in
+    chunks of `chunk_size` so memory use doesn't grow with the history.
+    Lines are the same as `build_to_json()` without the embedded project.
+    """
+    query = Build.history(project_id, branch=branch, status=status, pull_request=pull_request)\
+        .options(undefer(Build.snapshot))\
+        .order_by(Build.start_time.asc(), Build.id.asc())\
+        .execution_options(stream_results=True)\
+        .yield_per(chunk_size)
+
+    chunk = []
+    for build in query:
+        chunk.append(build)
+        if len(chunk) >= chunk_size:
+            yield _serialize_chunk(chunk)
+            chunk = []
+    if chunk:
+        yield _serialize_chunk(chunk)
+
+
+def _serialize_chunk(builds: typing.List[Build]) -> str:
+    load_jobs([build for build in builds if build.stored_snapshot is None])
+    # Snapshots aren't stored while exporting because the modified
+    # builds would be held by the session until the export is done.
+    return ''.join(f'{build.snapshot_text(store=False)}\n' for build in builds)
@@ -0,0 +1,81 @@
+# Copyright (C) 2017 Seth Michael Larson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Keyset (cursor) pagination for the build history. Builds are ordered
+by `(start_time, id)` descending and a cursor is an opaque encoding of
+that pair, so each page is a bounded range scan over the
+`(project_id, start_time, id)` index no matter how deep it is.
+"""
+
+import base64
+import datetime
+import typing
+from sqlalchemy import tuple_
+from armonaut.models import Build
+
+_CURSOR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(build: Build) -> str:
+    """Encodes the position of a build in the history into an opaque cursor."""
+    value = f'{build.start_time.strftime(_CURSOR_TIME_FORMAT)}|{build.id}'
+    return base64.urlsafe_b64encode(value.encode('ascii')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> typing.Tuple[datetime.datetime, int]:
+    """Decodes a cursor created by `encode_cursor()`. Raises `ValueError`
+    if the cursor is malformed in any way.
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        value = base64.urlsafe_b64decode(padded.encode('ascii')).decode('ascii')
+        start_time, build_id = value.split('|')
+        return datetime.datetime.strptime(start_time, _CURSOR_TIME_FORMAT), int(build_id)
+    except ValueError as e:
+        raise ValueError(f'Invalid cursor: {cursor!r}') from e
+
+
+def paginate_builds(query, count: int, after: str = None, before: str = None):
+    """Fetches a single page of builds from a filtered `Build` query.
+
+    Returns a tuple of the builds (newest first) and the cursors
+    that select the page after (older builds) and before (newer builds)
+    this one. A cursor is `None` if there is nothing in that direction.
+    """
+    position = tuple_(Build.start_time, Build.id)
+    if before is not None:
+        query = query.filter(position > decode_cursor(before))\
+            .order_by(Build.start_time.asc(), Build.id.asc())
+    else:
+        if after is not None:
+            query = query.filter(position < decode_cursor(after))
+        query = query.order_by(Build.start_time.desc(), Build.id.desc())
+
+    # Fetching one extra row tells us whether there is another page.
+    builds = query.limit(count + 1).all()
+    has_more = len(builds) > count
+    builds = builds[:count]
+
+    if before is not None:
+        builds.reverse()
+        has_newer, has_older = has_more, True
+    else:
+        has_newer, has_older = after is not None, has_more
+
+    if not builds:
+        return builds, None, None
+    return (builds,
+            encode_cursor(builds[-1]) if has_older else None,
+            encode_cursor(builds[0]) if has_newer else None)
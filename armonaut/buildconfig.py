@@ -0,0 +1,273 @@
+# Copyright (C) 2017 Seth Michael Larson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compiles and loads the `.armonaut.yml` of a commit.
+
+`compile_config()` parses the YAML with libyaml's `CSafeLoader` if PyYAML
+was built with it, validates the document against `SCHEMA` and normalizes
+it into the packed `Build` columns and the cells of the build matrix in a
+single walk. The schema is built from validator objects once at import.
+Errors carry the line of the offending key or value. Keys of Travis CI
+configs that builds don't use yet, like `cache`, are accepted as they are.
+
+The file at a commit never changes, so whether it exists and its compiled
+config (or the error that makes it invalid) are cached by the project's
+remote id and the commit SHA. Rebuilds, pull request re-syncs and every
+job of a matrix read the config from the cache instead of the remote
+host's API and the YAML parser. Failures to fetch the file aren't cached.
+"""
+
+import typing
+import yaml
+from armonaut.cache import SharedCache
+from armonaut.matrix import MatrixError, expand_matrix, parse_env
+from armonaut.models import Build, Project, pack_string_dict, pack_string_list
+
+try:
+    Loader = yaml.CSafeLoader
+except AttributeError:  # pragma: no cover
+    Loader = yaml.SafeLoader
+
+CONFIG_PATH = '.armonaut.yml'
+# Bumped whenever compiling changes so that old entries are ignored.
+CONFIG_CACHE_VERSION = 3
+COMMAND_COLUMNS = ('install', 'script', 'after_success', 'after_failure', 'after_script', 'deploy', 'services')
+_config_cache = SharedCache('build-config', maxsize=1024, ttl=7 * 86400, local_ttl=3600)
+
+
+class ConfigError(ValueError):
+    def __init__(self, message: str, line: int = None):
+        super(ConfigError, self).__init__(message if line is None else f'line {line}: {message}')
+        self.line = line
+
+
+def _line(node: yaml.Node) -> typing.Union[None, int]:
+    return None if node is None else node.start_mark.line + 1
+
+
+class String(object):
+    """A scalar. Numbers keep the text they were written as so that
+    `python: 3.10` isn't read as `3.1`."""
+    description = 'a string'
+
+    def __call__(self, value, node, path):
+        if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+            raise ConfigError(f'{path} must be {self.description}', _line(node))
+        if not isinstance(value, str) and isinstance(node, yaml.ScalarNode):
+            return node.value
+        return str(value)
+
+
+class Integer(object):
+    def __init__(self, minimum: int, maximum: int):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.description = f'a whole number from {minimum} to {maximum}'
+
+    def __call__(self, value, node, path):
+        if isinstance(value, bool) or not isinstance(value, int) or not self.minimum <= value <= self.maximum:
+            raise ConfigError(f'{path} must be {self.description}', _line(node))
+        return value
+
+
+class Anything(object):
+    """Keys that are accepted for compatibility but not used by builds yet."""
+    description = 'anything'
+
+    def __call__(self, value, node, path):
+        return value
+
+
+class ListOf(object):
+    """A list of items, a single item is treated as a list of one."""
+    def __init__(self, item):
+        self.item = item
+        self.description = f'{item.description} or a list of them'
+
+    def __call__(self, value, node, path):
+        if not isinstance(value, list):
+            return [self.item(value, node, path)]
+        nodes = node.value if isinstance(node, yaml.SequenceNode) else [node] * len(value)
+        return [self.item(item, item_node, f'{path}[{i}]')
+                for i, (item, item_node) in enumerate(zip(value, nodes))]
+
+
+class Mapping(object):
+    def __init__(self, fields: typing.Dict[str, typing.Any], values=None, description: str = None):
+        """`fields` validate known keys, `values` validates any other key
+        if given, otherwise other keys are errors."""
+        self.fields = fields
+        self.values = values
+        self.description = description or 'a mapping'
+
+    def __call__(self, value, node, path):
+        if not isinstance(value, dict):
+            raise ConfigError(f'{path or CONFIG_PATH} must be {self.description}', _line(node))
+        nodes = {}
+        if isinstance(node, yaml.MappingNode):
+            nodes = {key.value: (key, item) for key, item in node.value if isinstance(key, yaml.ScalarNode)}
+        result = {}
+        for key, item in value.items():
+            key_node, item_node = nodes.get(str(key), (node, node))
+            validate = self.fields.get(key, self.values)
+            if validate is None:
+                raise ConfigError(f'Unknown key {key!r} in {path or CONFIG_PATH}', _line(key_node))
+            result[str(key)] = validate(item, item_node, f'{path}.{key}' if path else str(key))
+        return result
+
+
+class OneOf(object):
+    def __init__(self, *choices):
+        self.choices = choices
+        self.description = ' or '.join(choice.description for choice in choices)
+
+    def __call__(self, value, node, path):
+        for choice in self.choices:
+            try:
+                return choice(value, node, path)
+            except ConfigError:
+                continue
+        raise ConfigError(f'{path} must be {self.description}', _line(node))
+
+
+class Env(object):
+    """An env entry like `A=1 B="two words"` or a mapping, normalized to a mapping."""
+    description = 'a KEY=VALUE string or a mapping of strings'
+
+    def __init__(self):
+        self.mapping = Mapping({}, values=String())
+
+    def __call__(self, value, node, path):
+        if isinstance(value, dict):
+            return self.mapping(value, node, path)
+        if not isinstance(value, str):
+            raise ConfigError(f'{path} must be {self.description}', _line(node))
+        try:
+            return parse_env(value)
+        except MatrixError as e:
+            raise ConfigError(str(e), _line(node)) from e
+
+
+class EnvConfig(object):
+    """Either env entries or a mapping with `global` and `matrix` entries."""
+    def __init__(self, entries):
+        self.entries = entries
+        self.split = Mapping({'global': entries, 'matrix': entries})
+        self.description = f'{self.split.description} or {entries.description}'
+
+    def __call__(self, value, node, path):
+        if isinstance(value, dict) and ('global' in value or 'matrix' in value):
+            return self.split(value, node, path)
+        return self.entries(value, node, path)
+
+
+STRING = String()
+STRINGS = ListOf(STRING)
+# Job.container_units is a SMALLINT.
+CONTAINER_UNITS = Integer(1, 32767)
+ENV_ENTRY = Env()
+ENV_ENTRIES = ListOf(ENV_ENTRY)
+MATRIX_ENTRY = Mapping({'python': STRING, 'env': ENV_ENTRY, 'stage': STRING})
+MATRIX_ENTRIES = ListOf(MATRIX_ENTRY)
+INCLUDE_ENTRIES = ListOf(Mapping(dict(MATRIX_ENTRY.fields, container_units=CONTAINER_UNITS)))
+IGNORED_KEYS = ('cache', 'sudo', 'dist', 'os', 'addons', 'git', 'notifications')
+
+SCHEMA = Mapping({
+    'language': STRING,
+    'python': STRINGS,
+    'env': EnvConfig(ENV_ENTRIES),
+    'stages': ListOf(OneOf(STRING, Mapping({'name': STRING}))),
+    'container_units': CONTAINER_UNITS,
+    # Versions of the services.
+    'redis': STRING,
+    'postgresql': STRING,
+    'branches': Mapping({'only': STRINGS, 'except': STRINGS}),
+    'matrix': Mapping({'include': INCLUDE_ENTRIES,
+                       'exclude': MATRIX_ENTRIES,
+                       'allow_failures': MATRIX_ENTRIES}),
+    **{column: STRINGS for column in COMMAND_COLUMNS},
+    **{key: Anything() for key in IGNORED_KEYS}
+})
+
+
+def _load_yaml(text: str) -> typing.Tuple[typing.Any, yaml.Node]:
+    loader = Loader(text)
+    try:
+        node = loader.get_single_node()
+        return (None if node is None else loader.construct_document(node)), node
+    except yaml.MarkedYAMLError as e:
+        mark = e.problem_mark or e.context_mark
+        raise ConfigError(f'Invalid YAML: {e.problem or e.context}', None if mark is None else mark.line + 1) from e
+    except yaml.YAMLError as e:
+        raise ConfigError(f'Invalid YAML: {e}') from e
+    finally:
+        loader.dispose()
+
+
+def compile_config(text: str) -> typing.Dict[str, typing.Any]:
+    """Compiles the text of a `.armonaut.yml` into the validated `config`,
+    the packed `columns` of its `Build` and the `cells` of its matrix."""
+    data, node = _load_yaml(text)
+    if data is None:
+        data = {}
+    config = SCHEMA(data, node, '')
+
+    try:
+        cells = expand_matrix(config)
+    except MatrixError as e:
+        key_node = None
+        if isinstance(node, yaml.MappingNode):
+            key_node = next((key for key, _ in node.value if key.value == 'matrix'), None)
+        raise ConfigError(str(e), _line(key_node)) from e
+
+    env = config.get('env')
+    global_env = {}
+    if isinstance(env, dict) and ('global' in env or 'matrix' in env):
+        for entry in env.get('global', []):
+            global_env.update(entry)
+
+    columns = {column: pack_string_list(config.get(column)) for column in COMMAND_COLUMNS}
+    columns['env'] = pack_string_dict(global_env)
+    return {'config': config, 'columns': columns, 'cells': cells}
+
+
+def apply_build_config(build: Build, compiled: typing.Dict[str, typing.Any]) -> None:
+    for column, value in compiled['columns'].items():
+        setattr(build, column, value)
+
+
+def _cache_key(project: Project, commit: str) -> str:
+    return f'{CONFIG_CACHE_VERSION}:{project.remote_host}:{project.remote_id}:{commit}'
+
+
+def load_build_config(project: Project, commit: str) -> typing.Dict[str, typing.Any]:
+    """Returns `{'exists': bool, 'compiled': dict, 'error': str}` for the
+    `.armonaut.yml` of a commit, `compiled` is the result of
+    `compile_config()` or None if the file doesn't exist or is invalid and
+    `error` says why it is invalid."""
+    key = _cache_key(project, commit)
+    entry = _config_cache.get(key)
+    if entry is not None:
+        return entry
+
+    text = project.get_file(CONFIG_PATH, commit)
+    entry = {'exists': text is not None, 'compiled': None, 'error': None}
+    if text is not None:
+        try:
+            entry['compiled'] = compile_config(text)
+        except ConfigError as e:
+            entry['error'] = str(e)
+    _config_cache.set(key, entry)
+    return entry
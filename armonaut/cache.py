@@ -0,0 +1,139 @@
+# Copyright (C) 2017 Seth Michael Larson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Two-level caches shared by the web and worker processes. Values are
+kept in a small in-process LRU and in Redis (if `CACHE_REDIS_URL` is
+configured) so that a value computed by one process is reused by all
+of them. Redis being unavailable never fails a request, the cache just
+degrades to the in-process level.
+"""
+
+import json
+import logging
+import threading
+import time
+import typing
+from collections import OrderedDict
+import redis
+from flask import current_app, has_app_context
+
+logger = logging.getLogger(__name__)
+_redis_clients = {}
+_MISSING = object()
+
+
+def get_redis() -> typing.Union[None, redis.StrictRedis]:
+    """Returns the Redis client for the configured `CACHE_REDIS_URL` or
+    None if there is no application context or no cache configured.
+    """
+    if not has_app_context():
+        return None
+    url = current_app.config.get('CACHE_REDIS_URL')
+    if not url:
+        return None
+    client = _redis_clients.get(url)
+    if client is None:
+        client = redis.StrictRedis.from_url(url, socket_timeout=0.25, socket_connect_timeout=0.25)
+        _redis_clients[url] = client
+    return client
+
+
+class LRUCache(object):
+    """Thread-safe, size-bounded in-process cache with per-entry expiry."""
+    def __init__(self, maxsize: int, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._data[key] = (value, None if ttl is None else time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SharedCache(object):
+    """An `LRUCache` backed by Redis. Values must be JSON serializable."""
+    def __init__(self, namespace: str, maxsize: int, ttl: int, local_ttl: float = None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.local = LRUCache(maxsize, ttl=ttl if local_ttl is None else local_ttl)
+
+    def _redis_key(self, key: str) -> str:
+        return f'armonaut:{self.namespace}:{key}'
+
+    def get(self, key: str, default=None):
+        value = self.local.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        client = get_redis()
+        if client is None:
+            return default
+        try:
+            data = client.get(self._redis_key(key))
+        except redis.RedisError:
+            logger.warning('Could not read %s from the shared cache', key, exc_info=True)
+            return default
+        if data is None:
+            return default
+        value = json.loads(data)
+        self.local.set(key, value)
+        return value
+
+    def set(self, key: str, value) -> None:
+        self.local.set(key, value)
+        client = get_redis()
+        if client is None:
+            return
+        try:
+            client.set(self._redis_key(key), json.dumps(value), ex=self.ttl)
+        except redis.RedisError:
+            logger.warning('Could not write %s to the shared cache', key, exc_info=True)
+
+    def delete(self, key: str) -> None:
+        self.local.delete(key)
+        client = get_redis()
+        if client is None:
+            return
+        try:
+            client.delete(self._redis_key(key))
+        except redis.RedisError:
+            logger.warning('Could not delete %s from the shared cache', key, exc_info=True)
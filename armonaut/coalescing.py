@@ -0,0 +1,133 @@
+# Copyright (C) 2017 Seth Michael Larson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Coalesces rapid pushes to the same branch or pull request so that only
+the newest commit is built.
+
+Pushes are first debounced for `BUILD_DEBOUNCE_SECONDS`: the newest delivery
+for a branch or pull request is remembered in Redis and a build is only
+created for a delivery that is still the newest one when its delay is up.
+Once a build is created any older builds for the same branch or pull
+request that haven't finished are canceled along with their jobs. The
+stored status of a build isn't updated as its jobs run, so builds are
+chosen by the statuses of their jobs.
+"""
+
+import datetime
+import logging
+import typing
+import redis
+from flask import current_app
+from sqlalchemy import exists, or_
+from armonaut.cache import get_redis
+from armonaut.models import TERMINAL_STATUSES, Build, Job
+
+logger = logging.getLogger(__name__)
+
+
+def coalescing_key(values: typing.Dict[str, typing.Any]) -> typing.Union[None, str]:
+    """Returns the key that builds supersede each other by, tags are
+    never superseded and return None."""
+    if values.get('pull_request_number') is not None:
+        if not current_app.config['AUTO_CANCEL_PULL_REQUEST_BUILDS']:
+            return None
+        return f'pr:{values["pull_request_number"]}'
+    if values.get('commit_tag') is not None or not current_app.config['AUTO_CANCEL_BRANCH_BUILDS']:
+        return None
+    return f'branch:{values["commit_branch"]}'
+
+
+def _debounce_key(project_id: int, key: str) -> str:
+    return f'armonaut:debounce:{project_id}:{key}'
+
+
+def debounce(project_id: int, key: str, delivery_id: str) -> bool:
+    """Records a delivery as the newest one for its key. Returns False if
+    debouncing isn't possible and the build should be created right away.
+    """
+    delay = current_app.config['BUILD_DEBOUNCE_SECONDS']
+    client = get_redis()
+    if not delay or client is None or key is None or delivery_id is None:
+        return False
+    try:
+        client.set(_debounce_key(project_id, key), delivery_id, ex=int(delay * 10) + 60)
+    except redis.RedisError:
+        logger.warning('Could not debounce delivery %s', delivery_id, exc_info=True)
+        return False
+    return True
+
+
+def is_newest_delivery(project_id: int, key: str, delivery_id: str) -> bool:
+    """Returns False if a newer delivery was debounced for the same key."""
+    client = get_redis()
+    if client is None:
+        return True
+    try:
+        newest = client.get(_debounce_key(project_id, key))
+    except redis.RedisError:
+        logger.warning('Could not check debounced delivery %s', delivery_id, exc_info=True)
+        return True
+    return newest is None or newest.decode('utf-8') == delivery_id
+
+
+def cancel_superseded_builds(build: Build) -> typing.List[Build]:
+    """Cancels the unfinished builds that `build` supersedes. The changes are
+    made through the ORM so that the project's latest build and version
+    are kept up to date, the caller commits them.
+    """
+    values = {'pull_request_number': build.pull_request_number,
+              'commit_tag': build.commit_tag,
+              'commit_branch': build.commit_branch}
+    key = coalescing_key(values)
+    if key is None:
+        return []
+
+    statuses = ['queued']
+    if current_app.config['AUTO_CANCEL_RUNNING_JOBS']:
+        statuses.extend(['starting', 'running'])
+
+    def has_jobs(*statuses):
+        condition = exists().where(Job.build_id == Build.id)
+        return condition.where(Job.status.in_(statuses)) if statuses else condition
+
+    # Builds without jobs yet are canceled too, builds with running jobs
+    # are left alone unless running jobs may be canceled.
+    query = Build.query.filter(Build.project_id == build.project_id,
+                               Build.number < build.number,
+                               Build.status.notin_(TERMINAL_STATUSES),
+                               or_(has_jobs(*statuses), ~has_jobs()))
+    if not current_app.config['AUTO_CANCEL_RUNNING_JOBS']:
+        query = query.filter(~has_jobs('starting', 'running'))
+    if build.pull_request_number is not None:
+        query = query.filter(Build.pull_request_number == build.pull_request_number)
+    else:
+        query = query.filter(Build.commit_branch == build.commit_branch,
+                             Build.pull_request_number.is_(None),
+                             Build.commit_tag.is_(None))
+    builds = query.all()
+    if not builds:
+        return []
+
+    now = datetime.datetime.utcnow()
+    jobs = Job.query.filter(Job.build_id.in_([b.id for b in builds]), Job.status.in_(statuses)).all()
+    for job in jobs:
+        job.status = 'canceled'
+        job.finish_time = now
+    for superseded in builds:
+        superseded.status = 'canceled'
+        superseded.finish_time = now
+    logger.info('Build %d of project %d canceled builds %s', build.number, build.project_id,
+                ', '.join(str(b.number) for b in builds))
+    return builds
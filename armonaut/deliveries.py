@@ -0,0 +1,202 @@
+# Copyright (C) 2017 Seth Michael Larson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Remembers which webhook deliveries have been accepted so that retried
+deliveries don't create duplicate builds.
+
+Recent delivery ids are stored exactly in Redis for `WEBHOOK_DELIVERY_TTL`
+seconds, which covers the providers' automatic retries. Older deliveries
+are remembered by a Bloom filter bitmap per `WEBHOOK_DELIVERY_WINDOW`,
+sized for `WEBHOOK_DELIVERY_CAPACITY` deliveries, so memory stays bounded
+no matter how many deliveries are received. If Redis is unavailable an
+in-process Bloom filter is used instead.
+
+A delivery is claimed before it is handed to the worker and only added to
+the Bloom filter once that succeeded, a failed hand-off releases the claim
+so that the provider's retry isn't ignored as a duplicate.
+"""
+
+import hashlib
+import logging
+import math
+import threading
+import time
+import typing
+import redis
+from flask import current_app
+from armonaut.cache import get_redis
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter(object):
+    """A Bloom filter with `capacity` items at the given false positive rate."""
+    def __init__(self, capacity: int, error_rate: float):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = None
+
+    def positions(self, key: str) -> typing.List[int]:
+        digest = hashlib.sha256(key.encode('utf-8')).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:16], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str) -> bool:
+        """Adds a key to the filter and returns whether it was (probably) present."""
+        if self._bits is None:
+            self._bits = bytearray((self.size + 7) // 8)
+        present = True
+        for position in self.positions(key):
+            byte, bit = divmod(position, 8)
+            if not self._bits[byte] & (1 << bit):
+                present = False
+                self._bits[byte] |= 1 << bit
+        return present
+
+    def __contains__(self, key: str) -> bool:
+        if self._bits is None:
+            return False
+        return all(self._bits[position // 8] & (1 << (position % 8))
+                   for position in self.positions(key))
+
+
+class DeliveryStore(object):
+    def __init__(self, namespace: str):
+        self.namespace = namespace
+        self._filter = None
+        self._local = {}
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def _get_filter(self) -> BloomFilter:
+        if self._filter is None:
+            self._filter = BloomFilter(current_app.config['WEBHOOK_DELIVERY_CAPACITY'],
+                                       current_app.config['WEBHOOK_DELIVERY_ERROR_RATE'])
+        return self._filter
+
+    def _generations(self) -> typing.Tuple[int, int]:
+        window = current_app.config['WEBHOOK_DELIVERY_WINDOW']
+        current = int(time.time() // window)
+        return current - 1, current
+
+    def _delivery_key(self, key: str) -> str:
+        return f'armonaut:{self.namespace}:{key}'
+
+    def _bloom_key(self, generation: int) -> str:
+        return f'armonaut:{self.namespace}-bloom:{generation}'
+
+    def seen(self, key: str) -> bool:
+        """Returns True if the delivery has been claimed before. This is only
+        a hint, `claim()` must still be called once the delivery is verified.
+        """
+        client = get_redis()
+        if client is not None:
+            try:
+                return self._redis_seen(client, key)
+            except redis.RedisError:
+                logger.warning('Could not check delivery %s in Redis', key, exc_info=True)
+        with self._lock:
+            return any(key in bloom for bloom in self._local_filters(create=False))
+
+    def claim(self, key: str) -> bool:
+        """Reserves a delivery, returns False if it was already recorded or
+        is reserved. `record()` must follow once the delivery is handed off
+        or `release()` if that failed, so that a retry can claim it again.
+        """
+        client = get_redis()
+        if client is not None:
+            try:
+                return self._redis_claim(client, key)
+            except redis.RedisError:
+                logger.warning('Could not claim delivery %s in Redis', key, exc_info=True)
+        with self._lock:
+            if key in self._pending or any(key in bloom for bloom in self._local_filters(create=False)):
+                return False
+            self._pending.add(key)
+            return True
+
+    def record(self, key: str) -> None:
+        """Remembers a claimed delivery in the Bloom filter."""
+        client = get_redis()
+        if client is not None:
+            try:
+                self._redis_record(client, key)
+                return
+            except redis.RedisError:
+                logger.warning('Could not record delivery %s in Redis', key, exc_info=True)
+        with self._lock:
+            self._pending.discard(key)
+            self._local_filters(create=True)[1].add(key)
+
+    def release(self, key: str) -> None:
+        """Gives up the claim of a delivery that couldn't be handed off."""
+        with self._lock:
+            self._pending.discard(key)
+        client = get_redis()
+        if client is not None:
+            try:
+                client.delete(self._delivery_key(key))
+            except redis.RedisError:
+                logger.warning('Could not release delivery %s in Redis', key, exc_info=True)
+
+    def _redis_seen(self, client, key: str) -> bool:
+        positions = self._get_filter().positions(key)
+        pipe = client.pipeline(transaction=False)
+        pipe.exists(self._delivery_key(key))
+        for generation in self._generations():
+            for position in positions:
+                pipe.getbit(self._bloom_key(generation), position)
+        results = pipe.execute()
+        previous, current = results[1:1 + len(positions)], results[1 + len(positions):]
+        return bool(results[0]) or all(previous) or all(current)
+
+    def _redis_claim(self, client, key: str) -> bool:
+        positions = self._get_filter().positions(key)
+        pipe = client.pipeline(transaction=True)
+        pipe.set(self._delivery_key(key), 1, nx=True, ex=current_app.config['WEBHOOK_DELIVERY_TTL'])
+        for generation in self._generations():
+            for position in positions:
+                pipe.getbit(self._bloom_key(generation), position)
+        results = pipe.execute()
+        previous, current = results[1:1 + len(positions)], results[1 + len(positions):]
+        return bool(results[0]) and not all(previous) and not all(current)
+
+    def _redis_record(self, client, key: str) -> None:
+        current = self._bloom_key(self._generations()[1])
+        pipe = client.pipeline(transaction=True)
+        for position in self._get_filter().positions(key):
+            pipe.setbit(current, position, 1)
+        pipe.expire(current, 2 * current_app.config['WEBHOOK_DELIVERY_WINDOW'])
+        pipe.execute()
+
+    def _local_filters(self, create: bool) -> typing.List[BloomFilter]:
+        generations = self._generations()
+        for generation in list(self._local):
+            if generation not in generations:
+                del self._local[generation]
+        filters = []
+        for generation in generations:
+            bloom = self._local.get(generation)
+            if bloom is None:
+                bloom = BloomFilter(current_app.config['WEBHOOK_DELIVERY_CAPACITY'],
+                                    current_app.config['WEBHOOK_DELIVERY_ERROR_RATE'])
+                if create:
+                    self._local[generation] = bloom
+            filters.append(bloom)
+        return filters
+
+
+webhook_deliveries = DeliveryStore('webhook-deliveries')
@@ -0,0 +1,191 @@
+# Copyright (C) 2017 Seth Michael Larson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Keeps outbound API calls within the rate limit of each access token.
+
+The remaining budget and reset time of a token are read from the rate
+limit headers of every response (`X-RateLimit-*` on GitHub and Bitbucket,
+`RateLimit-*` on GitLab) and `Retry-After` stops all calls with the token
+until it has passed. Urgent calls like commit statuses may use the whole
+budget. Other calls like syncs can't touch the last `reserve` of it, are
+paced by a token bucket that spreads the rest evenly until the reset and
+wait while urgent calls with the same token are waiting. Calls that would
+have to wait longer than `max_wait` raise `RateLimited` instead.
+
+The budget comes from the remote host, so all processes using a token
+converge on it with every response even though each governs its own calls.
+"""
+
+import hashlib
+import threading
+import time
+import typing
+import requests
+from armonaut.cache import LRUCache
+
+DEFAULT_WINDOW = 3600.0
+MAX_BUDGETS = 10000
+
+
+class RateLimited(requests.RequestException):
+    """Raised instead of sending a call that would exceed the rate limit."""
+    def __init__(self, message: str, wait: float):
+        super(RateLimited, self).__init__(message)
+        self.wait = wait
+
+
+def _header(response: requests.Response, *names: str) -> typing.Union[None, float]:
+    for name in names:
+        value = response.headers.get(name)
+        if value is not None:
+            try:
+                return float(value)
+            except ValueError:
+                return None
+    return None
+
+
+class Budget(object):
+    __slots__ = ('limit', 'remaining', 'reset_at', 'blocked_until', 'tokens', 'refill_time', 'urgent_waiting')
+
+    def __init__(self, now: float):
+        self.limit = None
+        self.remaining = None
+        self.reset_at = None
+        self.blocked_until = 0.0
+        self.tokens = 1.0
+        self.refill_time = now
+        self.urgent_waiting = 0
+
+
+class Governor(object):
+    def __init__(self, reserve: float = 0.2, burst: float = 10.0,
+                 max_wait: typing.Tuple[float, float] = (10.0, 60.0)):
+        """`max_wait` is the longest wait of urgent and of other calls."""
+        self.reserve = reserve
+        self.burst = burst
+        self.max_wait = max_wait
+        self.calls = 0
+        self.delayed = 0
+        self.rejected = 0
+        self.queue_time = 0.0
+        self.max_queue_time = 0.0
+        # Budgets of tokens that weren't used for a whole window are stale.
+        self._budgets = LRUCache(MAX_BUDGETS, ttl=DEFAULT_WINDOW)
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def key(token: str) -> str:
+        return hashlib.sha1(token.encode('utf-8')).hexdigest()
+
+    def _budget(self, token: str, now: float) -> Budget:
+        key = self.key(token)
+        budget = self._budgets.get(key)
+        if budget is None:
+            budget = Budget(now)
+        self._budgets.set(key, budget)
+        return budget
+
+    def _wait_time(self, budget: Budget, urgent: bool, now: float) -> float:
+        """Returns how long the call has to wait, 0 if it can be sent now."""
+        if budget.blocked_until > now:
+            return budget.blocked_until - now
+        if budget.remaining is None:
+            return 0.0
+        if budget.reset_at <= now:
+            budget.remaining = budget.limit
+            budget.reset_at = now + DEFAULT_WINDOW
+        if urgent:
+            return 0.0 if budget.remaining > 0 else budget.reset_at - now
+
+        spare = budget.remaining - self.reserve * budget.limit
+        if spare < 1:
+            return budget.reset_at - now
+        rate = spare / max(budget.reset_at - now, 1.0)
+        budget.tokens = min(self.burst, budget.tokens + (now - budget.refill_time) * rate)
+        budget.refill_time = now
+        return 0.0 if budget.tokens >= 1 else (1 - budget.tokens) / rate
+
+    def acquire(self, token: str, urgent: bool = True) -> float:
+        """Waits until a call with the token may be sent and returns how
+        long it waited. Raises `RateLimited` if that would be too long."""
+        max_wait = self.max_wait[0 if urgent else 1]
+        with self._cond:
+            start = now = time.monotonic()
+            budget = self._budget(token, now)
+            if urgent:
+                budget.urgent_waiting += 1
+            try:
+                while True:
+                    if not urgent and budget.urgent_waiting:
+                        # Urgent calls notify when they are done waiting.
+                        if now - start >= max_wait:
+                            self.rejected += 1
+                            raise RateLimited('Rate limit of token is used by urgent calls', max_wait)
+                        self._cond.wait(max_wait - (now - start))
+                        now = time.monotonic()
+                        continue
+                    wait = self._wait_time(budget, urgent, now)
+                    if wait <= 0:
+                        break
+                    if now - start + wait > max_wait:
+                        self.rejected += 1
+                        raise RateLimited(f'Rate limit of token exhausted, retry in {wait:.1f}s', wait)
+                    self._cond.wait(wait)
+                    now = time.monotonic()
+            finally:
+                if urgent:
+                    budget.urgent_waiting -= 1
+                    self._cond.notify_all()
+
+            if budget.remaining is not None:
+                budget.remaining -= 1
+                if not urgent:
+                    budget.tokens -= 1
+            waited = now - start
+            self.calls += 1
+            if waited > 0:
+                self.delayed += 1
+                self.queue_time += waited
+                self.max_queue_time = max(self.max_queue_time, waited)
+            return waited
+
+    def update(self, token: str, response: requests.Response) -> None:
+        """Updates the budget of the token from the headers of a response."""
+        remaining = _header(response, 'X-RateLimit-Remaining', 'RateLimit-Remaining')
+        retry_after = _header(response, 'Retry-After')
+        if remaining is None and retry_after is None:
+            return
+        with self._cond:
+            now = time.monotonic()
+            budget = self._budget(token, now)
+            if retry_after is not None:
+                budget.blocked_until = max(budget.blocked_until, now + retry_after)
+            if remaining is not None:
+                limit = _header(response, 'X-RateLimit-Limit', 'RateLimit-Limit')
+                reset = _header(response, 'X-RateLimit-Reset', 'RateLimit-Reset')
+                budget.remaining = remaining
+                budget.limit = max(limit or 0, remaining)
+                budget.reset_at = now + (DEFAULT_WINDOW if reset is None else max(reset - time.time(), 0))
+            self._cond.notify_all()
+
+    def stats_to_json(self) -> typing.Dict[str, typing.Any]:
+        with self._cond:
+            return {'calls': self.calls,
+                    'delayed': self.delayed,
+                    'rejected': self.rejected,
+                    'mean_queue_time': self.queue_time / self.delayed if self.delayed else 0.0,
+                    'max_queue_time': self.max_queue_time,
+                    'tokens': len(self._budgets)}
@@ -0,0 +1,192 @@
+# Copyright (C) 2017 Seth Michael Larson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Imports all repositories that an account has access to as projects.
+
+The repository listings of the remote hosts already contain everything a
+`Project` needs, so instead of a request per repository the pages of the
+listing are fetched: the first page tells how many pages there are and
+the rest are fetched concurrently with at most `IMPORT_CONCURRENCY`
+requests in flight. Repositories are upserted in batches with a single
+`INSERT ... ON CONFLICT` on the remote host and id each, so renamed
+repositories are updated in place and unchanged ones aren't written.
+Projects whose slug was taken by a repository with another remote id, one
+that was recreated or transferred, are moved out of the way first.
+"""
+
+import datetime
+import math
+import typing
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+import requests
+from flask import current_app
+from sqlalchemy import bindparam, or_, tuple_, update
+from sqlalchemy.dialects import postgresql, sqlite
+from armonaut import db
+from armonaut.models import Account, Project
+from armonaut.providers import ProviderClient, github, gitlab, bitbucket
+
+UPSERT_BATCH_SIZE = 500
+
+
+def _github_page_count(response: requests.Response) -> int:
+    last = response.links.get('last')
+    if last is None:
+        return 1
+    return int(parse_qs(urlsplit(last['url']).query)['page'][0])
+
+
+def _github_repository(repo: dict) -> dict:
+    return {'remote_id': repo['id'],
+            'owner': repo['owner']['login'],
+            'name': repo['name'],
+            'default_branch': repo.get('default_branch') or 'master',
+            'private': repo['private']}
+
+
+def _gitlab_repository(repo: dict) -> dict:
+    owner, _, name = repo['path_with_namespace'].rpartition('/')
+    return {'remote_id': repo['id'],
+            'owner': owner,
+            'name': name,
+            'default_branch': repo.get('default_branch') or 'master',
+            'private': repo.get('visibility') != 'public'}
+
+
+def _bitbucket_page_count(response: requests.Response) -> int:
+    data = response.json()
+    if 'size' not in data:
+        return 1
+    return max(math.ceil(data['size'] / data['pagelen']), 1)
+
+
+def _bitbucket_repository(repo: dict) -> dict:
+    owner, _, name = repo['full_name'].partition('/')
+    # Bitbucket repositories only have a UUID, the remote id is its first 63 bits.
+    return {'remote_id': uuid.UUID(repo['uuid']).int >> 65,
+            'owner': owner,
+            'name': name,
+            'default_branch': (repo.get('mainbranch') or {}).get('name') or 'master',
+            'private': repo['is_private']}
+
+
+class Listing(typing.NamedTuple):
+    client: ProviderClient
+    token_attr: str
+    url: str
+    params: typing.Dict[str, typing.Any]
+    page_count: typing.Callable[[requests.Response], int]
+    items: typing.Callable[[typing.Any], typing.List[dict]]
+    repository: typing.Callable[[dict], dict]
+
+
+LISTINGS = {
+    'gh': Listing(github, 'github_access_token', '/user/repos', {'per_page': 100},
+                  _github_page_count, lambda data: data, _github_repository),
+    'gl': Listing(gitlab, 'gitlab_access_token', '/projects', {'membership': 'true', 'per_page': 100},
+                  lambda r: int(r.headers.get('X-Total-Pages') or 1), lambda data: data, _gitlab_repository),
+    'bb': Listing(bitbucket, 'bitbucket_access_token', '/repositories', {'role': 'member', 'pagelen': 100},
+                  _bitbucket_page_count, lambda data: data['values'], _bitbucket_repository)
+}
+
+
+def _fetch_page(listing: Listing, token: str, page: int) -> requests.Response:
+    # Listing pages are large and change whenever any repository does, they aren't worth caching.
+    response = listing.client.get(listing.url, token, cache=False, urgent=False,
+                                  params=dict(listing.params, page=page))
+    response.raise_for_status()
+    return response
+
+
+def fetch_repositories(listing: Listing, token: str, concurrency: int) -> typing.Tuple[int, typing.List[dict]]:
+    """Returns the number of pages and the repositories of a listing."""
+    first = _fetch_page(listing, token, 1)
+    pages = [first]
+    page_count = listing.page_count(first)
+    if page_count > 1:
+        with ThreadPoolExecutor(max_workers=min(concurrency, page_count - 1)) as pool:
+            pages.extend(pool.map(lambda page: _fetch_page(listing, token, page), range(2, page_count + 1)))
+    repositories = {}
+    for page in pages:
+        for repo in listing.items(page.json()):
+            repository = listing.repository(repo)
+            repositories[repository['remote_id']] = repository
+    return page_count, list(repositories.values())
+
+
+def _insert():
+    if db.engine.dialect.name == 'postgresql':
+        return postgresql.insert(Project.__table__)
+    return sqlite.insert(Project.__table__)
+
+
+def _release_slugs(remote_host: str, rows: typing.List[dict], now: datetime.datetime) -> None:
+    """Renames projects whose slug is taken by a row with another remote id
+    to `name#remote_id`, which can't be a repository name on any host.
+    Projects still listed get their slug back from their own row."""
+    table = Project.__table__
+    slugs = {(row['owner'], row['name']): row['remote_id'] for row in rows}
+    taken = db.session.execute(
+        table.select().with_only_columns(table.c.id, table.c.owner, table.c.name, table.c.remote_id)
+        .where(table.c.remote_host == remote_host,
+               tuple_(table.c.owner, table.c.name).in_(list(slugs))))
+    params = [{'project_id': project_id, 'new_name': f'{name}#{remote_id}'}
+              for project_id, owner, name, remote_id in taken if slugs[(owner, name)] != remote_id]
+    if params:
+        db.session.execute(update(table)
+                           .where(table.c.id == bindparam('project_id'))
+                           .values(name=bindparam('new_name'), version=table.c.version + 1, update_time=now),
+                           params)
+
+
+def upsert_projects(account: Account, remote_host: str, repositories: typing.List[dict]) -> None:
+    """Inserts or updates the projects of repositories in batches. This
+    bypasses the ORM, changed projects get their version bumped here."""
+    table = Project.__table__
+    now = datetime.datetime.utcnow()
+    for i in range(0, len(repositories), UPSERT_BATCH_SIZE):
+        rows = [dict(repository, remote_host=remote_host, account_id=account.id)
+                for repository in repositories[i:i + UPSERT_BATCH_SIZE]]
+        _release_slugs(remote_host, rows, now)
+        insert = _insert()
+        excluded = insert.excluded
+        changed = [table.c[column] != excluded[column] for column in ('owner', 'name', 'default_branch', 'private')]
+        statement = insert.on_conflict_do_update(
+            index_elements=[table.c.remote_host, table.c.remote_id],
+            set_={'owner': excluded.owner,
+                  'name': excluded.name,
+                  'default_branch': excluded.default_branch,
+                  'private': excluded.private,
+                  'version': table.c.version + 1,
+                  'update_time': now},
+            where=or_(*changed))
+        db.session.execute(statement, rows)
+
+
+def import_projects(account: Account, remote_host: str, concurrency: int = None) -> typing.Dict[str, int]:
+    """Imports every repository that the account's token for the remote
+    host has access to and returns the number of pages and repositories."""
+    listing = LISTINGS[remote_host]
+    token = getattr(account, listing.token_attr)
+    if token is None:
+        return {'pages': 0, 'repositories': 0}
+    if concurrency is None:
+        concurrency = current_app.config['IMPORT_CONCURRENCY']
+    pages, repositories = fetch_repositories(listing, token, concurrency)
+    upsert_projects(account, remote_host, repositories)
+    db.session.commit()
+    return {'pages': pages, 'repositories': len(repositories)}
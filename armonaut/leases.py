@@ -0,0 +1,160 @@
+# Copyright (C) 2017 Seth Michael Larson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Lease-based ownership of jobs by workers.
+
+A worker claims a job for `JOB_LEASE_TTL` seconds and keeps the lease
+alive with heartbeats. Heartbeats are only written to a Redis hash and
+`flush_heartbeats()` renews the leases of all of them with one bulk
+UPDATE, so many running jobs don't cause a write per heartbeat to the
+`jobs` table. `reap_expired_leases()` moves jobs whose worker stopped
+heartbeating back to `queued`, or to `error` after `JOB_LEASE_MAX_ATTEMPTS`.
+"""
+
+import datetime
+import logging
+import time
+import typing
+import redis
+from flask import current_app
+from sqlalchemy import update, bindparam
+from armonaut import db
+from armonaut.cache import get_redis
+from armonaut.models import Job
+
+logger = logging.getLogger(__name__)
+HEARTBEATS_KEY = 'armonaut:job-heartbeats'
+
+
+def _lease_expire_time(timestamp: float) -> datetime.datetime:
+    return datetime.datetime.utcfromtimestamp(timestamp + current_app.config['JOB_LEASE_TTL'])
+
+
+def claim_job(job_id: int, worker_id: str) -> typing.Union[None, Job]:
+    """Claims a queued or starting job for a worker and marks it as
+    running, returns None if the job is already owned or finished."""
+    job = Job.query.filter(Job.id == job_id).with_for_update().first()
+    if job is None or job.status not in ('queued', 'starting') or job.lease_owner is not None:
+        db.session.rollback()
+        return None
+    job.status = 'running'
+    job.start_time = datetime.datetime.utcnow()
+    job.lease_owner = worker_id
+    job.lease_expire_time = _lease_expire_time(time.time())
+    job.attempts += 1
+    db.session.commit()
+    return job
+
+
+def heartbeat(worker_id: str, job_ids: typing.Iterable[int]) -> None:
+    """Records a heartbeat for all jobs that a worker is running. Falls
+    back to renewing the leases directly if Redis is unavailable."""
+    now = time.time()
+    beats = {str(job_id): f'{worker_id}|{now}' for job_id in job_ids}
+    if not beats:
+        return
+    client = get_redis()
+    if client is not None:
+        try:
+            client.hset(HEARTBEATS_KEY, mapping=beats)
+            return
+        except redis.RedisError:
+            logger.warning('Could not record heartbeats of %s', worker_id, exc_info=True)
+    _renew_leases(beats)
+    db.session.commit()
+
+
+def flush_heartbeats() -> int:
+    """Renews the leases of all heartbeats recorded since the last flush
+    and returns the number of heartbeats. Heartbeats are only removed
+    from Redis once the renewed leases are committed."""
+    client = get_redis()
+    if client is None:
+        return 0
+    try:
+        beats = client.hgetall(HEARTBEATS_KEY)
+    except redis.RedisError:
+        logger.warning('Could not flush heartbeats', exc_info=True)
+        return 0
+    beats = {key.decode('utf-8'): value.decode('utf-8') for key, value in beats.items()}
+    renewed = _renew_leases(beats)
+    db.session.commit()
+    if beats:
+        try:
+            client.hdel(HEARTBEATS_KEY, *beats)
+        except redis.RedisError:
+            # The leases are renewed again by the next flush which is harmless.
+            logger.warning('Could not remove flushed heartbeats', exc_info=True)
+    return renewed
+
+
+def _renew_leases(beats: typing.Dict[str, str]) -> int:
+    """Bulk updates the lease expiry of jobs from `{job id: 'owner|timestamp'}`.
+    A renewed lease isn't visible through the API so this bypasses the
+    ORM on purpose and doesn't bump `Project.version`."""
+    params = []
+    for job_id, value in beats.items():
+        owner, _, timestamp = value.rpartition('|')
+        params.append({'job_id': int(job_id), 'owner': owner,
+                       'expire_time': _lease_expire_time(float(timestamp))})
+    if not params:
+        return 0
+    statement = update(Job.__table__)\
+        .where(Job.__table__.c.id == bindparam('job_id'))\
+        .where(Job.__table__.c.lease_owner == bindparam('owner'))\
+        .where(Job.__table__.c.status == 'running')\
+        .values(lease_expire_time=bindparam('expire_time'))
+    db.session.execute(statement, params)
+    return len(params)
+
+
+def release_job(job: Job, status: str) -> None:
+    """Finishes a job with the given status and gives up its lease."""
+    job.status = status
+    job.finish_time = datetime.datetime.utcnow()
+    job.lease_owner = None
+    job.lease_expire_time = None
+    db.session.commit()
+    client = get_redis()
+    if client is not None:
+        try:
+            client.hdel(HEARTBEATS_KEY, str(job.id))
+        except redis.RedisError:
+            logger.warning('Could not remove heartbeat of job %d', job.id, exc_info=True)
+
+
+def reap_expired_leases() -> typing.List[Job]:
+    """Re-queues running jobs whose lease has expired, or fails them if
+    they have used all of their attempts. Pending heartbeats are flushed
+    first so that no live job is reaped."""
+    flush_heartbeats()
+    now = datetime.datetime.utcnow()
+    jobs = Job.query.filter(Job.status == 'running', Job.lease_expire_time < now)\
+        .with_for_update(skip_locked=True).all()
+    max_attempts = current_app.config['JOB_LEASE_MAX_ATTEMPTS']
+    for job in jobs:
+        logger.warning('Lease of job %d held by %s expired', job.id, job.lease_owner)
+        job.lease_owner = None
+        job.lease_expire_time = None
+        if job.attempts >= max_attempts:
+            job.status = 'error'
+            job.finish_time = now
+        else:
+            job.status = 'queued'
+            job.start_time = None
+            job.pool = None
+            job.runner_host = None
+    db.session.commit()
+    return jobs
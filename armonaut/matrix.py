@@ -0,0 +1,164 @@
+# Copyright (C) 2017 Seth Michael Larson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Expands the build matrix of a parsed `.armonaut.yml` into jobs.
+
+The matrix is every `python` version crossed with every `env` entry (or
+`env.matrix` if `env.global` is also given) in the order they are listed,
+minus the cells matching an entry of `matrix.exclude`, followed by the
+cells in `matrix.include`. Cells matching an entry of
+`matrix.allow_failures` don't fail the build. An entry matches a cell if
+all of the keys that it gives are equal, so `{python: nightly}` matches
+every cell using nightly.
+
+Cells run in the `test` stage unless an include entry gives a `stage` and
+use the top-level `container_units` (default 1) unless an include entry
+gives its own.
+Stages run in the order of the `stages` list, stages that aren't listed
+run after the listed ones in the order they first appear.
+"""
+
+import shlex
+import typing
+from armonaut import db
+from armonaut.models import Build, Job, pack_string_dict
+
+MAX_MATRIX_JOBS = 500
+
+
+class MatrixError(ValueError):
+    pass
+
+
+def parse_env(value: typing.Union[None, str, dict]) -> typing.Dict[str, str]:
+    """Parses an env entry like `A=1 B="two words"` into a dict."""
+    if value is None:
+        return {}
+    if isinstance(value, dict):
+        return {str(k): str(v) for k, v in value.items()}
+    env = {}
+    try:
+        words = shlex.split(str(value))
+    except ValueError as e:
+        raise MatrixError(f'Invalid env entry {value!r}: {e}') from e
+    for word in words:
+        key, sep, val = word.partition('=')
+        if not sep or not key:
+            raise MatrixError(f'Invalid env entry {value!r}: {word!r} is not KEY=VALUE')
+        env[key] = val
+    return env
+
+
+def _as_list(value) -> list:
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def _cell(python, env, stage='test', container_units=1) -> typing.Dict[str, typing.Any]:
+    return {'python': None if python is None else str(python), 'env': parse_env(env), 'stage': str(stage),
+            'container_units': int(container_units)}
+
+
+def _matches(entry: dict, cell: dict) -> bool:
+    if not isinstance(entry, dict) or not entry:
+        raise MatrixError(f'Invalid matrix entry {entry!r}')
+    if 'python' in entry and str(entry['python']) != cell['python']:
+        return False
+    if 'env' in entry and parse_env(entry['env']) != cell['env']:
+        return False
+    if 'stage' in entry and str(entry['stage']) != cell['stage']:
+        return False
+    return True
+
+
+def expand_matrix(config: dict) -> typing.List[typing.Dict[str, typing.Any]]:
+    """Returns the cells of the build matrix in order. Each cell is a dict
+    with the `python` version, the `env` of the job including `env.global`,
+    its `stage` and `stage_number`, its `container_units` and whether the
+    cell is an `allow_failure`.
+    """
+    env = config.get('env')
+    global_env = {}
+    if isinstance(env, dict) and ('global' in env or 'matrix' in env):
+        for entry in _as_list(env.get('global')):
+            global_env.update(parse_env(entry))
+        env = env.get('matrix')
+
+    container_units = config.get('container_units', 1)
+    pythons = _as_list(config.get('python')) or [None]
+    envs = _as_list(env) or [None]
+    matrix = config.get('matrix') or {}
+    if not isinstance(matrix, dict):
+        raise MatrixError('matrix must be a mapping')
+    excludes = _as_list(matrix.get('exclude'))
+    allow_failures = _as_list(matrix.get('allow_failures'))
+
+    cells = [cell for cell in (_cell(python, entry, container_units=container_units)
+                               for python in pythons for entry in envs)
+             if not any(_matches(exclude, cell) for exclude in excludes)]
+    for include in _as_list(matrix.get('include')):
+        if not isinstance(include, dict):
+            raise MatrixError(f'Invalid matrix entry {include!r}')
+        cells.append(_cell(include.get('python', pythons[0]), include.get('env'), include.get('stage', 'test'),
+                           include.get('container_units', container_units)))
+
+    if len(cells) > MAX_MATRIX_JOBS:
+        raise MatrixError(f'Build matrix has {len(cells)} jobs, the limit is {MAX_MATRIX_JOBS}')
+
+    stages = []
+    for stage in _as_list(config.get('stages')) + [cell['stage'] for cell in cells]:
+        if isinstance(stage, dict):
+            if 'name' not in stage:
+                raise MatrixError(f'Invalid stage {stage!r}')
+            stage = stage['name']
+        name = str(stage)
+        if name not in stages:
+            stages.append(name)
+
+    for cell in cells:
+        cell['allow_failure'] = any(_matches(entry, cell) for entry in allow_failures)
+        cell['env'] = dict(global_env, **cell['env'])
+        cell['stage_number'] = stages.index(cell['stage'])
+    # Sorting is stable so cells keep their order within a stage.
+    cells.sort(key=lambda cell: cell['stage_number'])
+    return cells
+
+
+def create_jobs(build: Build, cells: typing.List[typing.Dict[str, typing.Any]]) -> int:
+    """Inserts a job for every cell of the matrix with a single bulk INSERT.
+
+    This skips the ORM so it has to run in the same transaction that
+    creates the build, the flush that inserted the build has already
+    bumped the project's version.
+    """
+    if not cells:
+        return 0
+    if build.id is None:
+        db.session.flush()
+    rows = [{'build_id': build.id,
+             'number': number,
+             'python': cell['python'],
+             'env': pack_string_dict(cell['env']),
+             'allow_failure': cell['allow_failure'],
+             'stage': cell['stage'],
+             'stage_number': cell['stage_number'],
+             'container_units': cell['container_units']}
+            for number, cell in enumerate(cells, 1)]
+    db.session.execute(Job.__table__.insert(), rows)
+    db.session.expire(build, ['jobs'])
+    return len(rows)
@@ -13,19 +13,87 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from armonaut import BaseModel, login
+from armonaut import BaseModel, db, login
+from armonaut.cache import SharedCache
 import base64
 import datetime
+import json
 import re
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Boolean, SmallInteger, BigInteger, func
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Text, ForeignKey, DateTime, Boolean, SmallInteger, BigInteger, Index, func
+from sqlalchemy import event, inspect, select, case, update, bindparam
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import Session, relationship, deferred, column_property, make_transient_to_detached
+from sqlalchemy.orm.attributes import get_history, set_committed_value
+from sqlalchemy.sql.expression import FunctionElement
 from flask_login import UserMixin
 import typing
 
-STATUSES = {'queued', 'starting', 'running', 'success', 'failure', 'error', 'canceled'}
+STATUSES = {'queued', 'starting', 'running', 'success', 'failure', 'error', 'canceled', 'skipped'}
+TERMINAL_STATUSES = {'success', 'failure', 'error', 'canceled', 'skipped'}
+_SNAPSHOTS_KEY = 'armonaut.build_snapshots'
+_STALE_SLUGS_KEY = 'armonaut.stale_project_slugs'
+_CACHED_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+_project_slug_cache = SharedCache('project-slug', maxsize=4096, ttl=600, local_ttl=5)
 _UNPACK_DICT_REGEX = re.compile(r'^([^\s=]+)=(.*)$')
 
 
+class epoch(FunctionElement):
+    """Whole seconds since the Unix epoch of a naive UTC timestamp."""
+    type = Integer()
+    name = 'epoch'
+    inherit_cache = True
+
+
+@compiles(epoch)
+def _compile_epoch(element, compiler, **kw):
+    return f'CAST(FLOOR(EXTRACT(EPOCH FROM {compiler.process(element.clauses, **kw)})) AS INTEGER)'
+
+
+@compiles(epoch, 'sqlite')
+def _compile_epoch_sqlite(element, compiler, **kw):
+    return f"CAST(strftime('%s', {compiler.process(element.clauses, **kw)}) AS INTEGER)"
+
+
+class seconds_between(FunctionElement):
+    """Whole seconds from the first to the second naive UTC timestamp,
+    truncated like `int(timedelta.total_seconds())` rather than truncating
+    each timestamp."""
+    type = Integer()
+    name = 'seconds_between'
+    inherit_cache = True
+
+
+@compiles(seconds_between)
+def _compile_seconds_between(element, compiler, **kw):
+    start, end = (compiler.process(clause, **kw) for clause in element.clauses)
+    return f'CAST(TRUNC(EXTRACT(EPOCH FROM ({end} - {start}))) AS INTEGER)'
+
+
+@compiles(seconds_between, 'sqlite')
+def _compile_seconds_between_sqlite(element, compiler, **kw):
+    # SQLite keeps milliseconds, the rounding undoes the float error of julianday().
+    start, end = (compiler.process(clause, **kw) for clause in element.clauses)
+    return f'CAST(ROUND((julianday({end}) - julianday({start})) * 86400000) AS INTEGER) / 1000'
+
+
+class utcnow(FunctionElement):
+    """The current naive UTC timestamp as seen by the database."""
+    type = DateTime()
+    name = 'utcnow'
+    inherit_cache = True
+
+
+@compiles(utcnow)
+def _compile_utcnow(element, compiler, **kw):
+    return "TIMEZONE('utc', CURRENT_TIMESTAMP)"
+
+
+@compiles(utcnow, 'sqlite')
+def _compile_utcnow_sqlite(element, compiler, **kw):
+    return 'CURRENT_TIMESTAMP'
+
+
 class Account(BaseModel, UserMixin):
     __tablename__ = 'accounts'
 
@@ -57,8 +125,9 @@ def get_user(id):
 class Project(BaseModel):
     __tablename__ = 'projects'
 
-    owner = Column(String, nullable=False, index=True)
-    name = Column(String, nullable=False, index=True)
+    # The previous slug is needed to invalidate the cache after a rename.
+    owner = column_property(Column(String, nullable=False, index=True), active_history=True)
+    name = column_property(Column(String, nullable=False, index=True), active_history=True)
 
     remote_host = Column(String(2), nullable=False, index=True)
     remote_id = Column(BigInteger, nullable=False)
@@ -73,7 +142,20 @@ class Project(BaseModel):
 
     account = relationship('Account', uselist=False, back_populates='projects')
     account_id = Column(Integer, ForeignKey('accounts.id'), nullable=False)
-    builds = relationship('Build', back_populates='project')
+    builds = relationship('Build', back_populates='project', foreign_keys='Build.project_id')
+
+    # Denormalized pointer to the build with the highest number, kept
+    # up to date within the same flush that creates or updates a build.
+    latest_build_id = Column(Integer, ForeignKey('builds.id', use_alter=True, ondelete='SET NULL',
+                                                 name='fk_projects_latest_build_id'), default=None)
+    latest_build_number = Column(Integer, default=None)
+    latest_build_status = Column(String(8), default=None)
+    latest_build = relationship('Build', uselist=False, foreign_keys=[latest_build_id], post_update=True)
+
+    # Bumped whenever the project or any of its builds or jobs change,
+    # used as a cheap validator for conditional API requests.
+    version = Column(Integer, nullable=False, default=0)
+    update_time = Column(DateTime, default=None)
 
     __mapper_args__ = {'polymorphic_on': remote_host}
 
@@ -81,6 +163,24 @@ class Project(BaseModel):
     def slug(self) -> str:
         return f'{self.owner}/{self.name}'
 
+    @staticmethod
+    def get_by_slug(host: str, owner: str, name: str):
+        """Resolves a project by its remote host and slug. The columns of
+        the project are cached so that the project can be built without a
+        query. The cache is invalidated whenever the project row changes.
+        """
+        key = f'{host}/{owner}/{name}'
+        columns = _project_slug_cache.get(key)
+        if columns is not None:
+            return _project_from_columns(columns)
+
+        project = Project.query.filter(Project.remote_host == host,
+                                       Project.owner == owner,
+                                       Project.name == name).first()
+        if project is not None:
+            _project_slug_cache.set(key, _project_columns(project))
+        return project
+
     @property
     def remote_url(self) -> str:
         if self.remote_host == 'gh':
@@ -91,11 +191,19 @@ class Project(BaseModel):
             host = 'bitbucket.org'
         return f'https://{host}/{self.slug}'
 
-    @property
-    def latest_build(self):
-        return Build.query.filter(Build.project_id == self.id).order_by(Build.number.desc()).first()
+    def set_latest_build(self, build) -> None:
+        """Points the denormalized latest build columns at `build` if it
+        is at least as new as the current latest build."""
+        if self.latest_build_number is not None and build.number < self.latest_build_number:
+            return
+        self.latest_build = build
+        self.latest_build_number = build.number
+        self.latest_build_status = build.status
+
+    def has_file(self, path: str, ref: str = None) -> bool:
+        raise NotImplementedError()
 
-    def has_file(self, path: str) -> bool:
+    def get_file(self, path: str, ref: str = None) -> typing.Union[None, str]:
         raise NotImplementedError()
 
     def has_webhook(self) -> bool:
@@ -110,6 +218,12 @@ class Project(BaseModel):
     def update_commit_status(self, commit, status, url):
         raise NotImplementedError()
 
+    def post_commit_status(self, commit, status, url, context) -> typing.Union[None, int]:
+        raise NotImplementedError()
+
+    def invalidate_access_token(self):
+        raise NotImplementedError()
+
     def is_owner(self, id) -> bool:
         raise NotImplementedError()
 
@@ -122,9 +236,17 @@ class Project(BaseModel):
     def sync_project(self):
         raise NotImplementedError()
 
-    def project_to_json(self):
-        latest_build = self.latest_build
-        return {
+    # Top-level fields and embedded sub-objects of `project_to_json()`
+    JSON_FIELDS = {'id', 'name', 'owner', 'slug', 'remote_host', 'remote_id', 'remote_url',
+                   'url', 'default_branch', 'private'}
+    JSON_EMBEDS = {'latest_build'}
+
+    def project_to_json(self, latest_build_duration: int = None, fields: typing.Set[str] = None,
+                        embed: typing.Set[str] = JSON_EMBEDS):
+        """Serializes the project. `fields` restricts the top-level fields
+        and `embed` chooses the sub-objects to include, anything not
+        included isn't loaded from the database either."""
+        data = {
             'id': self.id,
             'name': self.name,
             'owner': self.owner,
@@ -134,16 +256,23 @@ class Project(BaseModel):
             'remote_url': self.remote_url,
             'url': f'https://armonaut.io/{self.remote_host}/{self.owner}/{self.name}',
             'default_branch': self.default_branch,
-            'private': self.private,
-            'latest_build': {
+            'private': self.private
+        }
+        if fields is not None:
+            data = {k: v for k, v in data.items() if k in fields}
+        if 'latest_build' in embed:
+            latest_build = self.latest_build
+            if latest_build is not None and latest_build_duration is None:
+                _, latest_build_duration = Build.aggregate_jobs([latest_build.id])[latest_build.id]
+            data['latest_build'] = {
                 'id': latest_build.id,
                 'number': latest_build.number,
                 'status': latest_build.status,
-                'duration': latest_build.duration,
+                'duration': latest_build_duration,
                 'start_time': strftime(latest_build.start_time),
                 'finish_time': strftime(latest_build.finish_time)
             } if latest_build is not None else None
-        }
+        return data
 
 
 class Build(BaseModel):
@@ -178,15 +307,29 @@ class Build(BaseModel):
     deploy = Column(String, default=None)
     services = Column(String, default=None)
 
-    project = relationship('Project', back_populates='builds')
+    project = relationship('Project', back_populates='builds', foreign_keys='Build.project_id')
     project_id = Column(Integer, ForeignKey('projects.id'), nullable=False)
     jobs = relationship('Job', back_populates='build')
 
+    # Pre-serialized JSON of a finished build and its jobs without the
+    # embedded project. Cleared whenever the build or one of its jobs changes.
+    snapshot = deferred(Column(Text, default=None))
+
+    @hybrid_property
+    def jobs_status(self) -> str:
+        """The status of the Build as determined by its jobs. On the class
+        this is a correlated SQL aggregate over `jobs` instead."""
+        return self.determine_status()
+
+    @jobs_status.expression
+    def jobs_status(cls):
+        return select(_jobs_status_expression()).where(Job.build_id == cls.id).scalar_subquery()
+
     def determine_status(self) -> str:
         """Returns the status of the Build which is determined by it's jobs statuses."""
         statuses = {}
         for job in self.jobs:
-            if job.status == 'failure' or job.status == 'error':
+            if (job.status == 'failure' or job.status == 'error') and not job.allow_failure:
                 return 'failure'
             statuses.setdefault(job.status, 0)
             statuses[job.status] += 1
@@ -194,20 +337,70 @@ class Build(BaseModel):
             return 'running'
         elif statuses.get('queued', 0):
             return 'queued'
+        elif statuses.get('canceled', 0):
+            return 'canceled'
         return 'success'
 
-    @property
+    def stage_metrics(self) -> typing.Dict[str, int]:
+        """Returns how many jobs and container units weren't run because
+        a job in an earlier stage failed."""
+        skipped = [job for job in self.jobs if job.status == 'skipped']
+        return {'skipped_jobs': len(skipped),
+                'skipped_container_units': sum(job.container_units for job in skipped)}
+
+    @hybrid_property
     def duration(self) -> int:
         """Returns the sum of all jobs that have started executing."""
         return sum([j.duration for j in self.jobs if j.start_time is not None])
 
-    def build_to_json(self, project: Project = None):
-        if project is None:
-            project = self.project
-        return {
+    @duration.expression
+    def duration(cls):
+        return select(_jobs_duration_expression()).where(Job.build_id == cls.id).scalar_subquery()
+
+    @staticmethod
+    def history(project_id: int, branch: str = None, status: str = None, pull_request: int = None):
+        """Returns a query of the builds of a project, optionally filtered
+        by branch, status and pull request number."""
+        query = Build.query.filter(Build.project_id == project_id)
+        if branch is not None:
+            query = query.filter(Build.commit_branch == branch)
+        if status is not None:
+            query = query.filter(Build.status == status)
+        if pull_request is not None:
+            query = query.filter(Build.pull_request_number == pull_request)
+        return query
+
+    @staticmethod
+    def aggregate_jobs(build_ids: typing.Iterable[int]) -> typing.Dict[int, typing.Tuple[str, int]]:
+        """Computes the jobs status and duration of many builds with a single
+        grouped query over `jobs` without loading any `Job` rows. Builds without
+        any jobs are reported as `('success', 0)` like `determine_status()` does.
+        """
+        build_ids = set(build_ids)
+        if not build_ids:
+            return {}
+        aggregates = {build_id: ('success', 0) for build_id in build_ids}
+        query = db.session.query(Job.build_id, _jobs_status_expression(), _jobs_duration_expression())\
+            .filter(Job.build_id.in_(build_ids))\
+            .group_by(Job.build_id)
+        for build_id, status, duration in query:
+            aggregates[build_id] = (status, duration)
+        return aggregates
+
+    # Top-level fields and embedded sub-objects of `build_to_json()`
+    JSON_FIELDS = {'id', 'number', 'duration', 'start_time', 'finish_time', 'status', 'commit', 'pull_request',
+                   'metrics'}
+    JSON_EMBEDS = {'project', 'jobs'}
+
+    def build_to_json(self, project: Project = None, project_json: dict = None, fields: typing.Set[str] = None,
+                      embed: typing.Set[str] = JSON_EMBEDS, duration: int = None):
+        """Serializes the build. `fields` restricts the top-level fields and
+        `embed` chooses the sub-objects to include. Pass `duration` from
+        `Build.aggregate_jobs()` if the jobs aren't embedded to avoid loading them.
+        """
+        data = {
             'id': self.id,
             'number': self.number,
-            'duration': self.duration,
             'start_time': strftime(self.start_time),
             'finish_time': strftime(self.finish_time),
             'status': self.status,
@@ -223,10 +416,171 @@ class Build(BaseModel):
                 'slug': self.pull_request_slug,
                 'branch': self.pull_request_branch,
                 'url': self.pull_request_url
-            } if self.pull_request_number is not None else None,
-            'models': project.project_to_json(),
-            'jobs': [job.job_to_json() for job in self.jobs]
+            } if self.pull_request_number is not None else None
         }
+        if fields is not None:
+            data = {k: v for k, v in data.items() if k in fields}
+        if fields is None or 'duration' in fields:
+            data['duration'] = self.duration if duration is None else duration
+        if 'project' in embed:
+            if project_json is None:
+                if project is None:
+                    project = self.project
+                project_json = project.project_to_json()
+            data['models'] = project_json
+        if 'jobs' in embed:
+            data['jobs'] = [job.job_to_json() for job in self.jobs]
+            # Metrics are computed from the jobs so only when they're embedded.
+            if fields is None or 'metrics' in fields:
+                data['metrics'] = self.stage_metrics()
+        return data
+
+    def build_to_json_text(self, project_json_text: str) -> str:
+        """Returns the same document as `build_to_json()` already serialized
+        to JSON, with the serialized project spliced in."""
+        return f'{self.snapshot_text()[:-1]},"models":{project_json_text}}}'
+
+    @property
+    def stored_snapshot(self) -> typing.Union[None, str]:
+        """The stored snapshot, only ever used while the build is finished."""
+        return self.snapshot if self.status in TERMINAL_STATUSES else None
+
+    def snapshot_text(self, store: bool = True) -> str:
+        """Returns the serialized JSON of the build and its jobs without the
+        embedded project. Builds that have reached a terminal status keep it in
+        `snapshot` (unless `store` is False) so that later reads don't need to
+        load or serialize the build's jobs at all. New snapshots are written
+        by `write_snapshots()`, not by flushing the build.
+        """
+        snapshot = self.stored_snapshot
+        if snapshot is None:
+            data = self.build_to_json(embed={'jobs'})
+            snapshot = json.dumps(data, separators=(',', ':'))
+            if store and self.status in TERMINAL_STATUSES:
+                set_committed_value(self, 'snapshot', snapshot)
+                pending = db.session.info.setdefault(_SNAPSHOTS_KEY, {})
+                pending[self.id] = {'build_id': self.id, 'build_status': self.status,
+                                    'build_finish_time': self.finish_time, 'build_snapshot': snapshot}
+        return snapshot
+
+
+Index('ix_projects_remote_host_owner_name', Project.remote_host, Project.owner, Project.name, unique=True)
+# Conflict target of the bulk upserts in `armonaut.imports`.
+Index('ix_projects_remote_host_remote_id', Project.remote_host, Project.remote_id, unique=True)
+
+# Composite indexes backing the keyset pagination of build history,
+# see `armonaut.api.pagination`.
+Index('ix_builds_project_id_start_time', Build.project_id, Build.start_time.desc(), Build.id.desc())
+Index('ix_builds_project_id_commit_branch_start_time', Build.project_id, Build.commit_branch,
+      Build.start_time.desc(), Build.id.desc())
+
+
+def write_snapshots() -> int:
+    """Writes the snapshots created by `Build.snapshot_text()` and returns
+    how many were written. Each is written with a conditional UPDATE that
+    only applies if the build is still finished the way it was serialized
+    and has no snapshot, so a build that changed meanwhile keeps none.
+    """
+    pending = db.session.info.pop(_SNAPSHOTS_KEY, None)
+    if not pending:
+        return 0
+    table = Build.__table__
+    statement = update(table)\
+        .where(table.c.id == bindparam('build_id'),
+               table.c.status.in_(TERMINAL_STATUSES),
+               table.c.status == bindparam('build_status'),
+               table.c.finish_time.is_not_distinct_from(bindparam('build_finish_time')),
+               table.c.snapshot.is_(None))\
+        .values(snapshot=bindparam('build_snapshot'))
+    result = db.session.execute(statement, list(pending.values()))
+    db.session.commit()
+    return result.rowcount
+
+
+def builds_to_json(builds: typing.List[Build], project: Project) -> typing.List[dict]:
+    """Serializes a page of builds belonging to a single project in one pass.
+    The project (and with it the latest build lookup) is only serialized once
+    and shared between all builds. Load the builds with `selectinload(Build.jobs)`
+    so that their jobs are fetched in a single query rather than one per build.
+    """
+    if not builds:
+        return []
+    project_json = project.project_to_json()
+    return [build.build_to_json(project, project_json) for build in builds]
+
+
+def builds_to_json_text(builds: typing.List[Build], project: Project, project_json: dict = None) -> str:
+    """Serializes a page of builds belonging to a single project into a JSON
+    array. Builds with a snapshot are spliced in as-is and the jobs of all other
+    builds are loaded with a single query. Load the builds with
+    `undefer(Build.snapshot)` and without eagerly loading their jobs.
+    """
+    if not builds:
+        return '[]'
+    load_jobs([build for build in builds if build.stored_snapshot is None])
+    if project_json is None:
+        project_json = project.project_to_json()
+    project_json_text = json.dumps(project_json, separators=(',', ':'))
+    return f'[{",".join(build.build_to_json_text(project_json_text) for build in builds)}]'
+
+
+def builds_to_sparse_json(builds: typing.List[Build], project: Project, fields: typing.Set[str] = None,
+                          embed: typing.Set[str] = Build.JSON_EMBEDS) -> typing.List[dict]:
+    """Serializes a page of builds like `builds_to_json()` with only the given
+    fields and embedded sub-objects, loading only the data that they need.
+    """
+    if not builds:
+        return []
+    durations = {}
+    if 'jobs' in embed:
+        load_jobs(builds)
+    elif fields is None or 'duration' in fields:
+        durations = Build.aggregate_jobs([build.id for build in builds])
+    project_json = project.project_to_json() if 'project' in embed else None
+    return [build.build_to_json(project, project_json, fields=fields, embed=embed,
+                                duration=durations.get(build.id, (None, None))[1])
+            for build in builds]
+
+
+def projects_to_json(projects: typing.List[Project]) -> typing.List[dict]:
+    """Serializes many projects at once, loading all of their latest
+    builds and the aggregates of their jobs with one query each.
+    """
+    latest_build_ids = [project.latest_build_id for project in projects if project.latest_build_id is not None]
+    if latest_build_ids:
+        # Loading the builds puts them in the identity map so that
+        # `Project.latest_build` doesn't need to emit a query.
+        Build.query.filter(Build.id.in_(latest_build_ids)).all()
+    aggregates = Build.aggregate_jobs(latest_build_ids)
+    return [project.project_to_json(aggregates.get(project.latest_build_id, (None, None))[1])
+            for project in projects]
+
+
+def load_jobs(builds: typing.List[Build]) -> None:
+    """Populates the `jobs` of many builds with a single query. Builds
+    that already have their jobs loaded are skipped."""
+    builds = [build for build in builds if 'jobs' in inspect(build).unloaded]
+    if not builds:
+        return
+    jobs = {build.id: [] for build in builds}
+    for job in Job.query.filter(Job.build_id.in_(jobs.keys())).order_by(Job.id):
+        jobs[job.build_id].append(job)
+    for build in builds:
+        set_committed_value(build, 'jobs', jobs[build.id])
+
+
+class Pool(BaseModel):
+    """A pool of identical runner hosts that each have `host_units`
+    container units. Community pools run jobs of public projects."""
+    __tablename__ = 'pools'
+
+    name = Column(String, nullable=False, unique=True)
+    community = Column(Boolean, nullable=False, default=False)
+    host_count = Column(Integer, nullable=False, default=0)
+    host_units = Column(Integer, nullable=False, default=8)
+
+    def host_names(self) -> typing.List[str]:
+        return [f'{self.name}-{i}' for i in range(self.host_count)]
 
 
 class Job(BaseModel):
@@ -236,16 +590,35 @@ class Job(BaseModel):
     finish_time = Column(DateTime, default=None)
     number = Column(SmallInteger, nullable=False)
     env = Column(String, default=None)
+    python = Column(String(16), default=None)
+    allow_failure = Column(Boolean, nullable=False, default=False)
+
+    # Jobs only start once every job in an earlier stage has succeeded
+    # and are skipped if one of them fails.
+    stage = Column(String, nullable=False, default='test')
+    stage_number = Column(SmallInteger, nullable=False, default=0)
 
     # DigitalOcean Droplet for debugging purposes
     droplet_id = Column(String, default=None)
 
-    # queued, starting, running, success, failure, error, canceled
+    # queued, starting, running, success, failure, error, canceled, skipped
     status = Column(String(8), default='queued', nullable=False, index=True)
 
     build = relationship('Build', back_populates='jobs')
     build_id = Column(Integer, ForeignKey('builds.id'), nullable=False)
 
+    # Size of the job's container and where the allocator placed it.
+    container_units = Column(SmallInteger, nullable=False, default=1)
+    pool = relationship('Pool', uselist=False)
+    pool_id = Column(Integer, ForeignKey('pools.id'), default=None)
+    runner_host = Column(String, default=None)
+
+    # The worker that owns the job until `lease_expire_time`, renewed by
+    # heartbeats. Jobs with expired leases are re-queued (see `armonaut.leases`).
+    lease_owner = Column(String, default=None)
+    lease_expire_time = Column(DateTime, default=None, index=True)
+    attempts = Column(SmallInteger, nullable=False, default=0)
+
     @property
     def spaces_log_url(self) -> str:
         """Returns the URL that the logs will be stored at for this job.
@@ -276,8 +649,8 @@ class Job(BaseModel):
     def queue_time(self) -> int:
         """Returns the number of seconds that this job has been in the queue."""
         start_time = self.start_time
-        if self.start_time is None:
-            self.start_time = datetime.datetime.utcnow()
+        if start_time is None:
+            start_time = datetime.datetime.utcnow()
         return int((start_time - self.create_time).total_seconds())
 
     def resolve_env(self) -> typing.Dict[str, str]:
@@ -303,6 +676,8 @@ class Job(BaseModel):
             'start_time': strftime(self.start_time),
             'finish_time': strftime(self.finish_time),
             'duration': self.duration,
+            'stage': self.stage,
+            'allow_failure': self.allow_failure,
             'container_units': self.container_units,
             'pool': {
                 'id': self.pool.id,
@@ -311,6 +686,238 @@ class Job(BaseModel):
         }
 
 
+def _jobs_status_expression():
+    """SQL aggregate over `jobs` equivalent to `Build.determine_status()`."""
+    def count(*statuses):
+        return func.count(case((Job.status.in_(statuses), 1)))
+    failures = func.count(case((Job.status.in_(('failure', 'error')) & Job.allow_failure.is_(False), 1)))
+    return func.coalesce(case((failures > 0, 'failure'),
+                              (count('running', 'starting') > 0, 'running'),
+                              (count('queued') > 0, 'queued'),
+                              (count('canceled') > 0, 'canceled'),
+                              else_='success'), 'success')
+
+
+def _jobs_duration_expression():
+    """SQL aggregate over `jobs` equivalent to `Build.duration`."""
+    job_duration = seconds_between(Job.start_time, func.coalesce(Job.finish_time, utcnow()))
+    return func.coalesce(func.sum(case((Job.start_time.isnot(None), job_duration), else_=0)), 0)
+
+
+@event.listens_for(Session, 'before_flush')
+def _skip_downstream_jobs(session, flush_context, instances) -> None:
+    """Skips the queued jobs of later stages when a job fails. Registered
+    first so that the other listeners see the skipped jobs."""
+    with session.no_autoflush:
+        for obj in list(session.dirty):
+            if not isinstance(obj, Job) or obj.allow_failure or obj.status not in ('failure', 'error'):
+                continue
+            if not get_history(obj, 'status').has_changes() or obj.build is None:
+                continue
+            now = datetime.datetime.utcnow()
+            for job in obj.build.jobs:
+                if job.stage_number > obj.stage_number and job.status == 'queued':
+                    job.status = 'skipped'
+                    job.finish_time = now
+
+
+@event.listens_for(Session, 'before_flush')
+def _roll_up_build_statuses(session, flush_context, instances) -> None:
+    """Updates the status of builds from `determine_status()` when the status
+    of one of their jobs changes. Builds finish when their last job does and
+    are unfinished again once a job is restarted."""
+    builds = set()
+    with session.no_autoflush:
+        for obj in list(session.new) + list(session.dirty):
+            if not isinstance(obj, Job) or not get_history(obj, 'status').has_changes():
+                continue
+            build = obj.build
+            if build is None and obj.build_id is not None:
+                build = session.query(Build).get(obj.build_id)
+            if build is not None and build not in session.new and build not in session.deleted:
+                builds.add(build)
+        for build in builds:
+            status = build.determine_status()
+            if build.status != status:
+                build.status = status
+            if status not in TERMINAL_STATUSES:
+                build.finish_time = None
+            elif build.finish_time is None:
+                finish_times = [job.finish_time for job in build.jobs if job.finish_time is not None]
+                build.finish_time = max(finish_times) if finish_times else datetime.datetime.utcnow()
+
+
+@event.listens_for(Session, 'before_flush')
+def _update_latest_builds(session, flush_context, instances) -> None:
+    """Keeps `Project.latest_build` and its cached number and status in
+    sync with new builds, build status changes (including those rolled up
+    from jobs) and deleted builds within the same flush.
+    """
+    with session.no_autoflush:
+        for obj in list(session.new) + list(session.dirty):
+            if not isinstance(obj, Build):
+                continue
+            project = _project_of(session, obj)
+            if project is None:
+                continue
+            if obj in session.new:
+                if obj.status is None:
+                    obj.status = 'queued'
+                project.set_latest_build(obj)
+            elif get_history(obj, 'number').has_changes():
+                project.set_latest_build(obj)
+            elif project.latest_build is obj and get_history(obj, 'status').has_changes():
+                project.latest_build_status = obj.status
+        for obj in session.deleted:
+            if not isinstance(obj, Build):
+                continue
+            project = _project_of(session, obj)
+            if project is None or project in session.deleted or project.latest_build_id != obj.id:
+                continue
+            deleted_ids = [other.id for other in session.deleted if isinstance(other, Build)]
+            previous = session.query(Build).filter(Build.project_id == project.id, Build.id.notin_(deleted_ids))\
+                .order_by(Build.number.desc()).first()
+            project.latest_build = previous
+            project.latest_build_number = None if previous is None else previous.number
+            project.latest_build_status = None if previous is None else previous.status
+
+
+@event.listens_for(Session, 'before_flush')
+def _bump_project_versions(session, flush_context, instances) -> None:
+    """Bumps `Project.version` once per flush for every project that
+    was modified or had one of its builds or jobs added, modified or deleted.
+    """
+    projects = set()
+    with session.no_autoflush:
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            if not isinstance(obj, (Project, Build, Job)):
+                continue
+            if obj in session.dirty and not _has_changes(obj, ignore=('snapshot',)):
+                continue
+            project = _project_of(session, obj)
+            if project is not None and project not in session.deleted:
+                projects.add(project)
+    for project in projects:
+        project.version = (project.version or 0) + 1
+        project.update_time = datetime.datetime.utcnow()
+
+
+@event.listens_for(Session, 'before_flush')
+def _invalidate_build_snapshots(session, flush_context, instances) -> None:
+    """Clears `Build.snapshot` whenever a build or one of its jobs changes."""
+    with session.no_autoflush:
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(obj, Job):
+                build = obj.build
+                if build is None and obj.build_id is not None:
+                    build = session.query(Build).get(obj.build_id)
+            elif isinstance(obj, Build) and _has_changes(obj, ignore=('snapshot',)):
+                build = obj
+            else:
+                continue
+            if build is None or build in session.new or build in session.deleted:
+                continue
+            previous_statuses = get_history(build, 'status').deleted or ()
+            if build.status in TERMINAL_STATUSES or TERMINAL_STATUSES.intersection(previous_statuses):
+                build.snapshot = None
+
+
+@event.listens_for(Session, 'after_flush')
+def _invalidate_project_slugs(session, flush_context) -> None:
+    """Drops the cached columns of projects that were changed or deleted,
+    under the slug they were cached with. They're dropped again after the
+    commit in case another process cached the old row in the meantime."""
+    slugs = session.info.setdefault(_STALE_SLUGS_KEY, set())
+    for obj in list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, Project) or (obj in session.dirty and not _has_changes(obj)):
+            continue
+        old_slug = []
+        for attr in ('remote_host', 'owner', 'name'):
+            history = get_history(obj, attr)
+            old_slug.append(history.deleted[0] if history.deleted else getattr(obj, attr))
+        old_slug = '/'.join(old_slug)
+        _project_slug_cache.delete(old_slug)
+        slugs.add(old_slug)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed_project_slugs(session) -> None:
+    for slug in session.info.pop(_STALE_SLUGS_KEY, ()):
+        _project_slug_cache.delete(slug)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_stale_project_slugs(session, previous_transaction) -> None:
+    if not previous_transaction.nested:
+        session.info.pop(_STALE_SLUGS_KEY, None)
+
+
+def _project_columns(project: Project) -> dict:
+    """Returns the column values of a project in a JSON serializable form."""
+    columns = {}
+    for attr in inspect(Project).column_attrs:
+        value = getattr(project, attr.key)
+        if isinstance(value, datetime.datetime):
+            value = value.strftime(_CACHED_TIME_FORMAT)
+        columns[attr.key] = value
+    return columns
+
+
+def _project_from_columns(columns: dict) -> Project:
+    """Returns the project with the cached `columns`, either the one
+    already in the session or a new persistent instance of them."""
+    mapper = inspect(Project).polymorphic_map[columns['remote_host']]
+    project = db.session.identity_map.get(mapper.identity_key_from_primary_key([columns['id']]))
+    if project is not None:
+        return project
+    project = mapper.class_manager.new_instance()
+    for attr in inspect(Project).column_attrs:
+        value = columns[attr.key]
+        if value is not None and isinstance(attr.columns[0].type, DateTime):
+            value = datetime.datetime.strptime(value, _CACHED_TIME_FORMAT)
+        set_committed_value(project, attr.key, value)
+    make_transient_to_detached(project)
+    db.session.add(project)
+    return project
+
+
+def _has_changes(obj, ignore=()) -> bool:
+    """Returns True if any attribute of `obj` other than those
+    in `ignore` has a pending change."""
+    for attr in inspect(obj).attrs:
+        if attr.key not in ignore and attr.history.has_changes():
+            return True
+    return False
+
+
+def _project_of(session, obj) -> typing.Union[Project, None]:
+    """Returns the `Project` that a project, build or job belongs to."""
+    if isinstance(obj, Job):
+        build = obj.build
+        if build is None and obj.build_id is not None:
+            build = session.query(Build).get(obj.build_id)
+        obj = build
+    if isinstance(obj, Build):
+        project = obj.project
+        if project is None and obj.project_id is not None:
+            project = session.query(Project).get(obj.project_id)
+        obj = project
+    return obj
+
+
+def pack_string_list(values: typing.List[str]) -> typing.Union[str, None]:
+    """Packs a list of strings into a NUL-separated list
+    and then base64-encodes it, see `unpack_string_list()`.
+    """
+    if not values:
+        return None
+    return base64.b64encode(b'\x00'.join(x.encode('utf-8') for x in values)).decode('ascii')
+
+
+def pack_string_dict(dct: typing.Dict[str, str]) -> typing.Union[str, None]:
+    return pack_string_list([f'{k}={v}' for k, v in dct.items()])
+
+
 def unpack_string_list(value: str) -> typing.List[str]:
     """Unpacks a list of strings that has been packed as
     a NUL-separated list and then base64-encoded
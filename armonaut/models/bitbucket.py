@@ -1,13 +1,37 @@
+import typing
 import requests
 from armonaut import __version__, db
 from armonaut.models import Project
+from armonaut.providers import bitbucket
+
+# Bitbucket build status states and descriptions of build statuses
+COMMIT_STATES = {'queued': ('INPROGRESS', 'The Armonaut build is queued'),
+                 'starting': ('INPROGRESS', 'The Armonaut build is queued'),
+                 'running': ('INPROGRESS', 'The Armonaut build is running'),
+                 'success': ('SUCCESSFUL', 'The Armonaut build passed'),
+                 'failure': ('FAILED', 'The Armonaut build failed'),
+                 'error': ('FAILED', 'The Armonaut build encountered an error'),
+                 'canceled': ('STOPPED', 'The Armonaut build was canceled'),
+                 'skipped': ('STOPPED', 'The Armonaut build was skipped')}
 
 
 class BitbucketProject(Project):
     __mapper_args__ = {'polymorphic_identity': 'bb'}
 
-    def has_file(self, path: str) -> bool:
-        raise NotImplementedError()
+    def has_file(self, path: str, ref: str = None) -> bool:
+        return self.get_file(path, ref) is not None
+
+    def get_file(self, path: str, ref: str = None) -> typing.Union[None, str]:
+        """Returns the contents of a file at `ref` (the default branch if
+        None) or None if it doesn't exist. Other errors are raised."""
+        with bitbucket.get(f'/repositories/{self.owner}/{self.name}/src/{ref or self.default_branch}/{path}',
+                           self.account.bitbucket_access_token, cache=ref is None) as r:
+            if r.status_code == 404:
+                return None
+            if r.status_code == 401:
+                self.invalidate_access_token()
+            r.raise_for_status()
+            return r.text
 
     def has_webhook(self) -> bool:
         raise NotImplementedError()
@@ -18,8 +42,30 @@ class BitbucketProject(Project):
     def delete_webhook(self):
         raise NotImplementedError()
 
-    def update_commit_status(self, commit, status, url):
-        raise NotImplementedError()
+    def update_commit_status(self, commit, status, url, context='continuous-integration/armonaut'):
+        if self.post_commit_status(commit, status, url, context) == 401:
+            self.invalidate_access_token()
+
+    def post_commit_status(self, commit, status, url, context) -> typing.Union[None, int]:
+        """Sends a commit status and returns the response's status code.
+        Doesn't touch the database so that it can be called from other threads."""
+        if status not in COMMIT_STATES:
+            return None
+        state, description = COMMIT_STATES[status]
+        # The context is the key that later statuses of the commit replace.
+        with bitbucket.post(f'/repositories/{self.owner}/{self.name}/commit/{commit}/statuses/build',
+                            self.account.bitbucket_access_token,
+                            json={'state': state,
+                                  'key': context,
+                                  'name': 'Armonaut',
+                                  'url': url,
+                                  'description': description}) as r:
+            return r.status_code
+
+    def invalidate_access_token(self):
+        db.session.add(self.account)
+        self.account.bitbucket_access_token = None
+        db.session.commit()
 
     def is_owner(self, id) -> bool:
         raise NotImplementedError()
@@ -1,19 +1,34 @@
-import requests
+import typing
 import uuid
 from flask import url_for
-from armonaut import __version__, db
+from armonaut import db
 from armonaut.models import Project
+from armonaut.providers import github
 
 
 class GithubProject(Project):
     __mapper_args__ = {'polymorphic_identity': 'gh'}
 
+    def has_file(self, path: str, ref: str = None) -> bool:
+        return self.get_file(path, ref) is not None
+
+    def get_file(self, path: str, ref: str = None) -> typing.Union[None, str]:
+        """Returns the contents of a file at `ref` (the default branch if
+        None) or None if it doesn't exist. Other errors are raised."""
+        with github.get(f'/repos/{self.owner}/{self.name}/contents/{path}', self.account.github_access_token,
+                        cache=ref is None, params=None if ref is None else {'ref': ref},
+                        headers={'Accept': 'application/vnd.github.v3.raw'}) as r:
+            if r.status_code == 404:
+                return None
+            if r.status_code == 401:
+                self.invalidate_access_token()
+            r.raise_for_status()
+            return r.text
+
     def has_webhook(self) -> bool:
         if self.webhook_id is not None:
-            with requests.head(f'https://api.github.com/repos/{self.owner}/{self.name}/hooks/{self.webhook_id}',
-                               headers={'Authorization': f'token {self.account.github_access_token}',
-                                        'User-Agent': f'Armonaut/{__version__}',
-                                        'Accept': 'application/vnd.github.v3+json'}) as r:
+            with github.get(f'/repos/{self.owner}/{self.name}/hooks/{self.webhook_id}',
+                            self.account.github_access_token) as r:
                 if r.status_code == 401:
                     db.session.add(self.account)
                     self.account.github_access_token = None
@@ -25,17 +40,14 @@ class GithubProject(Project):
             self.delete_webhook()
         db.session.add(self)
         self.webhook_secret = uuid.uuid4().hex
-        with requests.post(f'https://api.github.com/repos/{self.owner}/{self.name}/hooks',
-                           headers={'Authorization': f'token {self.account.github_access_token}',
-                                    'User-Agent': f'Armonaut/{__version__}',
-                                    'Accept': 'application/vnd.github.v3+json'},
-                           json={'name': 'web',
-                                 'active': True,
-                                 'events': ['push', 'pull_request', 'project'],
-                                 'config': {'url': url_for('webhooks.github_webhooks'),
-                                            'insecure_ssl': True,
-                                            'secret': self.webhook_secret,
-                                            'content_type': 'json'}}) as r:
+        with github.post(f'/repos/{self.owner}/{self.name}/hooks', self.account.github_access_token,
+                         json={'name': 'web',
+                               'active': True,
+                               'events': ['push', 'pull_request', 'project'],
+                               'config': {'url': url_for('webhooks.github_webhooks'),
+                                          'insecure_ssl': True,
+                                          'secret': self.webhook_secret,
+                                          'content_type': 'json'}}) as r:
             if r.status_code == 401:
                 db.session.add(self.account)
                 self.account.github_access_token = None
@@ -50,10 +62,8 @@ class GithubProject(Project):
 
     def delete_webhook(self):
         if self.webhook_id is not None:
-            with requests.delete(f'https://api.github.com/repos/{self.owner}/{self.name}/hooks/{self.webhook_id}',
-                                 headers={'Authorization': f'token  {self.account.github_access_token}',
-                                          'User-Agent': f'Armonaut/{__version__}',
-                                          'Accept': 'application/vnd.github.v3+json'}) as r:
+            with github.delete(f'/repos/{self.owner}/{self.name}/hooks/{self.webhook_id}',
+                               self.account.github_access_token) as r:
                 if r.status_code == 401:
                     db.session.add(self.account)
                     self.account.github_access_token = None
@@ -65,40 +75,52 @@ class GithubProject(Project):
                     self.webhook_secret = None
                     db.session.commit()
 
-    def update_commit_status(self, commit, status, url):
+    def update_commit_status(self, commit, status, url, context='continuous-integration/armonaut'):
+        if self.post_commit_status(commit, status, url, context) == 401:
+            self.invalidate_access_token()
+
+    def post_commit_status(self, commit, status, url, context) -> typing.Union[None, int]:
+        """Sends a commit status and returns the response's status code.
+        Doesn't touch the database so that it can be called from other threads."""
         commit_status = None
         description = None
-        if status == 'running':
+        if status in ('queued', 'starting'):
+            commit_status = 'pending'
+            description = 'The Armonaut build is queued'
+        elif status == 'running':
             commit_status = 'pending'
             description = 'The Armonaut build is running'
         elif status == 'success':
             commit_status = 'success'
             description = 'The Armonaut build passed'
-        elif status == 'failure' or status == 'canceled':
+        elif status == 'failure':
             commit_status = 'failure'
             description = 'The Armonaut build failed'
         elif status == 'error':
             commit_status = 'error'
             description = 'The Armonaut build encountered an error'
-        if commit_status is not None:
-            with requests.post(f'https://api.github.com/repos/{self.owner}/{self.name}/statuses/{commit}',
-                               headers={'Authorization': f'token  {self.account.github_access_token}',
-                                        'User-Agent': f'Armonaut/{__version__}',
-                                        'Accept': 'application/vnd.github.v3+json'},
-                               json={'state': commit_status,
-                                     'target_url': url,
-                                     'description': description,
-                                     'context': 'continuous-integration/armonaut'}) as r:
-                if r.status_code == 401:
-                    db.session.add(self.account)
-                    self.account.github_access_token = None
-                    db.session.commit()
+        elif status == 'canceled':
+            commit_status = 'error'
+            description = 'The Armonaut build was canceled'
+        elif status == 'skipped':
+            commit_status = 'error'
+            description = 'The Armonaut build was skipped'
+        if commit_status is None:
+            return None
+        with github.post(f'/repos/{self.owner}/{self.name}/statuses/{commit}', self.account.github_access_token,
+                         json={'state': commit_status,
+                               'target_url': url,
+                               'description': description,
+                               'context': context}) as r:
+            return r.status_code
+
+    def invalidate_access_token(self):
+        db.session.add(self.account)
+        self.account.github_access_token = None
+        db.session.commit()
 
     def sync_project(self):
-        with requests.get(f'https://api.github.com/repos/{self.owner}/{self.name}',
-                          headers={'Authorization': f'token  {self.account.github_access_token}',
-                                   'User-Agent': f'Armonaut/{__version__}',
-                                   'Accept': 'application/vnd.github.v3+json'}) as r:
+        with github.get(f'/repos/{self.owner}/{self.name}', self.account.github_access_token, urgent=False) as r:
             if r.status_code == 401:
                 db.session.add(self.account)
                 self.account.github_access_token = None
@@ -1,13 +1,39 @@
+import typing
+from urllib.parse import quote
 import requests
 from armonaut import __version__, db
 from armonaut.models import Project
+from armonaut.providers import gitlab
+
+# GitLab commit status states and descriptions of build statuses
+COMMIT_STATES = {'queued': ('pending', 'The Armonaut build is queued'),
+                 'starting': ('pending', 'The Armonaut build is queued'),
+                 'running': ('running', 'The Armonaut build is running'),
+                 'success': ('success', 'The Armonaut build passed'),
+                 'failure': ('failed', 'The Armonaut build failed'),
+                 'error': ('failed', 'The Armonaut build encountered an error'),
+                 'canceled': ('canceled', 'The Armonaut build was canceled'),
+                 'skipped': ('canceled', 'The Armonaut build was skipped')}
 
 
 class GitlabProject(Project):
     __mapper_args__ = {'polymorphic_identity': 'gl'}
 
-    def has_file(self, path: str) -> bool:
-        raise NotImplementedError()
+    def has_file(self, path: str, ref: str = None) -> bool:
+        return self.get_file(path, ref) is not None
+
+    def get_file(self, path: str, ref: str = None) -> typing.Union[None, str]:
+        """Returns the contents of a file at `ref` (the default branch if
+        None) or None if it doesn't exist. Other errors are raised."""
+        with gitlab.get(f'/projects/{self.remote_id}/repository/files/{quote(path, safe="")}/raw',
+                        self.account.gitlab_access_token, cache=ref is None,
+                        params={'ref': ref or self.default_branch}) as r:
+            if r.status_code == 404:
+                return None
+            if r.status_code == 401:
+                self.invalidate_access_token()
+            r.raise_for_status()
+            return r.text
 
     def has_webhook(self) -> bool:
         raise NotImplementedError()
@@ -18,8 +44,27 @@ class GitlabProject(Project):
     def delete_webhook(self):
         raise NotImplementedError()
 
-    def update_commit_status(self, commit, status, url):
-        raise NotImplementedError()
+    def update_commit_status(self, commit, status, url, context='continuous-integration/armonaut'):
+        if self.post_commit_status(commit, status, url, context) == 401:
+            self.invalidate_access_token()
+
+    def post_commit_status(self, commit, status, url, context) -> typing.Union[None, int]:
+        """Sends a commit status and returns the response's status code.
+        Doesn't touch the database so that it can be called from other threads."""
+        if status not in COMMIT_STATES:
+            return None
+        state, description = COMMIT_STATES[status]
+        with gitlab.post(f'/projects/{self.remote_id}/statuses/{commit}', self.account.gitlab_access_token,
+                         json={'state': state,
+                               'target_url': url,
+                               'description': description,
+                               'name': context}) as r:
+            return r.status_code
+
+    def invalidate_access_token(self):
+        db.session.add(self.account)
+        self.account.gitlab_access_token = None
+        db.session.commit()
 
     def is_owner(self, id) -> bool:
         raise NotImplementedError()
@@ -14,11 +14,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from urllib.parse import urlparse, urljoin, urlencode
-import requests
 from flask import Blueprint, url_for, redirect, current_app, request, flash, jsonify
 from flask_login import current_user, login_user, logout_user
-from armonaut import db, __version__
+from armonaut import db
 from armonaut.models import Account
+from armonaut.providers import github, gitlab, bitbucket
 
 oauth = Blueprint('oauth', __name__, url_prefix='/oauth')
 
@@ -45,23 +45,19 @@ def github_oauth_callback():
         return jsonify(message='Request must have parameter `code`.'), 400
 
     # Exchange our OAuth code for an access token.
-    with requests.post('https://github.com/login/oauth/access_token',
-                       headers={'Accept': 'application/json',
-                                'User-Agent': f'Armonaut/{__version__}'},
-                       params={'client_id': current_app.config.get('GITHUB_OAUTH_ID'),
-                               'client_secret': current_app.config.get('GITHUB_OAUTH_SECRET'),
-                               'redirect_uri': url_for('oauth.github_oauth_callback', _external=True),
-                               'code': request.args.get('code')}) as r:
+    with github.post('https://github.com/login/oauth/access_token',
+                     headers={'Accept': 'application/json'},
+                     params={'client_id': current_app.config.get('GITHUB_OAUTH_ID'),
+                             'client_secret': current_app.config.get('GITHUB_OAUTH_SECRET'),
+                             'redirect_uri': url_for('oauth.github_oauth_callback', _external=True),
+                             'code': request.args.get('code')}) as r:
         if not r.ok:  # pragma: no cover
             flash('Couldn\'t authenticate with GitHub', 'danger')
             return redirect(url_for('index.home'))
         access_token = r.json()['access_token']
 
     # Check the validity of the access token by trying to use it.
-    with requests.get('https://api.github.com/user',
-                      headers={'Accept': 'application/json',
-                               'User-Agent': f'Armonaut/{__version__}',
-                               'Authorization': f'token {access_token}'}) as r:
+    with github.get('/user', access_token) as r:
         if not r.ok:  # pragma: no cover
             flash('Couldn\'t authenticate with GitHub', 'danger')
             return redirect(url_for('index.home'))
@@ -106,13 +102,11 @@ def bitbucket_oauth_callback():
         return jsonify(message='Request must have parameter `code`.'), 400
 
     # Exchange our OAuth code for an access token.
-    with requests.post('https://bitbucket.org/site/oauth2/access_token',
-                       auth=(current_app.config.get('BITBUCKET_OAUTH_ID'),
-                             current_app.config.get('BITBUCKET_OAUTH_SECRET')),
-                       headers={'Accept': 'application/json',
-                                'User-Agent': f'Armonaut/{__version__}'},
-                       data={'code': request.args.get('code'),
-                             'grant_type': 'authorization_code'}) as r:
+    with bitbucket.post('https://bitbucket.org/site/oauth2/access_token',
+                        auth=(current_app.config.get('BITBUCKET_OAUTH_ID'),
+                              current_app.config.get('BITBUCKET_OAUTH_SECRET')),
+                        data={'code': request.args.get('code'),
+                              'grant_type': 'authorization_code'}) as r:
         if not r.ok:  # pragma: no cover
             flash('Couldn\'t authenticate with BitBucket', 'danger')
             return redirect(url_for('index.home'))
@@ -120,20 +114,14 @@ def bitbucket_oauth_callback():
         refresh_token = r.json()['refresh_token']
 
     # Check the validity of the access token by trying to use it.
-    with requests.get('https://api.bitbucket.org/2.0/user',
-                      headers={'Accept': 'application/json',
-                               'User-Agent': f'Armonaut/{__version__}',
-                               'Authorization': f'Bearer {access_token}'}) as r:
+    with bitbucket.get('/user', access_token) as r:
         if not r.ok:  # pragma: no cover
             flash('Couldn\'t authenticate with BitBucket', 'danger')
             return redirect(url_for('index.home'))
         bitbucket_id = r.json()['account_id']
         bitbucket_login = r.json()['username']
 
-    with requests.get('https://api.bitbucket.org/2.0/user/emails',
-                      headers={'Accept': 'application/json',
-                               'User-Agent': f'Armonaut/{__version__}',
-                               'Authorization': f'Bearer {access_token}'}) as r:
+    with bitbucket.get('/user/emails', access_token) as r:
         if not r.ok:  # pragma: no cover
             flash('Couldn\'t authenticate with BitBucket', 'danger')
             return redirect(url_for('index.home'))
@@ -185,14 +173,12 @@ def gitlab_oauth_callback():
         return jsonify(message='Request must have parameter `code`.'), 400
 
     # Exchange our OAuth code for an access token.
-    with requests.post('https://gitlab.com/oauth/token',
-                       headers={'Accept': 'application/json',
-                                'User-Agent': f'Armonaut/{__version__}'},
-                       params={'code': request.args.get('code'),
-                               'grant_type': 'authorization_code',
-                               'client_id':  current_app.config.get('GITLAB_OAUTH_ID'),
-                               'client_secret': current_app.config.get('GITLAB_OAUTH_SECRET'),
-                               'redirect_uri': url_for('oauth.gitlab_oauth_callback', _external=True)}) as r:
+    with gitlab.post('https://gitlab.com/oauth/token',
+                     params={'code': request.args.get('code'),
+                             'grant_type': 'authorization_code',
+                             'client_id':  current_app.config.get('GITLAB_OAUTH_ID'),
+                             'client_secret': current_app.config.get('GITLAB_OAUTH_SECRET'),
+                             'redirect_uri': url_for('oauth.gitlab_oauth_callback', _external=True)}) as r:
         if not r.ok:  # pragma: no cover
             flash('Couldn\'t authenticate with GitLab', 'danger')
             return redirect(url_for('index.home'))
@@ -200,10 +186,7 @@ def gitlab_oauth_callback():
         refresh_token = r.json()['refresh_token']
 
     # Check the validity of the access token by trying to use it.
-    with requests.get('https://gitlab.com/api/v4/user',
-                      headers={'Accept': 'application/json',
-                               'User-Agent': f'Armonaut/{__version__}',
-                               'Authorization': f'Bearer {access_token}'}) as r:
+    with gitlab.get('/user', access_token) as r:
         if not r.ok:  # pragma: no cover
             flash('Couldn\'t authenticate with GitLab', 'danger')
             return redirect(url_for('index.home'))
@@ -0,0 +1,391 @@
+# Copyright (C) 2017 Seth Michael Larson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""HTTP clients for the remote hosts' APIs and OAuth endpoints.
+
+Each remote host has one `requests.Session` per process so connections
+are kept alive and reused between calls instead of paying for a TCP and
+TLS handshake every time. Clients add the default headers and the
+authorization header for a token, apply timeouts and retry idempotent
+requests with backoff when the remote host is unavailable.
+
+GET responses carrying an `ETag` or `Last-Modified` header are kept in a
+bounded `ResponseCache` per URL and token. Later GETs of the same
+resource are sent as conditional requests and a `304 Not Modified`, which
+GitHub doesn't count against the rate limit, is answered from the cache.
+
+Every process publishes the stats of its clients to Redis so that
+`collect_provider_stats()` can add them up for `manage.py provider_stats`.
+"""
+
+import base64
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import typing
+import redis
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from armonaut import __version__
+from armonaut.cache import LRUCache, get_redis
+from armonaut.governor import Governor, RateLimited
+
+logger = logging.getLogger(__name__)
+TIMEOUT = (3.05, 15)
+POOL_MAXSIZE = 20
+RESPONSE_CACHE_SIZE = 50000
+RESPONSE_CACHE_ENTRY_SIZE = 16 * 1024
+LOCAL_RESPONSE_CACHE_SIZE = 512
+STATS_KEY = 'armonaut:provider-stats'
+STATS_INTERVAL = 10.0
+STATS_MAX_AGE = 3600.0
+_stats_published = 0.0
+
+
+class ProviderStats(object):
+    """Request counts and latencies of a provider client within this process."""
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.not_modified = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, elapsed: float, error: bool, not_modified: bool = False) -> None:
+        with self._lock:
+            self.requests += 1
+            self.errors += error
+            self.not_modified += not_modified
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+
+
+class ResponseCache(object):
+    """Validators and bodies of GET responses, bounded to `maxsize` entries
+    of at most `max_entry_size` bytes. Larger responses aren't cached.
+
+    Entries live in Redis with a sorted set of their last use so the least
+    recently used entries are evicted once there are too many, and in a
+    small in-process LRU. A stale entry is harmless because it is only
+    ever used after the remote host answered that it hasn't changed.
+    """
+    def __init__(self, namespace: str, maxsize: int = RESPONSE_CACHE_SIZE,
+                 max_entry_size: int = RESPONSE_CACHE_ENTRY_SIZE, local_maxsize: int = LOCAL_RESPONSE_CACHE_SIZE):
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.max_entry_size = max_entry_size
+        self.local = LRUCache(local_maxsize)
+
+    @staticmethod
+    def key(url: str, token: typing.Union[None, str]) -> str:
+        # Responses depend on the token and tokens shouldn't end up in Redis.
+        return hashlib.sha1(f'{token or ""}|{url}'.encode('utf-8')).hexdigest()
+
+    def _redis_key(self, key: str) -> str:
+        return f'armonaut:{self.namespace}:{key}'
+
+    @property
+    def _lru_key(self) -> str:
+        return f'armonaut:{self.namespace}:lru'
+
+    def get(self, key: str) -> typing.Union[None, typing.Dict[str, typing.Any]]:
+        entry = self.local.get(key)
+        if entry is not None:
+            return entry
+        client = get_redis()
+        if client is None:
+            return None
+        try:
+            pipe = client.pipeline(transaction=False)
+            pipe.get(self._redis_key(key))
+            pipe.zadd(self._lru_key, {key: time.time()}, xx=True)
+            data, _ = pipe.execute()
+        except redis.RedisError:
+            logger.warning('Could not read %s from the response cache', self.namespace, exc_info=True)
+            return None
+        if data is None:
+            return None
+        entry = json.loads(data)
+        self.local.set(key, entry)
+        return entry
+
+    def set(self, key: str, entry: typing.Dict[str, typing.Any]) -> None:
+        if len(entry['content']) > self.max_entry_size:
+            return
+        self.local.set(key, entry)
+        client = get_redis()
+        if client is None:
+            return
+        try:
+            pipe = client.pipeline(transaction=False)
+            pipe.set(self._redis_key(key), json.dumps(entry))
+            pipe.zadd(self._lru_key, {key: time.time()})
+            pipe.zcard(self._lru_key)
+            size = pipe.execute()[-1]
+            if size > self.maxsize:
+                self._evict(client, size - self.maxsize)
+        except redis.RedisError:
+            logger.warning('Could not write %s to the response cache', self.namespace, exc_info=True)
+
+    def _evict(self, client: redis.StrictRedis, count: int) -> None:
+        keys = [key.decode('utf-8') for key in client.zrange(self._lru_key, 0, count - 1)]
+        if keys:
+            pipe = client.pipeline(transaction=False)
+            pipe.delete(*[self._redis_key(key) for key in keys])
+            pipe.zrem(self._lru_key, *keys)
+            pipe.execute()
+
+    def clear(self) -> None:
+        self.local.clear()
+
+
+def _cache_entry(response: requests.Response) -> typing.Union[None, typing.Dict[str, typing.Any]]:
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if response.status_code != 200 or (etag is None and last_modified is None):
+        return None
+    return {'etag': etag,
+            'last_modified': last_modified,
+            'content_type': response.headers.get('Content-Type'),
+            'content': base64.b64encode(response.content).decode('ascii')}
+
+
+def _from_cache(response: requests.Response, entry: typing.Dict[str, typing.Any]) -> requests.Response:
+    """Turns a `304 Not Modified` into the cached `200 OK` response."""
+    response.status_code = 200
+    response.reason = 'OK'
+    response._content = base64.b64decode(entry['content'])
+    if entry['content_type'] is not None:
+        response.headers['Content-Type'] = entry['content_type']
+    response.headers.pop('Content-Encoding', None)
+    response.from_cache = True
+    return response
+
+
+class ProviderClient(object):
+    def __init__(self, name: str, base_url: str, auth_scheme: str, headers: typing.Dict[str, str] = None,
+                 backoff_factor: float = 0.3):
+        self.name = name
+        self.backoff_factor = backoff_factor
+        self.base_url = base_url
+        self.auth_scheme = auth_scheme
+        self.headers = {'User-Agent': f'Armonaut/{__version__}', 'Accept': 'application/json'}
+        self.headers.update(headers or {})
+        self.stats = ProviderStats()
+        self.cache = ResponseCache(f'provider-responses:{name}')
+        self.governor = Governor()
+        self._session = None
+        self._pid = None
+
+    @property
+    def session(self) -> requests.Session:
+        # Connections can't be shared with forked rq work horses.
+        if self._session is None or self._pid != os.getpid():
+            session = requests.Session()
+            session.headers.update(self.headers)
+            retry = Retry(total=3, connect=3, read=2, backoff_factor=self.backoff_factor,
+                          status_forcelist=(502, 503, 504), raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_MAXSIZE, max_retries=retry)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self._session, self._pid = session, os.getpid()
+        return self._session
+
+    def request(self, method: str, url: str, token: str = None, cache: bool = False, urgent: bool = True,
+                **kwargs) -> requests.Response:
+        """Sends a request to the provider. `url` may be relative to the
+        provider's API and `token` is sent as the authorization header.
+        With `cache` a GET is sent as a conditional request if the
+        resource has been fetched before (see `ResponseCache`). Calls with
+        a token wait for its rate limit, calls that aren't `urgent` wait
+        behind urgent ones (see `armonaut.governor`)."""
+        if not url.startswith(('https://', 'http://')):
+            url = self.base_url + url
+        headers = dict(kwargs.pop('headers', None) or {})
+        if token is not None:
+            headers['Authorization'] = f'{self.auth_scheme} {token}'
+        kwargs.setdefault('timeout', TIMEOUT)
+
+        key = entry = None
+        if cache and method == 'GET':
+            key = self.cache.key(requests.Request(method, url, params=kwargs.get('params')).prepare().url, token)
+            entry = self.cache.get(key)
+            if entry is not None:
+                if entry['etag'] is not None:
+                    headers['If-None-Match'] = entry['etag']
+                if entry['last_modified'] is not None:
+                    headers['If-Modified-Since'] = entry['last_modified']
+
+        if token is not None:
+            try:
+                self.governor.acquire(token, urgent)
+            except RateLimited:
+                logger.warning('Rate limited %s %s', method, url)
+                raise
+
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, url, headers=headers, **kwargs)
+        except requests.RequestException:
+            self.stats.record(time.perf_counter() - start, True)
+            raise
+        if token is not None:
+            self.governor.update(token, response)
+        not_modified = entry is not None and response.status_code == 304
+        self.stats.record(time.perf_counter() - start, response.status_code >= 500, not_modified)
+        publish_provider_stats()
+
+        if not_modified:
+            return _from_cache(response, entry)
+        response.from_cache = False
+        if key is not None:
+            new_entry = _cache_entry(response)
+            if new_entry is not None:
+                self.cache.set(key, new_entry)
+        return response
+
+    def get(self, url: str, token: str = None, cache: bool = True, **kwargs) -> requests.Response:
+        return self.request('GET', url, token, cache=cache, **kwargs)
+
+    def head(self, url: str, token: str = None, **kwargs) -> requests.Response:
+        return self.request('HEAD', url, token, **kwargs)
+
+    def post(self, url: str, token: str = None, **kwargs) -> requests.Response:
+        return self.request('POST', url, token, **kwargs)
+
+    def delete(self, url: str, token: str = None, **kwargs) -> requests.Response:
+        return self.request('DELETE', url, token, **kwargs)
+
+    def connections(self) -> int:
+        """Returns the number of connections opened by this process."""
+        if self._session is None or self._pid != os.getpid():
+            return 0
+        total = 0
+        for adapter in set(self._session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    total += pool.num_connections
+        return total
+
+    def stats_to_json(self) -> typing.Dict[str, typing.Any]:
+        stats = self.stats
+        connections = self.connections()
+        return {'requests': stats.requests,
+                'errors': stats.errors,
+                'not_modified': stats.not_modified,
+                'connections': connections,
+                'connection_reuses': max(stats.requests - connections, 0),
+                'mean_time': stats.total_time / stats.requests if stats.requests else 0.0,
+                'max_time': stats.max_time,
+                'rate_limit': self.governor.stats_to_json()}
+
+
+github = ProviderClient('gh', 'https://api.github.com', 'token',
+                        headers={'Accept': 'application/vnd.github.v3+json'})
+gitlab = ProviderClient('gl', 'https://gitlab.com/api/v4', 'Bearer')
+bitbucket = ProviderClient('bb', 'https://api.bitbucket.org/2.0', 'Bearer')
+CLIENTS = {client.name: client for client in (github, gitlab, bitbucket)}
+
+
+def get_client(remote_host: str) -> ProviderClient:
+    return CLIENTS[remote_host]
+
+
+def provider_stats() -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+    """Returns the request, connection reuse and latency stats of each
+    provider within this process."""
+    return {name: client.stats_to_json() for name, client in CLIENTS.items()}
+
+
+def publish_provider_stats(force: bool = False) -> None:
+    """Writes the `provider_stats()` of this process to Redis, at most
+    every `STATS_INTERVAL` seconds unless `force` is given."""
+    global _stats_published
+    now = time.time()
+    if not force and now - _stats_published < STATS_INTERVAL:
+        return
+    client = get_redis()
+    if client is None:
+        return
+    _stats_published = now
+    try:
+        client.hset(STATS_KEY, f'{socket.gethostname()}:{os.getpid()}',
+                    json.dumps({'time': now, 'providers': provider_stats()}))
+    except redis.RedisError:
+        logger.warning('Could not publish provider stats', exc_info=True)
+
+
+def collect_provider_stats() -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+    """Adds up the stats that all processes published within the last
+    `STATS_MAX_AGE` seconds, or returns the stats of this process if
+    there is no Redis. Older stats are of processes that are gone and
+    are removed."""
+    client = get_redis()
+    if client is None:
+        return provider_stats()
+    publish_provider_stats(force=True)
+    try:
+        published = client.hgetall(STATS_KEY)
+    except redis.RedisError:
+        logger.warning('Could not read provider stats', exc_info=True)
+        return provider_stats()
+
+    now = time.time()
+    processes = []
+    stale = []
+    for process, data in published.items():
+        data = json.loads(data)
+        if data['time'] < now - STATS_MAX_AGE:
+            stale.append(process)
+        else:
+            processes.append(data['providers'])
+    if stale:
+        try:
+            client.hdel(STATS_KEY, *stale)
+        except redis.RedisError:
+            logger.warning('Could not remove stale provider stats', exc_info=True)
+    return {name: _add_stats([providers[name] for providers in processes if name in providers])
+            for name in CLIENTS}
+
+
+def _mean(stats: typing.List[typing.Dict[str, typing.Any]], key: str, count: str) -> float:
+    total = sum(x[count] for x in stats)
+    return sum(x[key] * x[count] for x in stats) / total if total else 0.0
+
+
+def _add_stats(stats: typing.List[typing.Dict[str, typing.Any]]) -> typing.Dict[str, typing.Any]:
+    """Adds up the `ProviderClient.stats_to_json()` of many processes."""
+    rate_limits = [x['rate_limit'] for x in stats]
+    return {'requests': sum(x['requests'] for x in stats),
+            'errors': sum(x['errors'] for x in stats),
+            'not_modified': sum(x['not_modified'] for x in stats),
+            'connections': sum(x['connections'] for x in stats),
+            'connection_reuses': sum(x['connection_reuses'] for x in stats),
+            'mean_time': _mean(stats, 'mean_time', 'requests'),
+            'max_time': max([x['max_time'] for x in stats], default=0.0),
+            'rate_limit': {'calls': sum(x['calls'] for x in rate_limits),
+                           'delayed': sum(x['delayed'] for x in rate_limits),
+                           'rejected': sum(x['rejected'] for x in rate_limits),
+                           'mean_queue_time': _mean(rate_limits, 'mean_queue_time', 'delayed'),
+                           'max_queue_time': max([x['max_queue_time'] for x in rate_limits], default=0.0),
+                           'tokens': sum(x['tokens'] for x in rate_limits)}}
@@ -0,0 +1,160 @@
+# Copyright (C) 2017 Seth Michael Larson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Decides which queued jobs are dispatched next.
+
+Accounts share the runners fairly: the next job always comes from the
+account with the fewest running jobs relative to its weight (from
+`SCHEDULER_ACCOUNT_WEIGHTS`, default 1) so a large build matrix from one
+account can't starve the others. Within an account jobs are dispatched by
+how long they have been queued, where jobs of private projects and of
+branch builds (as opposed to pull request builds) are treated as having
+waited `SCHEDULER_PRIVATE_BOOST` and `SCHEDULER_BRANCH_BOOST` seconds longer.
+Jobs aren't dispatched while a job in an earlier stage of their build
+hasn't finished.
+"""
+
+import datetime
+import heapq
+import typing
+from flask import current_app
+from sqlalchemy import DateTime, select, case, func, literal
+from sqlalchemy.orm import aliased, joinedload
+from armonaut import db
+from armonaut.models import Project, Build, Job, Pool, epoch, seconds_between, utcnow
+
+ACTIVE_STATUSES = ('starting', 'running')
+
+
+def _job_priority():
+    """Higher is dispatched sooner, the boosted age of a job minus `now`."""
+    config = current_app.config
+    boost = (case((Project.private.is_(True), config['SCHEDULER_PRIVATE_BOOST']), else_=0) +
+             case((Build.pull_request_number.is_(None), config['SCHEDULER_BRANCH_BOOST']), else_=0))
+    return boost - epoch(Job.create_time)
+
+
+def _jobs_by_account(*columns):
+    return select(*columns).select_from(Job)\
+        .join(Build, Job.build_id == Build.id)\
+        .join(Project, Build.project_id == Project.id)
+
+
+def _is_blocked():
+    """True for jobs that have an unfinished job in an earlier stage."""
+    upstream = aliased(Job)
+    return select(upstream.id).where(upstream.build_id == Job.build_id,
+                                     upstream.stage_number < Job.stage_number,
+                                     upstream.status.in_(('queued',) + ACTIVE_STATUSES)).exists()
+
+
+def _queued_jobs(per_account: int) -> typing.Dict[int, typing.List[typing.Tuple[float, int]]]:
+    """Returns the `(priority, job id)` of the next queued jobs of each account."""
+    priority = _job_priority().label('priority')
+    rank = func.row_number().over(partition_by=Project.account_id,
+                                  order_by=(priority.desc(), Job.id)).label('rank')
+    ranked = _jobs_by_account(Job.id.label('job_id'), Project.account_id.label('account_id'), priority, rank)\
+        .where(Job.status == 'queued', ~_is_blocked()).subquery()
+    rows = db.session.execute(select(ranked.c.account_id, ranked.c.priority, ranked.c.job_id)
+                              .where(ranked.c.rank <= per_account)
+                              .order_by(ranked.c.account_id, ranked.c.rank))
+    jobs = {}
+    for account_id, priority, job_id in rows:
+        jobs.setdefault(account_id, []).append((priority, job_id))
+    return jobs
+
+
+def _running_jobs() -> typing.Dict[int, int]:
+    rows = db.session.execute(_jobs_by_account(Project.account_id, func.count(Job.id))
+                              .where(Job.status.in_(ACTIVE_STATUSES))
+                              .group_by(Project.account_id))
+    return dict(rows.all())
+
+
+def plan_jobs(limit: int) -> typing.List[int]:
+    """Returns the ids of the next `limit` jobs to dispatch in order."""
+    queued = _queued_jobs(limit)
+    running = _running_jobs()
+    weights = current_app.config['SCHEDULER_ACCOUNT_WEIGHTS']
+
+    # Accounts are ordered by their share of the runners, ties go to the
+    # account whose next job has the highest priority.
+    heap = []
+    for account_id, jobs in queued.items():
+        share = running.get(account_id, 0) / weights.get(account_id, 1)
+        heap.append((share, -jobs[0][0], account_id, 0))
+    heapq.heapify(heap)
+
+    planned = []
+    while heap and len(planned) < limit:
+        _, _, account_id, index = heapq.heappop(heap)
+        jobs = queued[account_id]
+        planned.append(jobs[index][1])
+        running[account_id] = running.get(account_id, 0) + 1
+        if index + 1 < len(jobs):
+            share = running[account_id] / weights.get(account_id, 1)
+            heapq.heappush(heap, (share, -jobs[index + 1][0], account_id, index + 1))
+    return planned
+
+
+def dispatch_jobs(limit: int, place: typing.Callable[[Job], bool] = None) -> typing.List[Job]:
+    """Marks the next `limit` jobs as starting and returns them in order.
+    Jobs that another dispatcher has already locked are skipped. `place`
+    is called for each job in order and jobs that it returns False for
+    aren't dispatched. It defaults to a `armonaut.allocator.PoolAllocator`
+    if there are any pools.
+    """
+    job_ids = plan_jobs(limit)
+    if not job_ids:
+        return []
+    if place is None and db.session.query(Pool.query.exists()).scalar():
+        from armonaut.allocator import PoolAllocator
+        place = PoolAllocator()
+    jobs = Job.query.filter(Job.id.in_(job_ids), Job.status == 'queued')\
+        .options(joinedload(Job.build, innerjoin=True).joinedload(Build.project, innerjoin=True))\
+        .with_for_update(skip_locked=True, of=Job).all()
+    order = {job_id: i for i, job_id in enumerate(job_ids)}
+    jobs.sort(key=lambda job: order[job.id])
+    if place is not None:
+        jobs = [job for job in jobs if place(job)]
+    for job in jobs:
+        job.status = 'starting'
+    db.session.commit()
+    return jobs
+
+
+def account_queue_stats(now: datetime.datetime = None) -> typing.List[typing.Dict[str, typing.Any]]:
+    """Returns the queue depth, running jobs and queue times of every
+    account that has queued or running jobs, longest waits first. Queue
+    times are measured until `now`, the database's current time by default.
+    """
+    now = utcnow() if now is None else literal(now, DateTime())
+    is_queued = Job.status == 'queued'
+    queue_time = seconds_between(Job.create_time, now)
+    rows = db.session.execute(
+        _jobs_by_account(Project.account_id,
+                         func.count(case((is_queued, 1))),
+                         func.count(case((Job.status.in_(ACTIVE_STATUSES), 1))),
+                         func.max(case((is_queued, queue_time))),
+                         func.avg(case((is_queued, queue_time))))
+        .where(Job.status.in_(('queued',) + ACTIVE_STATUSES))
+        .group_by(Project.account_id))
+    stats = [{'account_id': account_id,
+              'queued': queued,
+              'running': running,
+              'max_queue_time': int(max_wait or 0),
+              'mean_queue_time': int(mean_wait or 0)}
+             for account_id, queued, running, max_wait, mean_wait in rows]
+    return sorted(stats, key=lambda x: (-x['max_queue_time'], x['account_id']))
@@ -0,0 +1,227 @@
+# Copyright (C) 2017 Seth Michael Larson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Publishes build statuses to the remote hosts as commit statuses.
+
+Whenever a commit that changes the status of a build or of one of its
+jobs is committed, the build's status is recorded as the latest state of
+its `(project, commit, context)` in a Redis hash, so a matrix with many
+job transitions only leaves the newest state behind. The first update in
+a window enqueues `flush_commit_statuses` to run `COMMIT_STATUS_WINDOW`
+seconds later which sends all recorded states with at most
+`COMMIT_STATUS_CONCURRENCY` requests in flight. No provider round-trip
+happens in the transaction that changes a job. Statuses that couldn't be
+sent because of a connection error or a server error are put back for
+the next flush unless their commit has a newer status, at most
+`COMMIT_STATUS_ATTEMPTS` times.
+
+Without Redis the states are collected in-process until
+`flush_commit_statuses()` is called.
+"""
+
+import datetime
+import json
+import logging
+import threading
+import typing
+from concurrent.futures import ThreadPoolExecutor
+import redis
+import requests
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.orm.attributes import get_history
+from armonaut.cache import get_redis
+from armonaut.models import Project, Build, Job
+
+logger = logging.getLogger(__name__)
+STATUS_CONTEXT = 'continuous-integration/armonaut'
+STATUSES_KEY = 'armonaut:commit-statuses'
+SCHEDULED_KEY = 'armonaut:commit-statuses:scheduled'
+COMMIT_STATUS_ATTEMPTS = 5
+_SESSION_KEY = 'armonaut.commit_statuses'
+_SAVEPOINTS_KEY = 'armonaut.commit_statuses.savepoints'
+
+_local_statuses = {}
+_local_lock = threading.Lock()
+
+
+def _field(project_id: int, commit: str, context: str) -> str:
+    return json.dumps([project_id, commit, context])
+
+
+def publish_commit_status(project_id: int, commit: str, status: str, build_number: int,
+                          context: str = STATUS_CONTEXT) -> None:
+    """Records the latest status of a commit to be sent by the next flush."""
+    field = _field(project_id, commit, context)
+    _record_statuses({field: json.dumps({'status': status, 'build_number': build_number})})
+
+
+def _record_statuses(statuses: typing.Dict[str, str], replace: bool = True) -> None:
+    """Records statuses and schedules a flush if none is scheduled. Unless
+    `replace` a status isn't recorded if its commit has a newer one."""
+    client = get_redis()
+    if client is None:
+        with _local_lock:
+            for field, value in statuses.items():
+                if replace:
+                    _local_statuses[field] = value
+                else:
+                    _local_statuses.setdefault(field, value)
+        return
+
+    window = current_app.config['COMMIT_STATUS_WINDOW']
+    try:
+        pipe = client.pipeline(transaction=False)
+        for field, value in statuses.items():
+            if replace:
+                pipe.hset(STATUSES_KEY, field, value)
+            else:
+                pipe.hsetnx(STATUSES_KEY, field, value)
+        pipe.set(SCHEDULED_KEY, 1, nx=True, ex=int(window) + 60)
+        scheduled = pipe.execute()[-1]
+    except redis.RedisError:
+        logger.warning('Could not record commit statuses %s', list(statuses.values()), exc_info=True)
+        return
+    if scheduled:
+        from armonaut.worker import get_queue
+        try:
+            get_queue('high').enqueue_in(datetime.timedelta(seconds=window), 'armonaut.tasks.flush_commit_statuses')
+        except redis.RedisError:
+            logger.warning('Could not schedule sending commit statuses', exc_info=True)
+            client.delete(SCHEDULED_KEY)
+
+
+def _take_statuses() -> typing.Dict[str, str]:
+    client = get_redis()
+    if client is None:
+        with _local_lock:
+            statuses = dict(_local_statuses)
+            _local_statuses.clear()
+        return statuses
+    try:
+        # Updates after this point schedule the next flush.
+        client.delete(SCHEDULED_KEY)
+        pipe = client.pipeline(transaction=True)
+        pipe.hgetall(STATUSES_KEY)
+        pipe.delete(STATUSES_KEY)
+        statuses, _ = pipe.execute()
+    except redis.RedisError:
+        logger.warning('Could not read commit statuses', exc_info=True)
+        return {}
+    return {field.decode('utf-8'): value.decode('utf-8') for field, value in statuses.items()}
+
+
+def _post_commit_status(project: Project, commit: str, status: str, url: str,
+                        context: str) -> typing.Tuple[typing.Union[None, int], bool]:
+    """Returns the response's status code and whether sending should be retried."""
+    try:
+        result = project.post_commit_status(commit, status, url, context)
+    except requests.RequestException:
+        logger.warning('Could not send status %s of commit %s to project %d', status, commit,
+                       project.id, exc_info=True)
+        return None, True
+    except NotImplementedError:
+        return None, False
+    return result, result is not None and result >= 500
+
+
+def flush_commit_statuses() -> int:
+    """Sends every recorded commit status concurrently and returns the
+    number of statuses that were sent."""
+    updates = []
+    for field, value in _take_statuses().items():
+        project_id, commit, context = json.loads(field)
+        updates.append((project_id, commit, context, json.loads(value)))
+    if not updates:
+        return 0
+
+    # Projects and tokens are loaded up front so the threads only send requests.
+    projects = Project.query.options(joinedload(Project.account))\
+        .filter(Project.id.in_({update[0] for update in updates})).all()
+    projects = {project.id: project for project in projects}
+    url_template = current_app.config['BUILD_URL_TEMPLATE']
+    calls = []
+    fields = []
+    for project_id, commit, context, value in updates:
+        project = projects.get(project_id)
+        if project is None or project.account is None:
+            continue
+        url = url_template.format(host=project.remote_host, owner=project.owner, name=project.name,
+                                  number=value['build_number'])
+        calls.append((project, commit, value['status'], url, context))
+        fields.append((_field(project_id, commit, context), value))
+    if not calls:
+        return 0
+
+    workers = min(current_app.config['COMMIT_STATUS_CONCURRENCY'], len(calls))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(lambda call: _post_commit_status(*call), calls))
+
+    retries = {}
+    for (project, *_), (field, value), (result, retry) in zip(calls, fields, results):
+        if result == 401:
+            project.invalidate_access_token()
+        attempts = value.get('attempts', 1)
+        if retry and attempts < COMMIT_STATUS_ATTEMPTS:
+            retries[field] = json.dumps(dict(value, attempts=attempts + 1))
+    if retries:
+        _record_statuses(retries, replace=False)
+    return sum(1 for result, retry in results if result is not None and not retry)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_commit_statuses(session, flush_context) -> None:
+    """Remembers the status of every build whose status or jobs changed."""
+    builds = set()
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Job) and get_history(obj, 'status').has_changes() and obj.build is not None:
+            builds.add(obj.build)
+        elif isinstance(obj, Build) and get_history(obj, 'status').has_changes():
+            builds.add(obj)
+    if not builds:
+        return
+    statuses = session.info.setdefault(_SESSION_KEY, {})
+    for build in builds:
+        status = build.determine_status() if build.jobs else build.status
+        statuses[(build.project_id, build.commit_sha)] = (status, build.number)
+
+
+@event.listens_for(Session, 'after_transaction_create')
+def _remember_savepoint(session, transaction) -> None:
+    if transaction.nested:
+        statuses = dict(session.info.get(_SESSION_KEY, {}))
+        session.info.setdefault(_SAVEPOINTS_KEY, {})[transaction] = statuses
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_commit_statuses(session) -> None:
+    session.info.pop(_SAVEPOINTS_KEY, None)
+    statuses = session.info.pop(_SESSION_KEY, None)
+    for (project_id, commit), (status, build_number) in (statuses or {}).items():
+        publish_commit_status(project_id, commit, status, build_number)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_commit_statuses(session, previous_transaction) -> None:
+    """Discards the statuses collected since the savepoint or transaction
+    that was rolled back."""
+    if previous_transaction.nested:
+        statuses = session.info.get(_SAVEPOINTS_KEY, {}).pop(previous_transaction, None)
+        if statuses is not None:
+            session.info[_SESSION_KEY] = statuses
+        return
+    session.info.pop(_SAVEPOINTS_KEY, None)
+    session.info.pop(_SESSION_KEY, None)
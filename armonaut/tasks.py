@@ -0,0 +1,253 @@
+# Copyright (C) 2017 Seth Michael Larson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Background jobs that are executed by the rq workers in `armonaut.worker`."""
+
+import datetime
+import functools
+import json
+import logging
+import typing
+import requests
+from flask import current_app, has_app_context
+from armonaut import create_app, db, statuses
+from armonaut.buildconfig import CONFIG_PATH, apply_build_config, load_build_config
+from armonaut.coalescing import coalescing_key, debounce, is_newest_delivery, cancel_superseded_builds
+from armonaut.imports import LISTINGS, import_projects
+from armonaut.matrix import create_jobs
+from armonaut.models import Account, Project, Build
+from armonaut.providers import publish_provider_stats
+from armonaut.worker import get_queue
+
+logger = logging.getLogger(__name__)
+_app = None
+
+
+def task(func):
+    """Runs a background job within an application context, creating
+    the application once per worker process if necessary."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        global _app
+        if has_app_context():
+            return func(*args, **kwargs)
+        if _app is None:
+            _app = create_app()
+        with _app.app_context():
+            try:
+                return func(*args, **kwargs)
+            finally:
+                db.session.remove()
+                # Work horses exit after the task so their stats are published now.
+                publish_provider_stats(force=True)
+    return wrapper
+
+
+@task
+def process_webhook(remote_host: str, project_id: int, event: str, delivery_id: str, payload: str) -> None:
+    """Parses a verified webhook delivery and creates a build if the event requires one."""
+    parse = _WEBHOOK_PARSERS[remote_host]
+    values = parse(event, json.loads(payload))
+    if values is None:
+        logger.info('Ignoring %s delivery %s for project %d', event, delivery_id, project_id)
+        return
+
+    key = coalescing_key(values)
+    if debounce(project_id, key, delivery_id):
+        delay = datetime.timedelta(seconds=current_app.config['BUILD_DEBOUNCE_SECONDS'])
+        get_queue('high').enqueue_in(delay, create_debounced_build, project_id, key, delivery_id, values)
+        return
+
+    project = Project.query.get(project_id)
+    if project is None or not project.active:
+        return
+    create_build(project, values)
+
+
+@task
+def create_debounced_build(project_id: int, key: str, delivery_id: str, values: typing.Dict[str, typing.Any]) -> None:
+    """Creates the build for a debounced delivery unless a newer
+    delivery for the same branch or pull request has arrived since."""
+    if not is_newest_delivery(project_id, key, delivery_id):
+        logger.info('Delivery %s for project %d was superseded', delivery_id, project_id)
+        return
+    project = Project.query.get(project_id)
+    if project is None or not project.active:
+        return
+    create_build(project, values)
+
+
+def _build_config(project: Project, commit: str) -> typing.Union[None, typing.Dict[str, typing.Any]]:
+    try:
+        return load_build_config(project, commit)
+    except (requests.RequestException, NotImplementedError):
+        logger.warning('Could not load the config of commit %s of project %d', commit, project.id, exc_info=True)
+        return None
+
+
+def create_build(project: Project, values: typing.Dict[str, typing.Any]) -> typing.Union[None, Build]:
+    """Creates the next build of a project and the jobs of its matrix.
+    The project row is locked while the build number is chosen so that
+    concurrent deliveries can't create two builds with the same number.
+    Older builds that the new build supersedes are canceled in the same
+    transaction. Commits without a config aren't built and a build whose
+    config is invalid or couldn't be loaded errors right away.
+    """
+    # The config is loaded before the project row is locked.
+    config = _build_config(project, values['commit_sha'])
+    if config is not None and not config['exists']:
+        logger.info('Commit %s of project %d has no %s', values['commit_sha'], project.id, CONFIG_PATH)
+        return None
+    project = Project.query.filter(Project.id == project.id).with_for_update().one()
+    build = Build()
+    build.project = project
+    build.number = (project.latest_build_number or 0) + 1
+    for key, value in values.items():
+        setattr(build, key, value)
+    if config is None or config['error'] is not None:
+        if config is not None:
+            logger.info('Config of commit %s of project %d is invalid: %s', build.commit_sha, project.id,
+                        config['error'])
+        build.status = 'error'
+        build.finish_time = datetime.datetime.utcnow()
+    else:
+        apply_build_config(build, config['compiled'])
+    db.session.add(build)
+    db.session.flush()
+    if build.status != 'error':
+        create_jobs(build, config['compiled']['cells'])
+    cancel_superseded_builds(build)
+    db.session.commit()
+    return build
+
+
+def parse_github_webhook(event: str, payload: dict) -> typing.Union[None, dict]:
+    if event == 'push':
+        if payload.get('deleted') or payload.get('head_commit') is None:
+            return None
+        ref = payload['ref']
+        commit = payload['head_commit']
+        values = {'commit_sha': commit['id'],
+                  'commit_url': commit['url'],
+                  'commit_author': commit['author'].get('username') or commit['author']['name']}
+        if ref.startswith('refs/tags/'):
+            values['commit_tag'] = ref[len('refs/tags/'):]
+            values['commit_branch'] = payload['repository']['default_branch']
+        else:
+            values['commit_branch'] = ref[len('refs/heads/'):]
+        return values
+
+    elif event == 'pull_request':
+        if payload['action'] not in ('opened', 'reopened', 'synchronize'):
+            return None
+        pull_request = payload['pull_request']
+        head = pull_request['head']
+        return {'commit_sha': head['sha'],
+                'commit_url': f'{head["repo"]["html_url"]}/commit/{head["sha"]}',
+                'commit_author': pull_request['user']['login'],
+                'commit_branch': head['ref'],
+                'pull_request_number': pull_request['number'],
+                'pull_request_branch': pull_request['base']['ref'],
+                'pull_request_slug': head['repo']['full_name'],
+                'pull_request_url': pull_request['html_url']}
+    return None
+
+
+def parse_gitlab_webhook(event: str, payload: dict) -> typing.Union[None, dict]:
+    if event in ('Push Hook', 'Tag Push Hook'):
+        if payload.get('checkout_sha') is None:
+            return None
+        ref = payload['ref']
+        values = {'commit_sha': payload['checkout_sha'],
+                  'commit_url': f'{payload["project"]["web_url"]}/commit/{payload["checkout_sha"]}',
+                  'commit_author': payload['user_username']}
+        if ref.startswith('refs/tags/'):
+            values['commit_tag'] = ref[len('refs/tags/'):]
+            values['commit_branch'] = payload['project']['default_branch']
+        else:
+            values['commit_branch'] = ref[len('refs/heads/'):]
+        return values
+
+    elif event == 'Merge Request Hook':
+        attributes = payload['object_attributes']
+        if attributes.get('action') not in ('open', 'reopen', 'update'):
+            return None
+        commit = attributes['last_commit']
+        return {'commit_sha': commit['id'],
+                'commit_url': commit['url'],
+                'commit_author': payload['user']['username'],
+                'commit_branch': attributes['source_branch'],
+                'pull_request_number': attributes['iid'],
+                'pull_request_branch': attributes['target_branch'],
+                'pull_request_slug': attributes['source']['path_with_namespace'],
+                'pull_request_url': attributes['url']}
+    return None
+
+
+def parse_bitbucket_webhook(event: str, payload: dict) -> typing.Union[None, dict]:
+    if event == 'repo:push':
+        # Only the most recent change of a push is built.
+        changes = [change for change in payload['push']['changes'] if change.get('new')]
+        if not changes:
+            return None
+        new = changes[-1]['new']
+        target = new['target']
+        values = {'commit_sha': target['hash'],
+                  'commit_url': target['links']['html']['href'],
+                  'commit_author': target['author']['raw']}
+        if new['type'] == 'tag':
+            values['commit_tag'] = new['name']
+            values['commit_branch'] = payload['repository'].get('mainbranch', {}).get('name', 'master')
+        else:
+            values['commit_branch'] = new['name']
+        return values
+
+    elif event in ('pullrequest:created', 'pullrequest:updated'):
+        pull_request = payload['pullrequest']
+        source = pull_request['source']
+        return {'commit_sha': source['commit']['hash'],
+                'commit_url': f'https://bitbucket.org/{source["repository"]["full_name"]}/commits/'
+                              f'{source["commit"]["hash"]}',
+                'commit_author': pull_request['author']['username'],
+                'commit_branch': source['branch']['name'],
+                'pull_request_number': pull_request['id'],
+                'pull_request_branch': pull_request['destination']['branch']['name'],
+                'pull_request_slug': source['repository']['full_name'],
+                'pull_request_url': pull_request['links']['html']['href']}
+    return None
+
+
+_WEBHOOK_PARSERS = {'gh': parse_github_webhook,
+                    'gl': parse_gitlab_webhook,
+                    'bb': parse_bitbucket_webhook}
+
+
+@task
+def flush_commit_statuses() -> None:
+    """Sends the commit statuses recorded since the last flush."""
+    statuses.flush_commit_statuses()
+
+
+@task
+def import_account_projects(account_id: int) -> None:
+    """Imports the repositories of every remote host the account is connected to."""
+    account = Account.query.get(account_id)
+    if account is None:
+        return
+    for remote_host, listing in LISTINGS.items():
+        if getattr(account, listing.token_attr) is not None:
+            counts = import_projects(account, remote_host)
+            logger.info('Imported %d repositories of account %d from %s', counts['repositories'],
+                        account_id, remote_host)
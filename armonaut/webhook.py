@@ -1,19 +1,146 @@
-from flask import Blueprint
+# Copyright (C) 2017 Seth Michael Larson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+"""Webhook receivers for all remote hosts. Providers time out slow
+receivers so the handlers only verify that the delivery is authentic and
+enqueue the raw payload, all parsing and build creation happens in
+`armonaut.tasks.process_webhook` on the worker. Retried deliveries are
+recognized by their delivery id and acknowledged without being enqueued.
+"""
 
-webhooks = Blueprint('webhooks', __name__, '/webhooks')
+import hashlib
+import hmac
+import json
+from flask import Blueprint, jsonify, request
+from armonaut.deliveries import webhook_deliveries
+from armonaut.models import Project
+from armonaut.tasks import process_webhook
+from armonaut.worker import get_queue
+
+webhooks = Blueprint('webhooks', __name__, url_prefix='/webhooks')
+
+# Events that can trigger builds, everything else is acknowledged and dropped.
+GITHUB_EVENTS = {'push', 'pull_request'}
+GITLAB_EVENTS = {'Push Hook', 'Tag Push Hook', 'Merge Request Hook'}
+BITBUCKET_EVENTS = {'repo:push', 'pullrequest:created', 'pullrequest:updated'}
 
 
 @webhooks.route('/github', methods=['POST'])
 def github_webhooks():
-    raise NotImplementedError()
+    event = request.headers.get('X-GitHub-Event')
+    if event not in GITHUB_EVENTS:
+        return jsonify(message='Event ignored'), 200
+    delivery_id = request.headers.get('X-GitHub-Delivery')
+    if is_duplicate_delivery('gh', delivery_id):
+        return jsonify(message='Duplicate delivery ignored'), 200
+    project = get_webhook_project('gh', lambda payload: payload['repository']['full_name'])
+    if project is None:
+        return jsonify(message='Could not find a project for this webhook'), 404
+
+    signature = request.headers.get('X-Hub-Signature', '')
+    expected = 'sha1=' + hmac.new(project.webhook_secret.encode('utf-8'),
+                                  request.get_data(), hashlib.sha1).hexdigest()
+    if not secrets_match(signature, expected):
+        return jsonify(message='Invalid webhook signature'), 403
+
+    return accept_webhook(project, event, delivery_id)
 
 
 @webhooks.route('/gitlab', methods=['POST'])
 def gitlab_webhooks():
-    raise NotImplementedError()
+    event = request.headers.get('X-Gitlab-Event')
+    if event not in GITLAB_EVENTS:
+        return jsonify(message='Event ignored'), 200
+    delivery_id = request.headers.get('X-Gitlab-Event-UUID')
+    if is_duplicate_delivery('gl', delivery_id):
+        return jsonify(message='Duplicate delivery ignored'), 200
+    project = get_webhook_project('gl', lambda payload: payload['project']['path_with_namespace'])
+    if project is None:
+        return jsonify(message='Could not find a project for this webhook'), 404
+
+    if not secrets_match(request.headers.get('X-Gitlab-Token', ''), project.webhook_secret):
+        return jsonify(message='Invalid webhook token'), 403
+
+    return accept_webhook(project, event, delivery_id)
 
 
 @webhooks.route('/bitbucket', methods=['POST'])
 def bitbucket_webhooks():
-    raise NotImplementedError()
+    event = request.headers.get('X-Event-Key')
+    if event not in BITBUCKET_EVENTS:
+        return jsonify(message='Event ignored'), 200
+    delivery_id = request.headers.get('X-Request-UUID')
+    if is_duplicate_delivery('bb', delivery_id):
+        return jsonify(message='Duplicate delivery ignored'), 200
+    project = get_webhook_project('bb', lambda payload: payload['repository']['full_name'])
+    if project is None:
+        return jsonify(message='Could not find a project for this webhook'), 404
+
+    # Bitbucket doesn't sign deliveries so the secret is part of the webhook URL.
+    if not secrets_match(request.args.get('secret', ''), project.webhook_secret):
+        return jsonify(message='Invalid webhook secret'), 403
+
+    return accept_webhook(project, event, delivery_id)
+
+
+def get_webhook_project(remote_host: str, get_slug):
+    """Returns the active project that a delivery is for or None. Only
+    the repository slug is read from the payload at this point.
+    """
+    try:
+        owner, name = get_slug_parts(get_slug(json.loads(request.get_data())))
+    except (ValueError, KeyError, TypeError):
+        return None
+    project = Project.get_by_slug(remote_host, owner, name)
+    if project is None or not project.active or project.webhook_secret is None:
+        return None
+    return project
+
+
+def get_slug_parts(slug: str):
+    owner, _, name = slug.rpartition('/')
+    return owner, name
+
+
+def secrets_match(given: str, expected: str) -> bool:
+    """Compares secrets in constant time. `hmac.compare_digest()` only
+    accepts ASCII strings so both are compared as UTF-8 bytes."""
+    return hmac.compare_digest(given.encode('utf-8'), expected.encode('utf-8'))
+
+
+def is_duplicate_delivery(remote_host: str, delivery_id: str) -> bool:
+    return delivery_id is not None and webhook_deliveries.seen(f'{remote_host}:{delivery_id}')
+
+
+def accept_webhook(project: Project, event: str, delivery_id: str):
+    # Concurrent retries can both get past `is_duplicate_delivery()`
+    # but only one of them can claim the delivery id.
+    key = None if delivery_id is None else f'{project.remote_host}:{delivery_id}'
+    if key is not None and not webhook_deliveries.claim(key):
+        return jsonify(message='Duplicate delivery ignored'), 200
+    try:
+        enqueue_webhook(project.remote_host, project.id, event, delivery_id, request.get_data(as_text=True))
+    except Exception:
+        if key is not None:
+            webhook_deliveries.release(key)
+        raise
+    if key is not None:
+        webhook_deliveries.record(key)
+    return jsonify(message='Accepted'), 202
+
+
+def enqueue_webhook(remote_host: str, project_id: int, event: str, delivery_id: str, payload: str) -> None:
+    """Hands a verified delivery to the worker for processing."""
+    get_queue('high').enqueue(process_webhook, remote_host, project_id, event, delivery_id, payload)
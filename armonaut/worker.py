@@ -19,9 +19,16 @@ from rq import Worker, Queue, Connection
 
 
 conn = redis.StrictRedis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379'))
+QUEUES = ['high', 'default', 'low']
+
+
+def get_queue(name: str) -> Queue:
+    """Returns one of the worker's queues for enqueuing jobs."""
+    return Queue(name, connection=conn)
 
 
 if __name__ == '__main__':  # pragma: no coverage
     with Connection(conn):
-        worker = Worker(map(Queue, ['high', 'default', 'low']))
-        worker.work()
+        worker = Worker(map(Queue, QUEUES))
+        # The scheduler runs jobs that are enqueued with a delay.
+        worker.work(with_scheduler=True)
@@ -16,6 +16,36 @@ class Config(object):
 
     # Redis Config
     REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+    CACHE_REDIS_URL = REDIS_URL
+
+    # Webhook Config
+    WEBHOOK_DELIVERY_TTL = 3600
+    WEBHOOK_DELIVERY_WINDOW = 86400
+    WEBHOOK_DELIVERY_CAPACITY = 2000000
+    WEBHOOK_DELIVERY_ERROR_RATE = 1e-6
+
+    # Build Coalescing Config
+    BUILD_DEBOUNCE_SECONDS = 5
+    AUTO_CANCEL_BRANCH_BUILDS = True
+    AUTO_CANCEL_PULL_REQUEST_BUILDS = True
+    AUTO_CANCEL_RUNNING_JOBS = False
+
+    # Scheduler Config
+    SCHEDULER_ACCOUNT_WEIGHTS = {}
+    SCHEDULER_PRIVATE_BOOST = 300
+    SCHEDULER_BRANCH_BOOST = 120
+
+    # Job Lease Config
+    JOB_LEASE_TTL = 60
+    JOB_LEASE_MAX_ATTEMPTS = 3
+
+    # Commit Status Config
+    COMMIT_STATUS_WINDOW = 2
+    COMMIT_STATUS_CONCURRENCY = 8
+    BUILD_URL_TEMPLATE = 'https://armonaut.io/{host}/{owner}/{name}/builds/{number}'
+
+    # Project Import Config
+    IMPORT_CONCURRENCY = 8
 
     # GitHub Config
     GITHUB_API_SECRET = os.environ.get('GITHUB_API_SECRET')
@@ -59,3 +89,4 @@ class TestingConfig(Config):
     SERVER_NAME = 'localhost:8080'
     RATELIMIT_ENABLED = False
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    CACHE_REDIS_URL = None
@@ -13,7 +13,14 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import sys
+import time
 from armonaut import create_app, db
+from armonaut.api.export import iter_builds_ndjson
+from armonaut.leases import reap_expired_leases
+from armonaut.models import Project
+from armonaut.providers import collect_provider_stats
+from armonaut.scheduler import account_queue_stats, dispatch_jobs
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
@@ -24,5 +31,71 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.option('host', help='Remote host of the project (gh, gl or bb)')
+@manager.option('owner', help='Owner of the project')
+@manager.option('name', help='Name of the project')
+@manager.option('-b', '--branch', dest='branch', default=None)
+@manager.option('-s', '--status', dest='status', default=None)
+@manager.option('-p', '--pull-request', dest='pull_request', type=int, default=None)
+def export_builds(host, owner, name, branch=None, status=None, pull_request=None):
+    """Writes the full build history of a project to stdout as newline-delimited JSON."""
+    project = Project.get_by_slug(host, owner, name)
+    if project is None:
+        print(f'Could not find the project {host}/{owner}/{name}', file=sys.stderr)
+        sys.exit(1)
+    for lines in iter_builds_ndjson(project.id, branch=branch, status=status, pull_request=pull_request):
+        sys.stdout.write(lines)
+
+
+@manager.command
+def queue_stats():
+    """Prints the queue depth and queue times of every account with queued or running jobs."""
+    print(f'{"account":>10} {"queued":>8} {"running":>8} {"max wait":>10} {"mean wait":>10}')
+    for stats in account_queue_stats():
+        print(f'{stats["account_id"]:>10} {stats["queued"]:>8} {stats["running"]:>8} '
+              f'{stats["max_queue_time"]:>9}s {stats["mean_queue_time"]:>9}s')
+
+
+@manager.command
+def provider_stats():
+    """Prints the API request and rate limit stats of every remote host, added up over all processes."""
+    print(f'{"host":>4} {"requests":>9} {"errors":>7} {"304s":>7} {"reuses":>7} {"mean time":>10} '
+          f'{"max time":>10} {"tokens":>7} {"delayed":>8} {"rejected":>9} {"max wait":>9}')
+    for host, stats in collect_provider_stats().items():
+        rate_limit = stats['rate_limit']
+        print(f'{host:>4} {stats["requests"]:>9} {stats["errors"]:>7} {stats["not_modified"]:>7} '
+              f'{stats["connection_reuses"]:>7} {stats["mean_time"]:>9.3f}s {stats["max_time"]:>9.3f}s '
+              f'{rate_limit["tokens"]:>7} {rate_limit["delayed"]:>8} {rate_limit["rejected"]:>9} '
+              f'{rate_limit["max_queue_time"]:>8.1f}s')
+
+
+@manager.option('-l', '--limit', dest='limit', type=int, default=100,
+                help='Maximum number of jobs to dispatch at a time')
+@manager.option('-i', '--interval', dest='interval', type=float, default=None,
+                help='Keep dispatching every INTERVAL seconds instead of once')
+def dispatch(limit=100, interval=None):
+    """Dispatches the next queued jobs in fair-share order onto the pools."""
+    while True:
+        jobs = dispatch_jobs(limit)
+        if jobs:
+            print(f'Dispatched {len(jobs)} jobs: {", ".join(str(job.id) for job in jobs)}')
+        if interval is None:
+            break
+        time.sleep(interval)
+
+
+@manager.option('-i', '--interval', dest='interval', type=float, default=None,
+                help='Keep reaping every INTERVAL seconds instead of once')
+def reap_jobs(interval=None):
+    """Flushes job heartbeats and re-queues jobs whose lease has expired."""
+    while True:
+        jobs = reap_expired_leases()
+        if jobs:
+            print(f'Reaped {len(jobs)} jobs: {", ".join(str(job.id) for job in jobs)}')
+        if interval is None:
+            break
+        time.sleep(interval)
+
+
 if __name__ == '__main__':
     manager.run()
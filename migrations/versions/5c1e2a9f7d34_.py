@@ -0,0 +1,48 @@
+# Copyright (C) 2017 Seth Michael Larson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1e2a9f7d34'
+down_revision = 'a00c729a0d53'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('pools',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('create_time', sa.DateTime(), nullable=False),
+                    sa.Column('name', sa.String(), nullable=False),
+                    sa.Column('community', sa.Boolean(), nullable=False),
+                    sa.Column('host_count', sa.Integer(), nullable=False),
+                    sa.Column('host_units', sa.Integer(), nullable=False),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('name'))
+    op.add_column('jobs', sa.Column('container_units', sa.SmallInteger(), nullable=False, server_default='1'))
+    op.add_column('jobs', sa.Column('pool_id', sa.Integer(), nullable=True))
+    op.add_column('jobs', sa.Column('runner_host', sa.String(), nullable=True))
+    op.create_foreign_key('fk_jobs_pool_id', 'jobs', 'pools', ['pool_id'], ['id'])
+
+
+def downgrade():
+    op.drop_constraint('fk_jobs_pool_id', 'jobs', type_='foreignkey')
+    op.drop_column('jobs', 'runner_host')
+    op.drop_column('jobs', 'pool_id')
+    op.drop_column('jobs', 'container_units')
+    op.drop_table('pools')
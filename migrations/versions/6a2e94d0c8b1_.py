@@ -0,0 +1,34 @@
+# Copyright (C) 2017 Seth Michael Larson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6a2e94d0c8b1'
+down_revision = '3f8d1c6b4a27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('jobs', sa.Column('stage', sa.String(), nullable=False, server_default='test'))
+    op.add_column('jobs', sa.Column('stage_number', sa.SmallInteger(), nullable=False, server_default='0'))
+
+
+def downgrade():
+    op.drop_column('jobs', 'stage_number')
+    op.drop_column('jobs', 'stage')
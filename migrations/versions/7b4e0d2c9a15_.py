@@ -0,0 +1,32 @@
+# Copyright (C) 2017 Seth Michael Larson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '7b4e0d2c9a15'
+down_revision = '6a2e94d0c8b1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_projects_remote_host_remote_id', 'projects',
+                    ['remote_host', 'remote_id'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_projects_remote_host_remote_id', table_name='projects')
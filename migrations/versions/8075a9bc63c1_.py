@@ -0,0 +1,48 @@
+# Copyright (C) 2017 Seth Michael Larson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8075a9bc63c1'
+down_revision = 'd08338cff475'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('projects', sa.Column('latest_build_id', sa.Integer(), nullable=True))
+    op.add_column('projects', sa.Column('latest_build_number', sa.Integer(), nullable=True))
+    op.add_column('projects', sa.Column('latest_build_status', sa.String(length=8), nullable=True))
+    op.create_foreign_key('fk_projects_latest_build_id', 'projects', 'builds',
+                          ['latest_build_id'], ['id'], ondelete='SET NULL')
+
+    # Backfill the pointer for all existing projects.
+    op.execute('UPDATE projects SET latest_build_id = '
+               '(SELECT builds.id FROM builds WHERE builds.project_id = projects.id '
+               'ORDER BY builds.number DESC LIMIT 1)')
+    op.execute('UPDATE projects SET '
+               'latest_build_number = (SELECT builds.number FROM builds WHERE builds.id = projects.latest_build_id), '
+               'latest_build_status = (SELECT builds.status FROM builds WHERE builds.id = projects.latest_build_id) '
+               'WHERE latest_build_id IS NOT NULL')
+
+
+def downgrade():
+    op.drop_constraint('fk_projects_latest_build_id', 'projects', type_='foreignkey')
+    op.drop_column('projects', 'latest_build_status')
+    op.drop_column('projects', 'latest_build_number')
+    op.drop_column('projects', 'latest_build_id')
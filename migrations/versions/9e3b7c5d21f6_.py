@@ -0,0 +1,38 @@
+# Copyright (C) 2017 Seth Michael Larson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e3b7c5d21f6'
+down_revision = '5c1e2a9f7d34'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('jobs', sa.Column('lease_owner', sa.String(), nullable=True))
+    op.add_column('jobs', sa.Column('lease_expire_time', sa.DateTime(), nullable=True))
+    op.add_column('jobs', sa.Column('attempts', sa.SmallInteger(), nullable=False, server_default='0'))
+    op.create_index(op.f('ix_jobs_lease_expire_time'), 'jobs', ['lease_expire_time'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_jobs_lease_expire_time'), table_name='jobs')
+    op.drop_column('jobs', 'attempts')
+    op.drop_column('jobs', 'lease_expire_time')
+    op.drop_column('jobs', 'lease_owner')
@@ -0,0 +1,36 @@
+# Copyright (C) 2017 Seth Michael Larson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd08338cff475'
+down_revision = 'b18fbd61be38'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_builds_project_id_start_time', 'builds',
+                    ['project_id', sa.text('start_time DESC'), sa.text('id DESC')], unique=False)
+    op.create_index('ix_builds_project_id_commit_branch_start_time', 'builds',
+                    ['project_id', 'commit_branch', sa.text('start_time DESC'), sa.text('id DESC')], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_builds_project_id_commit_branch_start_time', table_name='builds')
+    op.drop_index('ix_builds_project_id_start_time', table_name='builds')
@@ -1,10 +1,12 @@
 import os
 import tempfile
+import time
 import pytest
+import redis
 
-from armonaut import create_app
+from armonaut import buildconfig, cache, create_app, models
 from armonaut import db as _db
-from armonaut.models import Account, Project
+from armonaut.models import Account, Project, Build, Job, GithubProject, GitlabProject, BitbucketProject
 
 
 TEST_DB_PATH = os.path.join(tempfile.gettempdir(), 'test.db')
@@ -26,6 +28,198 @@ def vcr_cassette_path(request, vcr_cassette_name):
     return os.path.join('tests', 'cassettes', request.module.__name__[6:], vcr_cassette_name)
 
 
+class FakeRedis(object):
+    """An in-memory stand-in for the Redis commands that armonaut uses.
+    Values are returned as bytes like redis-py does. Setting `fail` makes
+    every command raise `ConnectionError` like an unreachable server."""
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.fail = False
+
+    def _check(self):
+        if self.fail:
+            raise redis.ConnectionError('Fake Redis is down')
+
+    @staticmethod
+    def _bytes(value) -> bytes:
+        return value if isinstance(value, bytes) else str(value).encode('utf-8')
+
+    def _get(self, key, default=None):
+        expires = self.expires.get(key)
+        if expires is not None and expires <= time.time():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return self.data.get(key, default)
+
+    def _set(self, key, value, ex=None):
+        self.data[key] = value
+        if ex is None:
+            self.expires.pop(key, None)
+        else:
+            self.expires[key] = time.time() + ex
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def get(self, key):
+        self._check()
+        return self._get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        self._check()
+        if nx and self._get(key) is not None:
+            return None
+        self._set(key, self._bytes(value), ex=ex)
+        return True
+
+    def exists(self, *keys):
+        self._check()
+        return sum(1 for key in keys if self._get(key) is not None)
+
+    def delete(self, *keys):
+        self._check()
+        deleted = self.exists(*keys)
+        for key in keys:
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return deleted
+
+    def expire(self, key, seconds):
+        self._check()
+        if self._get(key) is None:
+            return False
+        self.expires[key] = time.time() + seconds
+        return True
+
+    def ttl(self, key):
+        self._check()
+        if self._get(key) is None:
+            return -2
+        return -1 if key not in self.expires else int(self.expires[key] - time.time())
+
+    def getbit(self, key, offset):
+        self._check()
+        bits = self._get(key, b'')
+        byte, bit = divmod(offset, 8)
+        return (bits[byte] >> (7 - bit)) & 1 if byte < len(bits) else 0
+
+    def setbit(self, key, offset, value):
+        self._check()
+        bits = bytearray(self._get(key, b''))
+        byte, bit = divmod(offset, 8)
+        bits.extend(b'\0' * (byte + 1 - len(bits)))
+        previous = (bits[byte] >> (7 - bit)) & 1
+        bits[byte] = bits[byte] | (1 << (7 - bit)) if value else bits[byte] & ~(1 << (7 - bit))
+        self.data[key] = bytes(bits)
+        return previous
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        self._check()
+        items = dict(mapping or {})
+        if field is not None:
+            items[field] = value
+        hash_ = self._get(key)
+        if hash_ is None:
+            hash_ = self.data[key] = {}
+        added = sum(1 for field in items if self._bytes(field) not in hash_)
+        hash_.update({self._bytes(field): self._bytes(value) for field, value in items.items()})
+        return added
+
+    def hsetnx(self, key, field, value):
+        self._check()
+        if self._bytes(field) in self._get(key, {}):
+            return 0
+        return self.hset(key, field, value)
+
+    def hgetall(self, key):
+        self._check()
+        return dict(self._get(key, {}))
+
+    def hdel(self, key, *fields):
+        self._check()
+        hash_ = self._get(key, {})
+        return sum(1 for field in fields if hash_.pop(self._bytes(field), None) is not None)
+
+    def zadd(self, key, mapping, xx=False):
+        self._check()
+        zset = self._get(key)
+        if zset is None:
+            if xx:
+                return 0
+            zset = self.data[key] = {}
+        added = 0
+        for member, score in mapping.items():
+            member = self._bytes(member)
+            if member not in zset:
+                if xx:
+                    continue
+                added += 1
+            zset[member] = score
+        return added
+
+    def zcard(self, key):
+        self._check()
+        return len(self._get(key, {}))
+
+    def zrange(self, key, start, end):
+        self._check()
+        members = sorted(self._get(key, {}).items(), key=lambda item: (item[1], item[0]))
+        return [member for member, _ in members][start:None if end == -1 else end + 1]
+
+    def zrem(self, key, *members):
+        self._check()
+        zset = self._get(key, {})
+        return sum(1 for member in members if zset.pop(self._bytes(member), None) is not None)
+
+
+class FakePipeline(object):
+    def __init__(self, client: FakeRedis):
+        self.client = client
+        self.calls = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        self.client._check()
+        calls, self.calls = self.calls, []
+        return [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in calls]
+
+
+@pytest.fixture(scope='function')
+def config_files(monkeypatch):
+    """Serves the config file of every project from a dict keyed by
+    commit instead of the remote host. Exceptions in it are raised."""
+    buildconfig._config_cache.local.clear()
+    files = {}
+    calls = []
+
+    def get_file(self, path, ref=None):
+        calls.append((path, ref))
+        value = files.get(ref)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    for cls in (Project, GithubProject, GitlabProject, BitbucketProject):
+        monkeypatch.setattr(cls, 'get_file', get_file)
+    return files, calls
+
+
+@pytest.fixture(scope='function')
+def fake_redis(app, monkeypatch):
+    """Makes `get_redis()` return a `FakeRedis` for the test."""
+    client = FakeRedis()
+    url = 'redis://fake-redis/0'
+    monkeypatch.setitem(app.config, 'CACHE_REDIS_URL', url)
+    monkeypatch.setitem(cache._redis_clients, url, client)
+    return client
+
+
 @pytest.fixture(scope='session')
 def app(request):
     """Session-wide test `Flask` application."""
@@ -75,6 +269,8 @@ def session(db, request):
         transaction.rollback()
         connection.close()
         session.remove()
+        # Rows cached during the test were rolled back with it.
+        models._project_slug_cache.local.clear()
 
     request.addfinalizer(teardown)
     return session
@@ -107,3 +303,38 @@ def project(account, session):
     session.add(project)
     session.commit()
     return project
+
+
+@pytest.fixture(scope='function')
+def project_factory(session):
+    """Returns a function that creates a project owned by a new account
+    unless `account` is given. Keyword arguments set project attributes."""
+    def create_project(remote_id=1, name=None, account=None, **kwargs):
+        if account is None:
+            account = Account(github_id=remote_id)
+            session.add(account)
+        attributes = dict(remote_host='gh', owner='armonaut', default_branch='master', private=False)
+        attributes.update(kwargs)
+        project = Project(account=account, remote_id=remote_id, name=name or f'project{remote_id}', **attributes)
+        session.add(project)
+        session.commit()
+        return project
+    return create_project
+
+
+@pytest.fixture(scope='function')
+def build_factory(session):
+    """Returns a function that creates a build of `project` with one job for
+    each item of `jobs`, given either as a status or as a dict of job
+    attributes. Keyword arguments set build attributes."""
+    def create_build(project, number=1, jobs=(), **kwargs):
+        attributes = dict(commit_branch='master', commit_sha=str(number), commit_author='a@b',
+                          commit_url='https://url')
+        attributes.update(kwargs)
+        build = Build(project=project, number=number, **attributes)
+        for i, job in enumerate(jobs):
+            build.jobs.append(Job(number=i + 1, **({'status': job} if isinstance(job, str) else job)))
+        session.add(build)
+        session.commit()
+        return build
+    return create_build
@@ -0,0 +1,92 @@
+import pytest
+from armonaut.allocator import Host, place, fleet_metrics, PoolAllocator
+from armonaut.models import Pool
+from armonaut.scheduler import dispatch_jobs
+
+
+def create_hosts(*used):
+    return [Host(f'host-{i}', 8, units) for i, units in enumerate(used)]
+
+
+@pytest.mark.parametrize('strategy,expected', [('first_fit', 'host-0'),
+                                               ('best_fit', 'host-1'),
+                                               ('worst_fit', 'host-2')])
+def test_place_strategies(strategy, expected):
+    hosts = create_hosts(4, 6, 0)
+
+    host = place(hosts, 2, strategy)
+
+    assert host.name == expected
+    assert host.used in (6, 8, 2)
+
+
+def test_place_no_fit():
+    hosts = create_hosts(6, 7)
+
+    assert place(hosts, 4) is None
+    assert [host.used for host in hosts] == [6, 7]
+
+
+def test_best_fit_keeps_room_for_large_jobs():
+    for strategy, fits in (('best_fit', True), ('worst_fit', False)):
+        hosts = create_hosts(0, 0)
+        for _ in range(4):
+            place(hosts, 2, strategy)
+        assert (place(hosts, 8, strategy) is not None) is fits
+
+
+def test_fleet_metrics():
+    metrics = fleet_metrics(create_hosts(8, 5, 0), min_units=4)
+
+    assert metrics['capacity_units'] == 24
+    assert metrics['idle_units'] == 11
+    assert metrics['idle_hosts'] == 1
+    assert metrics['utilization'] == pytest.approx(13 / 24)
+    assert metrics['fragmentation'] == pytest.approx(3 / 11)
+    assert metrics['stranded_units'] == 3
+    assert fleet_metrics([])['utilization'] == 0.0
+
+
+def test_dispatch_jobs_onto_pools(app, session, project, build_factory):
+    community = Pool(name='community', community=True, host_count=2, host_units=4)
+    private = Pool(name='private', community=False, host_count=1, host_units=8)
+    session.add_all([community, private])
+    jobs = build_factory(project, jobs=[{'container_units': units} for units in [4, 2, 4, 2]]).jobs
+
+    allocator = PoolAllocator()
+    dispatched = dispatch_jobs(10, place=allocator)
+
+    # The third job doesn't fit the public project's community pool
+    # so it stays queued while the smaller job after it is dispatched.
+    assert dispatched == [jobs[0], jobs[1], jobs[3]]
+    assert [job.status for job in jobs] == ['starting', 'starting', 'queued', 'starting']
+    assert [(job.pool, job.runner_host) for job in dispatched] == [(community, 'community-0'),
+                                                                   (community, 'community-1'),
+                                                                   (community, 'community-1')]
+    assert allocator.metrics()['community']['idle_units'] == 0
+    assert allocator.metrics()['private']['idle_units'] == 8
+    assert PoolAllocator().metrics() == allocator.metrics()
+
+
+def test_dispatch_jobs_too_large_for_pools(app, session, project, build_factory):
+    session.add_all([Pool(name='community', community=True, host_count=2, host_units=4),
+                     Pool(name='private', community=False, host_count=1, host_units=16)])
+    build = build_factory(project, jobs=[{'container_units': units} for units in [2, 8]], status='running')
+
+    # Pools are used by default and no community host could ever run the second job.
+    assert dispatch_jobs(10) == build.jobs[:1]
+    assert [job.status for job in build.jobs] == ['starting', 'error']
+    assert build.jobs[1].finish_time is not None
+    assert build.jobs[1].pool is None
+
+
+def test_job_to_json_pool(app, session, project, build_factory):
+    pool = Pool(name='community', community=True, host_count=1, host_units=4)
+    session.add(pool)
+    job, = build_factory(project, jobs=[{'container_units': 2}]).jobs
+    job.pool = pool
+    session.commit()
+
+    data = job.job_to_json()
+    assert data['container_units'] == 2
+    assert data['pool'] == {'id': pool.id, 'community': True}
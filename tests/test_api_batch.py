@@ -0,0 +1,106 @@
+import datetime
+import pytest
+from flask import url_for
+from sqlalchemy import event
+from limits import parse as parse_rate_limit
+from armonaut import limiter
+
+
+def test_api_batch(app, session, client, account, project_factory, build_factory):
+    project1 = project_factory(1, name='armonaut', account=account)
+    project2 = project_factory(2, name='armonaut.io', account=account)
+    for project in (project1, project2):
+        for number in (1, 2):
+            build_factory(project, number, start_time=datetime.datetime(2017, 1, 1, 0, 0, number))
+
+    r = client.post(url_for('api.get_batch'), json={'projects': [
+        {'host': 'gh', 'owner': 'armonaut', 'name': 'armonaut.io', 'builds': [2, 3]},
+        {'host': 'gh', 'owner': 'armonaut', 'name': 'unknown', 'builds': [1]},
+        {'host': 'gh', 'owner': 'armonaut', 'name': 'armonaut'}
+    ]})
+    assert r.status_code == 200
+
+    results = r.json['projects']
+    assert [x['name'] for x in results] == ['armonaut.io', 'unknown', 'armonaut']
+    assert results[0]['project'] == project2.project_to_json()
+    assert results[0]['builds'] == [project2.latest_build.build_to_json()]
+    assert results[1]['project'] is None
+    assert results[1]['builds'] == []
+    assert results[2]['project'] == project1.project_to_json()
+    assert results[2]['builds'] == []
+
+
+def test_api_batch_constant_queries(app, session, client, account, db, project_factory, build_factory):
+    statements = []
+
+    def count_statements(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    def get_batch(names):
+        statements.clear()
+        r = client.post(url_for('api.get_batch'), json={'projects': [
+            {'host': 'gh', 'owner': 'armonaut', 'name': name, 'builds': [1, 2]} for name in names
+        ]})
+        assert r.status_code == 200
+        return len(statements)
+
+    names = [f'project{i}' for i in range(5)]
+    for i, name in enumerate(names):
+        project = project_factory(i, name=name, account=account)
+        for number in (1, 2):
+            build_factory(project, number, start_time=datetime.datetime(2017, 1, 1, 0, 0, number))
+
+    event.listen(db.engine, 'before_cursor_execute', count_statements)
+    try:
+        assert get_batch(names[:1]) == get_batch(names)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count_statements)
+
+
+@pytest.fixture(scope='function')
+def rate_limited(app, monkeypatch):
+    """Enables the rate limit with in-memory storage."""
+    monkeypatch.setitem(app.config, 'RATELIMIT_ENABLED', True)
+    monkeypatch.setitem(app.config, 'RATELIMIT_STORAGE_URL', 'memory://')
+    monkeypatch.setitem(app.config, 'RATELIMIT_STRATEGY', 'fixed-window')
+    monkeypatch.setitem(app.extensions, 'limiter', None)
+    for name in ('enabled', 'initialized', '_storage', '_limiter'):
+        monkeypatch.setattr(limiter, name, getattr(limiter, name, None))
+    limiter.init_app(app)
+
+
+def remaining_rate_limit():
+    limit = parse_rate_limit('60/hour')
+    return limiter.limiter.get_window_stats(limit, '127.0.0.1', 'api.get_batch')[1]
+
+
+def test_api_batch_charges_rate_limit_per_item(app, session, client, project_factory, rate_limited):
+    def get_batch(*projects):
+        return client.post(url_for('api.get_batch'), json={'projects': [
+            {'host': 'gh', 'owner': 'armonaut', 'name': name, 'builds': builds} for name, builds in projects
+        ]}).status_code
+
+    project_factory(0)
+    assert remaining_rate_limit() == 60
+
+    assert get_batch(('project0', [1, 2, 3]), ('project1', [])) == 200
+    assert remaining_rate_limit() == 55
+
+    # A rejected batch is only charged for the request itself.
+    assert get_batch(('project0', list(range(50))), ('project1', [1, 2, 3, 4])) == 429
+    assert remaining_rate_limit() == 54
+
+    assert get_batch(('project0', list(range(50))), ('project1', [1, 2])) == 200
+    assert remaining_rate_limit() == 0
+    assert get_batch(('project0', [])) == 429
+
+
+@pytest.mark.parametrize('body', [None, [], {'projects': 1}, {'projects': [{'host': 'gh'}]},
+                                  {'projects': [{'host': 'gh', 'owner': 'a', 'name': 1}]},
+                                  {'projects': [{'host': 'gh', 'owner': 'a', 'name': 'b', 'builds': ['1']}]},
+                                  {'projects': [{'host': 'gh', 'owner': 'a', 'name': 'b', 'builds': list(range(51))}]},
+                                  {'projects': [{'host': 'gh', 'owner': 'a', 'name': 'b'}] * 501}])
+def test_api_batch_bad_body(app, session, client, body):
+    r = client.post(url_for('api.get_batch'), json=body)
+    assert r.status_code == 400
+    assert 'message' in r.json
@@ -1,7 +1,10 @@
 import datetime
+import json
 import pytest
+from sqlalchemy import event
 from flask import url_for
-from armonaut.models import Build
+from armonaut.api.export import iter_builds_ndjson
+from armonaut.models import Build, Job, write_snapshots
 
 
 def test_api_get_builds(app, session, client, project):
@@ -50,7 +53,8 @@ def test_api_get_builds(app, session, client, project):
     assert r.json['build'] == build1.build_to_json()
 
 
-@pytest.mark.parametrize('query_string', [{'count': 'a'}, {'page': 'a', 'count': '5'}, {'pull_request': 'a'}, {'status': 'unknown'}])
+@pytest.mark.parametrize('query_string', [{'count': 'a'}, {'page': 'a', 'count': '5'}, {'pull_request': 'a'}, {'status': 'unknown'},
+                                          {'after': 'not-a-cursor'}, {'after': 'a', 'before': 'b'}])
 def test_api_builds_bad_query_string(app, session, client, project, query_string):
     build1 = Build()
     build1.project = project
@@ -116,3 +120,260 @@ def test_api_builds_filter(app, session, client, project, query_string, expected
 
     assert r.status_code == 200
     assert len(r.json['builds']) == expected_number
+
+
+def test_api_get_builds_constant_queries(app, session, client, project, db):
+    statements = []
+
+    def count_statements(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    def get_builds():
+        statements.clear()
+        r = client.get(url_for('api.get_builds', host='gh', owner='armonaut', name='armonaut'))
+        assert r.status_code == 200
+        return len(r.json['builds']), len(statements)
+
+    for number in range(1, 3):
+        build = Build()
+        build.project = project
+        build.number = number
+        build.commit_branch = 'master'
+        build.commit_sha = str(number)
+        build.commit_author = 'a@b'
+        build.commit_url = 'https://url'
+        build.start_time = datetime.datetime(2017, 1, 1, 0, 0, number)
+        session.add(build)
+    session.commit()
+
+    event.listen(db.engine, 'before_cursor_execute', count_statements)
+    try:
+        small_count, small_queries = get_builds()
+
+        for number in range(3, 21):
+            build = Build()
+            build.project = project
+            build.number = number
+            build.commit_branch = 'master'
+            build.commit_sha = str(number)
+            build.commit_author = 'a@b'
+            build.commit_url = 'https://url'
+            build.start_time = datetime.datetime(2017, 1, 1, 0, 0, number)
+            session.add(build)
+        session.commit()
+
+        large_count, large_queries = get_builds()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count_statements)
+
+    assert (small_count, large_count) == (2, 20)
+    assert small_queries == large_queries
+
+
+def test_api_builds_cursor_pagination(app, session, client, project):
+    for number in range(1, 6):
+        build = Build()
+        build.project = project
+        build.number = number
+        build.commit_branch = 'master'
+        build.commit_sha = str(number)
+        build.commit_author = 'a@b'
+        build.commit_url = 'https://url'
+        build.start_time = datetime.datetime(2017, 1, 1, 0, 0, number // 2)
+        session.add(build)
+    session.commit()
+
+    def get_page(**query_string):
+        r = client.get(url_for('api.get_builds', host='gh', owner='armonaut', name='armonaut'),
+                       query_string=dict(count=2, **query_string))
+        assert r.status_code == 200
+        return [b['number'] for b in r.json['builds']], r.json['cursors']
+
+    numbers, cursors = get_page()
+    assert numbers == [5, 4]
+    assert cursors['before'] is None
+
+    numbers, cursors = get_page(after=cursors['after'])
+    assert numbers == [3, 2]
+
+    numbers, last_cursors = get_page(after=cursors['after'])
+    assert numbers == [1]
+    assert last_cursors['after'] is None
+
+    numbers, cursors = get_page(before=last_cursors['before'])
+    assert numbers == [3, 2]
+
+    numbers, cursors = get_page(before=cursors['before'])
+    assert numbers == [5, 4]
+    assert cursors['before'] is None
+
+
+def test_api_builds_finished_build_snapshot(app, session, client, project):
+    build = Build()
+    build.project = project
+    build.number = 1
+    build.status = 'success'
+    build.commit_branch = 'master'
+    build.commit_sha = '1'
+    build.commit_author = 'a@b'
+    build.commit_url = 'https://url'
+    build.start_time = datetime.datetime(2017, 1, 1, 0, 0, 0)
+    session.add(build)
+    session.commit()
+    assert build.snapshot is None
+
+    url = url_for('api.get_builds', host='gh', owner='armonaut', name='armonaut')
+    r = client.get(url)
+    assert r.status_code == 200
+    assert r.json['builds'] == [build.build_to_json()]
+    assert build.snapshot is not None
+    etag = r.headers['ETag']
+
+    r = client.get(url, headers={'If-None-Match': etag})
+    assert r.status_code == 304
+
+    r = client.get(url_for('api.get_build', host='gh', owner='armonaut', name='armonaut', build_number=1))
+    assert r.status_code == 200
+    assert r.json['build'] == build.build_to_json()
+
+    build.commit_tag = 'v1.0.0'
+    session.commit()
+    assert build.snapshot is None
+
+    r = client.get(url)
+    assert r.status_code == 200
+    assert r.json['builds'][0]['commit']['tag'] == 'v1.0.0'
+
+
+def test_build_snapshot_not_written_after_build_changed(app, session, project):
+    build = Build(project=project, number=1, status='success', commit_branch='master', commit_sha='1',
+                  commit_author='a@b', commit_url='https://url', finish_time=datetime.datetime(2017, 1, 1))
+    build.jobs.append(Job(number=1, status='success'))
+    session.add(build)
+    session.commit()
+
+    build.snapshot_text()
+    # A worker restarts the build between serializing and writing the snapshot.
+    session.execute(Build.__table__.update().where(Build.__table__.c.id == build.id)
+                    .values(status='queued', finish_time=None))
+    assert write_snapshots() == 0
+    session.expire_all()
+    assert build.snapshot is None
+
+    build.jobs[0].status = 'running'
+    session.commit()
+    session.execute(Build.__table__.update().where(Build.__table__.c.id == build.id)
+                    .values(snapshot='{"stale":true}'))
+    session.expire_all()
+    # Builds that aren't finished never use a snapshot.
+    assert build.status == 'running'
+    assert build.stored_snapshot is None
+    assert json.loads(build.snapshot_text())['status'] == 'running'
+    assert write_snapshots() == 0
+
+
+def test_api_export_builds(app, session, client, project):
+    builds = []
+    for number in range(1, 6):
+        build = Build()
+        build.project = project
+        build.number = number
+        build.status = 'success' if number % 2 else 'failure'
+        build.commit_branch = 'master'
+        build.commit_sha = str(number)
+        build.commit_author = 'a@b'
+        build.commit_url = 'https://url'
+        build.start_time = datetime.datetime(2017, 1, 1, 0, 0, number)
+        session.add(build)
+        builds.append(build)
+    session.commit()
+
+    expected = []
+    for build in builds:
+        data = build.build_to_json()
+        del data['models']
+        expected.append(data)
+
+    r = client.get(url_for('api.export_builds', host='gh', owner='armonaut', name='armonaut'))
+    assert r.status_code == 200
+    assert r.mimetype == 'application/x-ndjson'
+    assert [json.loads(line) for line in r.data.decode('utf-8').splitlines()] == expected
+
+    r = client.get(url_for('api.export_builds', host='gh', owner='armonaut', name='armonaut'),
+                   query_string={'status': 'failure'})
+    assert [json.loads(line)['number'] for line in r.data.decode('utf-8').splitlines()] == [2, 4]
+
+    r = client.get(url_for('api.export_builds', host='gh', owner='armonaut', name='armonaut'),
+                   query_string={'status': 'unknown'})
+    assert r.status_code == 400
+
+
+def test_iter_builds_ndjson_chunks(app, session, project):
+    for number in range(1, 6):
+        build = Build()
+        build.project = project
+        build.number = number
+        build.commit_branch = 'master'
+        build.commit_sha = str(number)
+        build.commit_author = 'a@b'
+        build.commit_url = 'https://url'
+        build.start_time = datetime.datetime(2017, 1, 1, 0, 0, number)
+        session.add(build)
+    session.commit()
+
+    chunks = list(iter_builds_ndjson(project.id, chunk_size=2))
+    assert [chunk.count('\n') for chunk in chunks] == [2, 2, 1]
+
+
+def test_api_builds_sparse_fieldsets(app, session, client, project, db):
+    build = Build()
+    build.project = project
+    build.number = 1
+    build.status = 'success'
+    build.commit_branch = 'master'
+    build.commit_sha = '1'
+    build.commit_author = 'a@b'
+    build.commit_url = 'https://url'
+    build.start_time = datetime.datetime(2017, 1, 1, 0, 0, 0)
+    session.add(build)
+    session.commit()
+
+    statements = []
+
+    def count_statements(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', count_statements)
+    try:
+        r = client.get(url_for('api.get_builds', host='gh', owner='armonaut', name='armonaut'),
+                       query_string={'fields': 'number,status', 'embed': ''})
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count_statements)
+    assert r.status_code == 200
+    assert r.json['builds'] == [{'number': 1, 'status': 'success'}]
+    assert not any('FROM jobs' in statement for statement in statements)
+
+    r = client.get(url_for('api.get_build', host='gh', owner='armonaut', name='armonaut', build_number=1),
+                   query_string={'fields': 'duration', 'embed': 'jobs'})
+    assert r.status_code == 200
+    assert r.json['build'] == {'duration': 0, 'jobs': []}
+
+    r = client.get(url_for('api.get_build', host='gh', owner='armonaut', name='armonaut', build_number=1),
+                   query_string={'embed': 'project'})
+    assert r.status_code == 200
+    expected = build.build_to_json()
+    del expected['jobs']
+    del expected['metrics']
+    assert r.json['build'] == expected
+
+    r = client.get(url_for('api.get_project', host='gh', owner='armonaut', name='armonaut'),
+                   query_string={'fields': 'slug', 'embed': ''})
+    assert r.status_code == 200
+    assert r.json['project'] == {'slug': 'armonaut/armonaut'}
+
+
+@pytest.mark.parametrize('query_string', [{'fields': 'unknown'}, {'embed': 'latest_build'}])
+def test_api_builds_bad_fieldsets(app, session, client, project, query_string):
+    r = client.get(url_for('api.get_builds', host='gh', owner='armonaut', name='armonaut'), query_string=query_string)
+    assert r.status_code == 400
+    assert 'message' in r.json
@@ -1,6 +1,7 @@
+import datetime
 import pytest
 from flask import url_for
-from armonaut.models import Project
+from armonaut.models import Project, Build
 
 
 def test_no_project_found(app, session, client):
@@ -56,3 +57,99 @@ def test_project_api_remote_url(app, session, client, host, hostname, account):
     r = client.get(url_for('api.get_project', host=host, owner='armonaut', name='armonaut.io'))
     assert r.status_code == 200
     assert r.json['project']['remote_url'] == f'https://{hostname}/armonaut/armonaut.io'
+
+
+def test_project_latest_build_is_denormalized(app, session, client, project):
+    builds = []
+    for number in (1, 3, 2):
+        build = Build()
+        build.project = project
+        build.number = number
+        build.commit_branch = 'master'
+        build.commit_sha = str(number)
+        build.commit_author = 'a@b'
+        build.commit_url = 'https://url'
+        build.start_time = datetime.datetime(2017, 1, 1, 0, 0, number)
+        session.add(build)
+        session.commit()
+        builds.append(build)
+
+    session.expire(project)
+    assert project.latest_build_id == builds[1].id
+    assert project.latest_build_number == 3
+    assert project.latest_build_status == 'queued'
+
+    builds[1].status = 'success'
+    builds[2].status = 'failure'
+    session.commit()
+    assert project.latest_build_status == 'success'
+
+    r = client.get(url_for('api.get_project', host='gh', owner='armonaut', name='armonaut'))
+    assert r.status_code == 200
+    assert r.json['project']['latest_build']['number'] == 3
+    assert r.json['project']['latest_build']['status'] == 'success'
+
+    session.delete(builds[1])
+    session.commit()
+    assert (project.latest_build_id, project.latest_build_number, project.latest_build_status) == \
+        (builds[2].id, 2, 'failure')
+
+    session.delete(builds[0])
+    session.delete(builds[2])
+    session.commit()
+    assert (project.latest_build_id, project.latest_build_number, project.latest_build_status) == \
+        (None, None, None)
+
+
+@pytest.mark.parametrize('endpoint,kwargs', [('api.get_project', {}),
+                                             ('api.get_builds', {}),
+                                             ('api.get_build', {'build_number': 1})])
+def test_project_conditional_get(app, session, client, project, build_factory, endpoint, kwargs):
+    build = build_factory(project, status='success')
+
+    url = url_for(endpoint, host='gh', owner='armonaut', name='armonaut', **kwargs)
+    r = client.get(url)
+    assert r.status_code == 200
+    etag = r.headers['ETag']
+    last_modified = r.headers['Last-Modified']
+
+    r = client.get(url, headers={'If-None-Match': etag})
+    assert r.status_code == 304
+    assert r.headers['ETag'] == etag
+    assert r.data == b''
+
+    r = client.get(url, headers={'If-Modified-Since': last_modified})
+    assert r.status_code == 304
+
+    r = client.get(url, query_string={'count': 1}, headers={'If-None-Match': etag})
+    assert r.status_code == 200
+
+    build.status = 'failure'
+    session.commit()
+
+    r = client.get(url, headers={'If-None-Match': etag})
+    assert r.status_code == 200
+    assert r.headers['ETag'] != etag
+
+
+@pytest.mark.parametrize('endpoint,kwargs', [('api.get_project', {}),
+                                             ('api.get_builds', {}),
+                                             ('api.get_build', {'build_number': 1})])
+def test_project_conditional_get_running_jobs(app, session, client, project, build_factory, endpoint, kwargs):
+    build = build_factory(project, jobs=[{'status': 'running', 'start_time': datetime.datetime.utcnow()}],
+                          status='running')
+    url = url_for(endpoint, host='gh', owner='armonaut', name='armonaut', **kwargs)
+
+    # The running job's duration changes without the project changing.
+    r = client.get(url)
+    assert r.status_code == 200
+    assert 'ETag' not in r.headers and 'Last-Modified' not in r.headers
+
+    build.jobs[0].status = 'success'
+    build.jobs[0].finish_time = datetime.datetime.utcnow()
+    session.commit()
+
+    r = client.get(url)
+    etag = r.headers['ETag']
+    r = client.get(url, headers={'If-None-Match': etag})
+    assert r.status_code == 304
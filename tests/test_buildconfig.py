@@ -0,0 +1,210 @@
+import glob
+import os
+import pytest
+import requests
+from armonaut.buildconfig import ConfigError, compile_config, load_build_config
+from armonaut.models import Account, unpack_string_dict, unpack_string_list
+from armonaut.models.bitbucket import BitbucketProject
+from armonaut.models.github import GithubProject
+from armonaut.models.gitlab import GitlabProject
+from armonaut.providers import gitlab, bitbucket
+from armonaut.tasks import create_build
+
+CONFIG = '''
+python: ["3.6", "3.7"]
+script: pytest
+container_units: 2
+matrix:
+  include:
+    - python: "3.8"
+      container_units: 4
+'''
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='function')
+def github_project(session, account):
+    project = GithubProject(owner='armonaut', name='armonaut', remote_id=1,
+                            default_branch='master', private=False, account=account)
+    session.add(project)
+    session.commit()
+    return project
+
+
+def test_load_build_config_is_cached_per_commit(app, session, github_project, config_files):
+    files, calls = config_files
+    files['abc'] = CONFIG
+
+    for _ in range(3):
+        entry = load_build_config(github_project, 'abc')
+        assert entry['exists'] is True
+        assert entry['error'] is None
+        assert entry['compiled']['config']['python'] == ['3.6', '3.7']
+    load_build_config(github_project, 'def')
+
+    assert calls == [('.armonaut.yml', 'abc'), ('.armonaut.yml', 'def')]
+
+
+def test_load_build_config_missing_is_cached(app, session, github_project, config_files):
+    files, calls = config_files
+
+    assert load_build_config(github_project, 'abc') == {'exists': False, 'compiled': None, 'error': None}
+    assert load_build_config(github_project, 'abc')['exists'] is False
+    assert len(calls) == 1
+
+
+def test_load_build_config_invalid_is_cached(app, session, github_project, config_files):
+    files, calls = config_files
+    files['abc'] = 'python: [3.6\n'
+    files['def'] = '- not a mapping\n'
+
+    assert load_build_config(github_project, 'abc')['error'].startswith('line 2: Invalid YAML')
+    assert load_build_config(github_project, 'abc')['compiled'] is None
+    assert load_build_config(github_project, 'def')['error'] == 'line 1: .armonaut.yml must be a mapping'
+    assert len(calls) == 2
+
+
+def test_load_build_config_errors_are_not_cached(app, session, github_project, config_files):
+    files, calls = config_files
+    files['abc'] = requests.ConnectionError()
+
+    with pytest.raises(requests.ConnectionError):
+        load_build_config(github_project, 'abc')
+    files['abc'] = CONFIG
+    assert load_build_config(github_project, 'abc')['exists'] is True
+    assert len(calls) == 2
+
+
+def test_compile_config_columns():
+    compiled = compile_config('''
+language: python
+python:
+  - 3.6
+  - 3.10
+env:
+  global:
+    - CI=true SECRET="two words"
+  matrix:
+    - TOX=py
+    - {TOX: docs}
+install: pip install tox
+script:
+  - tox
+  - codecov
+services: [redis, postgresql]
+matrix:
+  allow_failures:
+    - python: 3.10
+''')
+
+    columns = compiled['columns']
+    assert unpack_string_dict(columns['env']) == {'CI': 'true', 'SECRET': 'two words'}
+    assert unpack_string_list(columns['install']) == ['pip install tox']
+    assert unpack_string_list(columns['script']) == ['tox', 'codecov']
+    assert unpack_string_list(columns['services']) == ['redis', 'postgresql']
+    assert columns['deploy'] is None
+    assert [(cell['python'], cell['env']['TOX'], cell['allow_failure']) for cell in compiled['cells']] == \
+        [('3.6', 'py', False), ('3.6', 'docs', False), ('3.10', 'py', True), ('3.10', 'docs', True)]
+
+
+@pytest.mark.parametrize(('text', 'error'), [
+    ('script: tox\ninstal: pip install tox\n', "line 2: Unknown key 'instal' in .armonaut.yml"),
+    ('script:\n  - tox\n  - {run: tox}\n', 'line 3: script[1] must be a string'),
+    ('env:\n  - A=1\n  - B="2\n', 'line 3: Invalid env entry \'B="2\': No closing quotation'),
+    ('matrix:\n  include:\n    - python: 3.6\n      pyhton: 3.7\n',
+     "line 4: Unknown key 'pyhton' in matrix.include[0]"),
+    ('script: [tox\n', "line 2: Invalid YAML: did not find expected ',' or ']'"),
+    ('container_units: 0\n', 'line 1: container_units must be a whole number from 1 to 32767'),
+    ('matrix:\n  exclude:\n    - container_units: 2\n',
+     "line 3: Unknown key 'container_units' in matrix.exclude[0]"),
+])
+def test_compile_config_errors(text, error):
+    with pytest.raises(ConfigError) as e:
+        compile_config(text)
+    assert str(e.value) == error
+
+
+def test_compile_repository_config():
+    with open(os.path.join(ROOT, '.armonaut.yml')) as f:
+        compiled = compile_config(f.read())
+
+    assert unpack_string_list(compiled['columns']['after_success']) == ['codecov']
+    assert [(cell['python'], cell['container_units']) for cell in compiled['cells']] == \
+        [('3.6-dev', 4), ('3.7-dev', 4), ('nightly', 4)]
+    assert compiled['config']['branches'] == {'only': ['master']}
+    assert compiled['config']['redis'] == '4.0.2'
+
+
+@pytest.mark.parametrize('path', sorted(glob.glob(os.path.join(ROOT, 'tools', 'configs', '*.yml'))),
+                         ids=os.path.basename)
+def test_compile_config_corpus(path):
+    with open(path) as f:
+        assert compile_config(f.read())['cells']
+
+
+def test_create_build_from_config(app, session, github_project, config_files):
+    files, _ = config_files
+    files['abc'] = CONFIG
+    files['def'] = 'scrip: pytest\n'
+    values = {'commit_sha': 'abc', 'commit_branch': 'master', 'commit_author': 'a@b', 'commit_url': 'https://url',
+              'commit_tag': 'v1'}
+
+    build = create_build(github_project, values)
+    assert unpack_string_list(build.script) == ['pytest']
+    assert [(job.number, job.python, job.container_units) for job in build.jobs] == \
+        [(1, '3.6', 2), (2, '3.7', 2), (3, '3.8', 4)]
+
+    build = create_build(github_project, dict(values, commit_sha='def'))
+    assert build.status == 'error'
+    assert build.finish_time is not None
+    assert build.jobs == []
+
+
+def test_create_build_without_config(app, session, github_project, config_files):
+    files, _ = config_files
+    files['abc'] = requests.ConnectionError()
+    values = {'commit_sha': 'abc', 'commit_branch': 'master', 'commit_author': 'a@b', 'commit_url': 'https://url'}
+
+    # The config couldn't be loaded so the build can't run.
+    build = create_build(github_project, values)
+    assert (build.number, build.status, build.jobs) == (1, 'error', [])
+    assert build.finish_time is not None
+
+    # Commits without a config aren't built at all.
+    assert create_build(github_project, dict(values, commit_sha='def')) is None
+    assert github_project.latest_build is build
+
+
+class FakeResponse(requests.Response):
+    def __init__(self, status_code, text=''):
+        super(FakeResponse, self).__init__()
+        self.status_code = status_code
+        self._content = text.encode('utf-8')
+        self._content_consumed = True
+
+
+@pytest.mark.parametrize('project_class,client,token_attr,url,params',
+                         [(GitlabProject, gitlab, 'gitlab_access_token',
+                           '/projects/7/repository/files/.armonaut.yml/raw', {'ref': 'abc'}),
+                          (BitbucketProject, bitbucket, 'bitbucket_access_token',
+                           '/repositories/armonaut/armonaut/src/abc/.armonaut.yml', None)])
+def test_get_file(app, session, monkeypatch, project_class, client, token_attr, url, params):
+    account = Account(**{token_attr: 'token'})
+    project = project_class(owner='armonaut', name='armonaut', remote_id=7, default_branch='master',
+                            private=False, account=account)
+    session.add(project)
+    session.commit()
+    requests_sent = []
+    responses = [FakeResponse(200, CONFIG), FakeResponse(404), FakeResponse(500)]
+
+    def get(url, token, cache=True, params=None):
+        requests_sent.append((url, token, cache, params))
+        return responses.pop(0)
+
+    monkeypatch.setattr(client, 'get', get)
+
+    assert project.get_file('.armonaut.yml', 'abc') == CONFIG
+    assert requests_sent == [(url, 'token', False, params)]
+    assert not project.has_file('.armonaut.yml', 'abc')
+    with pytest.raises(requests.HTTPError):
+        project.get_file('.armonaut.yml', 'abc')
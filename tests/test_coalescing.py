@@ -0,0 +1,148 @@
+import json
+import pytest
+from armonaut import coalescing, tasks
+from armonaut.tasks import process_webhook
+
+
+@pytest.fixture(scope='function')
+def active_project(session, project, config_files):
+    files, _ = config_files
+    files['abc123'] = 'script: pytest\n'
+    project.active = True
+    project.webhook_secret = 'secret'
+    session.commit()
+    return project
+
+
+class FakeQueue(object):
+    def __init__(self):
+        self.scheduled = []
+
+    def enqueue_in(self, delay, func, *args):
+        self.scheduled.append((delay, func, args))
+
+
+def push(project, branch='master', tag=None, delivery_id=None):
+    ref = f'refs/tags/{tag}' if tag else f'refs/heads/{branch}'
+    payload = {'ref': ref,
+               'head_commit': {'id': 'abc123', 'url': 'https://url', 'author': {'name': 'a@b'}},
+               'repository': {'full_name': 'armonaut/armonaut', 'default_branch': 'master'}}
+    process_webhook('gh', project.id, 'push', delivery_id, json.dumps(payload))
+    return project.latest_build
+
+
+def test_push_cancels_queued_builds_on_branch(app, session, active_project, build_factory):
+    queued = build_factory(active_project, 1, jobs=['queued'], status='queued')
+    running = build_factory(active_project, 2, jobs=['running'], status='running')
+    other_branch = build_factory(active_project, 3, jobs=['queued'], status='queued', commit_branch='feature')
+    pull_request = build_factory(active_project, 4, jobs=['queued'], status='queued', pull_request_number=1)
+
+    build = push(active_project)
+
+    assert build.number == 5
+    assert build.status == 'queued'
+    assert queued.status == 'canceled'
+    assert queued.finish_time is not None
+    assert [job.status for job in queued.jobs] == ['canceled']
+    assert running.status == 'running'
+    assert other_branch.status == 'queued'
+    assert pull_request.status == 'queued'
+
+
+def test_push_cancels_running_builds_if_enabled(app, session, active_project, build_factory, monkeypatch):
+    monkeypatch.setitem(app.config, 'AUTO_CANCEL_RUNNING_JOBS', True)
+    running = build_factory(active_project, 1, jobs=['running'], status='running')
+
+    push(active_project)
+
+    assert running.status == 'canceled'
+    assert [job.status for job in running.jobs] == ['canceled']
+
+
+def test_push_cancels_builds_by_job_statuses(app, session, active_project, build_factory):
+    # Builds are chosen by their jobs even if their own status is out of date.
+    running = build_factory(active_project, 1, jobs=['running', 'queued'], status='queued')
+    finished = build_factory(active_project, 2, jobs=['success', 'failure'], status='queued')
+    queued = build_factory(active_project, 3, jobs=['success', 'queued'], status='queued')
+
+    push(active_project)
+
+    assert running.status == 'queued'
+    assert [job.status for job in running.jobs] == ['running', 'queued']
+    assert finished.status == 'queued'
+    assert [job.status for job in finished.jobs] == ['success', 'failure']
+    assert queued.status == 'canceled'
+    assert [job.status for job in queued.jobs] == ['success', 'canceled']
+
+
+def test_push_cancels_builds_with_running_jobs_if_enabled(app, session, active_project, build_factory, monkeypatch):
+    monkeypatch.setitem(app.config, 'AUTO_CANCEL_RUNNING_JOBS', True)
+    running = build_factory(active_project, 1, jobs=['running', 'queued'], status='queued')
+
+    push(active_project)
+
+    assert running.status == 'canceled'
+    assert [job.status for job in running.jobs] == ['canceled', 'canceled']
+
+
+def test_push_disabled_auto_cancel(app, session, active_project, build_factory, monkeypatch):
+    monkeypatch.setitem(app.config, 'AUTO_CANCEL_BRANCH_BUILDS', False)
+    queued = build_factory(active_project, 1, jobs=['queued'], status='queued')
+
+    push(active_project)
+
+    assert queued.status == 'queued'
+
+
+def test_tag_push_doesnt_cancel(app, session, active_project, build_factory):
+    queued = build_factory(active_project, 1, jobs=['queued'], status='queued')
+
+    build = push(active_project, tag='v1.0.0')
+
+    assert build.commit_tag == 'v1.0.0'
+    assert queued.status == 'queued'
+
+
+def test_pull_request_cancels_same_pull_request(app, session, active_project, build_factory):
+    same = build_factory(active_project, 1, jobs=['queued'], status='queued', commit_branch='feature',
+                         pull_request_number=1)
+    other = build_factory(active_project, 2, jobs=['queued'], status='queued', commit_branch='feature',
+                          pull_request_number=2)
+    branch = build_factory(active_project, 3, jobs=['queued'], status='queued', commit_branch='feature')
+
+    payload = {'action': 'synchronize',
+               'pull_request': {'number': 1, 'html_url': 'https://url', 'user': {'login': 'a'},
+                                'base': {'ref': 'master'},
+                                'head': {'ref': 'feature', 'sha': 'abc123',
+                                         'repo': {'full_name': 'a/armonaut', 'html_url': 'https://url'}}}}
+    process_webhook('gh', active_project.id, 'pull_request', None, json.dumps(payload))
+
+    assert active_project.latest_build.number == 4
+    assert active_project.latest_build.status == 'queued'
+    assert same.status == 'canceled'
+    assert other.status == 'queued'
+    assert branch.status == 'queued'
+
+
+def test_debounced_pushes_build_newest_delivery(app, session, active_project, fake_redis, monkeypatch):
+    queue = FakeQueue()
+    monkeypatch.setattr(tasks, 'get_queue', lambda name: queue)
+
+    push(active_project, delivery_id='first')
+    push(active_project, delivery_id='second')
+    assert active_project.latest_build is None
+    assert [args[2] for _, _, args in queue.scheduled] == ['first', 'second']
+    assert fake_redis.get(f'armonaut:debounce:{active_project.id}:branch:master') == b'second'
+
+    for delay, func, args in queue.scheduled:
+        assert delay.total_seconds() == app.config['BUILD_DEBOUNCE_SECONDS']
+        func(*args)
+    assert [build.number for build in active_project.builds] == [1]
+
+
+def test_debounce_without_redis_builds_immediately(app, session, active_project, fake_redis):
+    fake_redis.fail = True
+
+    assert not coalescing.debounce(active_project.id, 'branch:master', 'first')
+    assert coalescing.is_newest_delivery(active_project.id, 'branch:master', 'first')
+    assert push(active_project, delivery_id='first').number == 1
@@ -0,0 +1,86 @@
+import time
+import pytest
+import requests
+from armonaut.governor import Governor, RateLimited
+
+
+def rate_limit_response(limit, remaining, reset_in, retry_after=None):
+    response = requests.Response()
+    response.status_code = 200 if retry_after is None else 429
+    response.headers['X-RateLimit-Limit'] = str(limit)
+    response.headers['X-RateLimit-Remaining'] = str(remaining)
+    response.headers['X-RateLimit-Reset'] = str(int(time.time() + reset_in))
+    if retry_after is not None:
+        response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def test_governor_unknown_budget_is_not_limited():
+    governor = Governor()
+
+    for _ in range(100):
+        assert governor.acquire('token', urgent=False) == 0
+
+    assert governor.stats_to_json()['calls'] == 100
+    assert governor.stats_to_json()['delayed'] == 0
+
+
+def test_governor_reserves_budget_for_urgent_calls():
+    governor = Governor(reserve=0.2, max_wait=(0.1, 0.1))
+    governor.update('token', rate_limit_response(5000, 900, 3600))
+
+    with pytest.raises(RateLimited):
+        governor.acquire('token', urgent=False)
+    assert governor.acquire('token', urgent=True) == 0
+    assert governor.acquire('other', urgent=False) == 0
+
+    stats = governor.stats_to_json()
+    assert stats['rejected'] == 1
+    assert stats['calls'] == 2
+
+
+def test_governor_rejects_exhausted_token():
+    governor = Governor(max_wait=(0.1, 0.1))
+    governor.update('token', rate_limit_response(5000, 1, 3600))
+
+    assert governor.acquire('token') == 0
+    with pytest.raises(RateLimited) as e:
+        governor.acquire('token')
+    assert e.value.wait > 3500
+
+
+def test_governor_honors_retry_after():
+    governor = Governor(max_wait=(1.0, 1.0))
+    governor.update('token', rate_limit_response(5000, 4000, 3600, retry_after=0))
+    assert governor.acquire('token') == 0
+
+    governor.update('token', rate_limit_response(5000, 4000, 3600, retry_after=60))
+    with pytest.raises(RateLimited):
+        governor.acquire('token')
+
+
+def test_governor_paces_background_calls():
+    # 100 spare calls over 10 seconds is one call every 0.1 seconds.
+    governor = Governor(reserve=0.0, burst=1.0, max_wait=(1.0, 1.0))
+    governor.update('token', rate_limit_response(100, 100, 10))
+
+    waits = [governor.acquire('token', urgent=False) for _ in range(3)]
+
+    assert waits[0] == 0
+    assert 0.05 < waits[1] < 0.3
+    assert 0.05 < waits[2] < 0.3
+    stats = governor.stats_to_json()
+    assert stats['delayed'] == 2
+    assert stats['max_queue_time'] >= stats['mean_queue_time'] > 0
+
+
+def test_governor_forgets_idle_budgets(monkeypatch):
+    governor = Governor()
+    governor.update('token', rate_limit_response(5000, 100, 3600))
+    assert governor.stats_to_json()['tokens'] == 1
+
+    clock = time.monotonic() + 3601
+    monkeypatch.setattr('armonaut.cache.time.monotonic', lambda: clock)
+    assert governor._budgets.get(Governor.key('token')) is None
+    governor.acquire('other')
+    assert governor.stats_to_json()['tokens'] == 1
@@ -0,0 +1,118 @@
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlsplit
+import pytest
+from armonaut import imports
+from armonaut.imports import import_projects, _bitbucket_repository
+from armonaut.models import Project
+from armonaut.models.github import GithubProject
+from armonaut.providers import ProviderClient
+
+
+def github_repo(i, name=None):
+    return {'id': 1000 + i, 'name': name or f'repo{i}', 'owner': {'login': 'armonaut'},
+            'default_branch': 'master', 'private': i % 2 == 0}
+
+
+class GithubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    repos = []
+    pages = []
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        page, per_page = int(query['page'][0]), int(query['per_page'][0])
+        self.pages.append(page)
+        last = max((len(self.repos) + per_page - 1) // per_page, 1)
+        body = json.dumps(self.repos[(page - 1) * per_page:page * per_page]).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', f'"{page}"')
+        self.send_header('Link', f'<http://{self.headers["Host"]}{url.path}?per_page={per_page}&page={last}>; '
+                                 f'rel="last"')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), GithubHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+
+
+@pytest.fixture(scope='function')
+def github_listing(server, monkeypatch):
+    listing = imports.LISTINGS['gh']._replace(client=ProviderClient('test', server, 'token'))
+    monkeypatch.setitem(imports.LISTINGS, 'gh', listing)
+    GithubHandler.pages.clear()
+    return listing
+
+
+def test_import_projects_pages_concurrently(app, session, account, github_listing):
+    GithubHandler.repos = [github_repo(i) for i in range(250)]
+
+    assert import_projects(account, 'gh', concurrency=4) == {'pages': 3, 'repositories': 250}
+
+    assert sorted(GithubHandler.pages) == [1, 2, 3]
+    assert len(github_listing.client.cache.local) == 0
+    projects = Project.query.filter(Project.account_id == account.id).order_by(Project.remote_id).all()
+    assert len(projects) == 250
+    assert all(isinstance(project, GithubProject) for project in projects)
+    assert [(p.remote_id, p.name, p.private, p.active) for p in projects[:2]] == [(1000, 'repo0', True, False),
+                                                                                 (1001, 'repo1', False, False)]
+
+
+def test_import_projects_upserts(app, session, account, github_listing):
+    GithubHandler.repos = [github_repo(i) for i in range(3)]
+    import_projects(account, 'gh')
+    versions = dict(session.query(Project.remote_id, Project.version).all())
+
+    GithubHandler.repos = [github_repo(0), github_repo(1, name='renamed'), github_repo(2), github_repo(3)]
+    assert import_projects(account, 'gh') == {'pages': 1, 'repositories': 4}
+
+    rows = session.query(Project.remote_id, Project.name, Project.version).order_by(Project.remote_id).all()
+    assert rows == [(1000, 'repo0', versions[1000]),
+                    (1001, 'renamed', versions[1001] + 1),
+                    (1002, 'repo2', versions[1002]),
+                    (1003, 'repo3', 0)]
+
+
+def test_import_projects_recreated_and_transferred(app, session, account, github_listing):
+    GithubHandler.repos = [github_repo(0), github_repo(1), github_repo(2, name='moved')]
+    import_projects(account, 'gh')
+    versions = dict(session.query(Project.remote_id, Project.version).all())
+
+    # repo0 was recreated with a new id, repo1 and moved swapped their names.
+    GithubHandler.repos = [github_repo(10, name='repo0'), github_repo(1, name='moved'),
+                           github_repo(2, name='repo1')]
+    assert import_projects(account, 'gh') == {'pages': 1, 'repositories': 3}
+
+    rows = session.query(Project.remote_id, Project.name, Project.version).order_by(Project.remote_id).all()
+    assert rows == [(1000, 'repo0#1000', versions[1000] + 1),
+                    (1001, 'moved', versions[1001] + 2),
+                    (1002, 'repo1', versions[1002] + 2),
+                    (1010, 'repo0', 0)]
+
+
+def test_import_projects_without_token(app, session, account):
+    account.gitlab_access_token = None
+    assert import_projects(account, 'gl') == {'pages': 0, 'repositories': 0}
+
+
+def test_bitbucket_repository():
+    repository = _bitbucket_repository({'uuid': '{2d5bbe3c-8bb4-4f2c-9c36-93d1e9b6a0c4}',
+                                        'full_name': 'armonaut/armonaut', 'is_private': False,
+                                        'mainbranch': {'name': 'develop'}})
+
+    assert repository['owner'] == 'armonaut'
+    assert repository['default_branch'] == 'develop'
+    assert 0 < repository['remote_id'] < 2 ** 63
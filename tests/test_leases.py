@@ -0,0 +1,136 @@
+import datetime
+import pytest
+from armonaut.leases import HEARTBEATS_KEY, claim_job, flush_heartbeats, heartbeat, release_job, \
+    reap_expired_leases
+
+
+def expire(session, job):
+    job.lease_expire_time = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+    session.commit()
+
+
+def test_claim_job(app, session, project, build_factory):
+    job, = build_factory(project, jobs=['starting']).jobs
+
+    assert claim_job(job.id, 'worker-1') is job
+    assert job.status == 'running'
+    assert job.lease_owner == 'worker-1'
+    assert job.lease_expire_time > datetime.datetime.utcnow()
+    assert job.attempts == 1
+    assert claim_job(job.id, 'worker-2') is None
+
+
+def test_heartbeat_renews_lease(app, session, project, build_factory):
+    job, = build_factory(project, jobs=['starting']).jobs
+    claim_job(job.id, 'worker-1')
+    expire(session, job)
+
+    heartbeat('worker-1', [job.id])
+    session.expire_all()
+
+    assert job.lease_expire_time > datetime.datetime.utcnow()
+    assert reap_expired_leases() == []
+
+
+def test_heartbeat_from_other_worker_ignored(app, session, project, build_factory):
+    job, = build_factory(project, jobs=['starting']).jobs
+    claim_job(job.id, 'worker-1')
+    expire(session, job)
+
+    heartbeat('worker-2', [job.id])
+
+    assert reap_expired_leases() == [job]
+    assert job.status == 'queued'
+    assert job.lease_owner is None
+    assert job.start_time is None
+
+
+def test_reap_fails_job_after_max_attempts(app, session, project, build_factory):
+    job, = build_factory(project, jobs=['starting']).jobs
+    for _ in range(app.config['JOB_LEASE_MAX_ATTEMPTS']):
+        assert claim_job(job.id, 'worker-1') is job
+        expire(session, job)
+        assert reap_expired_leases() == [job]
+
+    assert job.status == 'error'
+    assert job.finish_time is not None
+    assert job.build.determine_status() == 'failure'
+
+
+def test_release_job(app, session, project, build_factory):
+    job, = build_factory(project, jobs=['starting']).jobs
+    claim_job(job.id, 'worker-1')
+
+    release_job(job, 'success')
+
+    assert job.status == 'success'
+    assert job.lease_owner is None
+    assert job.finish_time is not None
+    assert claim_job(job.id, 'worker-1') is None
+
+
+def test_heartbeats_flushed_from_redis(app, session, project, build_factory, fake_redis):
+    job, = build_factory(project, jobs=['starting']).jobs
+    other, = build_factory(project, jobs=['starting']).jobs
+    claim_job(job.id, 'worker-1')
+    claim_job(other.id, 'worker-1')
+    expire(session, job)
+    expire(session, other)
+
+    heartbeat('worker-1', [job.id])
+    heartbeat('worker-2', [other.id])
+    session.expire_all()
+    # Heartbeats only reach the database once they are flushed.
+    assert job.lease_expire_time < datetime.datetime.utcnow()
+    assert set(fake_redis.hgetall(HEARTBEATS_KEY)) == {str(job.id).encode(), str(other.id).encode()}
+
+    assert flush_heartbeats() == 2
+    session.expire_all()
+    assert job.lease_expire_time > datetime.datetime.utcnow()
+    assert other.lease_expire_time < datetime.datetime.utcnow()
+    assert fake_redis.hgetall(HEARTBEATS_KEY) == {}
+    assert flush_heartbeats() == 0
+
+
+def test_heartbeats_kept_if_flush_fails(app, session, project, build_factory, fake_redis, monkeypatch):
+    job, = build_factory(project, jobs=['starting']).jobs
+    claim_job(job.id, 'worker-1')
+    heartbeat('worker-1', [job.id])
+
+    def commit():
+        raise RuntimeError('Database is down')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(session, 'commit', commit)
+        with pytest.raises(RuntimeError):
+            flush_heartbeats()
+    assert set(fake_redis.hgetall(HEARTBEATS_KEY)) == {str(job.id).encode()}
+
+    session.rollback()
+    assert flush_heartbeats() == 1
+    assert fake_redis.hgetall(HEARTBEATS_KEY) == {}
+
+
+def test_reap_flushes_redis_heartbeats(app, session, project, build_factory, fake_redis):
+    job, = build_factory(project, jobs=['starting']).jobs
+    claim_job(job.id, 'worker-1')
+    expire(session, job)
+
+    heartbeat('worker-1', [job.id])
+    assert reap_expired_leases() == []
+
+    release_job(job, 'success')
+    assert fake_redis.hgetall(HEARTBEATS_KEY) == {}
+
+
+def test_heartbeat_redis_down_renews_directly(app, session, project, build_factory, fake_redis):
+    job, = build_factory(project, jobs=['starting']).jobs
+    claim_job(job.id, 'worker-1')
+    expire(session, job)
+    fake_redis.fail = True
+
+    heartbeat('worker-1', [job.id])
+    session.expire_all()
+
+    assert job.lease_expire_time > datetime.datetime.utcnow()
+    assert flush_heartbeats() == 0
@@ -0,0 +1,101 @@
+import pytest
+from sqlalchemy import event
+from armonaut.matrix import expand_matrix, create_jobs, parse_env, MatrixError
+from armonaut.models import Build, unpack_string_dict
+
+
+def cells_of(config):
+    return [(cell['python'], cell['env'], cell['allow_failure']) for cell in expand_matrix(config)]
+
+
+def test_expand_matrix_product():
+    assert cells_of({'python': ['3.6', 3.7], 'env': ['A=1', 'A=2']}) == [
+        ('3.6', {'A': '1'}, False),
+        ('3.6', {'A': '2'}, False),
+        ('3.7', {'A': '1'}, False),
+        ('3.7', {'A': '2'}, False)]
+
+
+def test_expand_matrix_no_axes():
+    assert cells_of({}) == [(None, {}, False)]
+    assert cells_of({'python': '3.6'}) == [('3.6', {}, False)]
+
+
+def test_expand_matrix_include_exclude_allow_failures():
+    config = {'python': ['3.6', 'nightly'],
+              'env': {'global': ['CI=true'], 'matrix': ['TOX=py', 'TOX=lint']},
+              'matrix': {'exclude': [{'python': 'nightly', 'env': 'TOX=lint'}],
+                         'include': [{'python': 'pypy3', 'env': 'TOX=py'}, {'env': 'TOX=docs'}],
+                         'allow_failures': [{'python': 'nightly'}]}}
+
+    assert cells_of(config) == [
+        ('3.6', {'CI': 'true', 'TOX': 'py'}, False),
+        ('3.6', {'CI': 'true', 'TOX': 'lint'}, False),
+        ('nightly', {'CI': 'true', 'TOX': 'py'}, True),
+        ('pypy3', {'CI': 'true', 'TOX': 'py'}, False),
+        ('3.6', {'CI': 'true', 'TOX': 'docs'}, False)]
+
+
+def test_expand_matrix_is_deterministic():
+    config = {'python': ['3.6', '3.7', '3.8'], 'env': [f'N={i}' for i in range(40)]}
+    assert expand_matrix(config) == expand_matrix(config)
+
+
+@pytest.mark.parametrize('config', [{'env': ['A']},
+                                    {'env': ['A="unterminated']},
+                                    {'matrix': ['include']},
+                                    {'matrix': {'exclude': [{}]}},
+                                    {'python': [str(i) for i in range(30)], 'env': [f'N={i}' for i in range(30)]}])
+def test_expand_matrix_invalid(config):
+    with pytest.raises(MatrixError):
+        expand_matrix(config)
+
+
+def test_parse_env():
+    assert parse_env('A=1 B="two words" C=') == {'A': '1', 'B': 'two words', 'C': ''}
+    assert parse_env({'A': 1}) == {'A': '1'}
+
+
+def test_create_jobs_single_insert(app, session, db, project):
+    build = Build()
+    build.project = project
+    build.number = 1
+    build.commit_branch = 'master'
+    build.commit_sha = '1'
+    build.commit_author = 'a@b'
+    build.commit_url = 'https://url'
+    session.add(build)
+    session.flush()
+
+    cells = expand_matrix({'python': ['3.6', '3.7', '3.8', 'nightly'],
+                           'env': [f'N={i}' for i in range(30)],
+                           'matrix': {'allow_failures': [{'python': 'nightly'}]},
+                           'container_units': 2})
+    statements = []
+
+    def count_statements(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', count_statements)
+    try:
+        assert create_jobs(build, cells) == 120
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count_statements)
+    session.commit()
+
+    assert len(statements) == 1
+    assert [job.number for job in build.jobs] == list(range(1, 121))
+    job = build.jobs[-1]
+    assert (job.python, unpack_string_dict(job.env), job.allow_failure) == ('nightly', {'N': '29'}, True)
+    assert job.status == 'queued'
+    assert job.container_units == 2
+    assert job.create_time is not None
+
+    build.jobs[0].status = 'success'
+    job.status = 'failure'
+    assert build.determine_status() == 'queued'
+    for other in build.jobs[1:-1]:
+        other.status = 'success'
+    session.commit()
+    assert build.determine_status() == 'success'
+    assert Build.aggregate_jobs([build.id])[build.id][0] == 'success'
@@ -0,0 +1,80 @@
+import datetime
+import pytest
+from armonaut.models import Build
+
+
+def timed_jobs(job_statuses):
+    """Jobs that started together and took ten seconds more than the last."""
+    jobs = []
+    for i, status in enumerate(job_statuses):
+        job = {'status': status}
+        if status != 'queued':
+            job['start_time'] = datetime.datetime(2017, 1, 1, 0, 0, 0)
+            job['finish_time'] = datetime.datetime(2017, 1, 1, 0, 0, 10 * (i + 1))
+        jobs.append(job)
+    return jobs
+
+
+@pytest.mark.parametrize('job_statuses,expected_status,expected_duration',
+                         [([], 'success', 0),
+                          (['queued', 'queued'], 'queued', 0),
+                          (['success', 'queued'], 'queued', 10),
+                          (['success', 'running', 'queued'], 'running', 30),
+                          (['success', 'error', 'running'], 'failure', 60),
+                          (['success', 'canceled'], 'canceled', 30),
+                          (['success', 'success'], 'success', 30)])
+def test_build_aggregates_match_python(app, session, project, build_factory, job_statuses, expected_status,
+                                       expected_duration):
+    build = build_factory(project, 1, timed_jobs(job_statuses))
+
+    assert build.determine_status() == expected_status
+    assert build.duration == expected_duration
+
+    row = session.query(Build.jobs_status, Build.duration).filter(Build.id == build.id).one()
+    assert tuple(row) == (expected_status, expected_duration)
+
+    assert Build.aggregate_jobs([build.id]) == {build.id: (expected_status, expected_duration)}
+
+
+def test_build_aggregate_jobs_many_builds(app, session, project, build_factory):
+    build1 = build_factory(project, 1, timed_jobs(['success', 'failure']))
+    build2 = build_factory(project, 2, timed_jobs(['running']))
+    build3 = build_factory(project, 3)
+
+    assert Build.aggregate_jobs([build1.id, build2.id, build3.id]) == {build1.id: ('failure', 30),
+                                                                       build2.id: ('running', 10),
+                                                                       build3.id: ('success', 0)}
+    assert Build.aggregate_jobs([]) == {}
+
+
+def test_build_duration_fractional_seconds(app, session, project, build_factory):
+    build = build_factory(project, 1, timed_jobs(['success'] * 5))
+    for i, job in enumerate(build.jobs):
+        job.start_time = datetime.datetime(2017, 1, 1, 0, 0, i, 900000)
+        job.finish_time = job.start_time + datetime.timedelta(seconds=5.3)
+    session.commit()
+
+    # Flooring each timestamp would give 30 for jobs of 5.3 seconds.
+    assert build.duration == 25
+    assert session.query(Build.duration).filter(Build.id == build.id).scalar() == 25
+    assert Build.aggregate_jobs([build.id]) == {build.id: ('success', 25)}
+
+
+def test_build_status_rolls_up_from_jobs(app, session, project, build_factory):
+    build = build_factory(project, 1, ['queued', 'queued'])
+    assert build.status == 'queued'
+
+    build.jobs[0].status = 'running'
+    session.commit()
+    assert (build.status, build.finish_time, project.latest_build_status) == ('running', None, 'running')
+
+    for i, job in enumerate(build.jobs):
+        job.status = 'success'
+        job.finish_time = datetime.datetime(2017, 1, 1, 0, 0, i)
+    session.commit()
+    assert (build.status, build.finish_time) == ('success', datetime.datetime(2017, 1, 1, 0, 0, 1))
+    assert project.latest_build_status == 'success'
+
+    build.jobs[1].status = 'queued'
+    session.commit()
+    assert (build.status, build.finish_time, project.latest_build_status) == ('queued', None, 'queued')
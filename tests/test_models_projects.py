@@ -0,0 +1,61 @@
+from flask import url_for
+from sqlalchemy import event
+from armonaut.models import Project
+
+
+def test_project_get_by_slug_is_cached(app, session, db, project):
+    statements = []
+
+    def count_statements(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    assert Project.get_by_slug('gh', 'armonaut', 'armonaut') is project
+
+    event.listen(db.engine, 'before_cursor_execute', count_statements)
+    try:
+        assert Project.get_by_slug('gh', 'armonaut', 'armonaut') is project
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count_statements)
+    assert statements == []
+
+
+def test_project_get_by_slug_invalidated_on_rename(app, session, project):
+    assert Project.get_by_slug('gh', 'armonaut', 'armonaut') is project
+
+    project.owner = 'SethMichaelLarson'
+    session.commit()
+
+    assert Project.get_by_slug('gh', 'armonaut', 'armonaut') is None
+    assert Project.get_by_slug('gh', 'SethMichaelLarson', 'armonaut') is project
+
+
+def test_project_get_by_slug_not_found(app, session, project):
+    assert Project.get_by_slug('gl', 'armonaut', 'armonaut') is None
+    assert Project.get_by_slug('gh', 'armonaut', 'armonaut.io') is None
+
+
+def test_project_get_by_slug_across_requests(app, session, client, db, project):
+    statements = []
+
+    def count_statements(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    url = url_for('api.get_project', host='gh', owner='armonaut', name='armonaut')
+    expected = client.get(url).json
+
+    event.listen(db.engine, 'before_cursor_execute', count_statements)
+    try:
+        for _ in range(2):
+            # Every request starts with an empty session.
+            session.expunge_all()
+            statements.clear()
+            assert client.get(url).json == expected
+            assert not any('FROM projects' in statement for statement in statements)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count_statements)
+
+    # Projects built from the cache can be changed like any other.
+    Project.get_by_slug('gh', 'armonaut', 'armonaut').default_branch = 'develop'
+    session.commit()
+    session.expunge_all()
+    assert client.get(url).json['project']['default_branch'] == 'develop'
@@ -0,0 +1,167 @@
+import json
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import pytest
+from armonaut.models.github import GithubProject
+from armonaut import providers
+from armonaut.providers import ProviderClient, github
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    paths = []
+    conditional = []
+
+    def do_GET(self):
+        self.paths.append(self.path)
+        if self.path.startswith('/etag'):
+            return self.send_etag()
+        body = self.headers.get('Authorization', '').encode('utf-8')
+        self.send_response(503 if self.path == '/unavailable' else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_etag(self):
+        self.conditional.append(self.headers.get('If-None-Match'))
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.send_header('ETag', '"v1"')
+            self.end_headers()
+            return
+        body = b'{"version": 1}'
+        if self.path == '/etag/large':
+            body = b'{"version": 1, "padding": "%s"}' % (b'x' * 32 * 1024)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def server():
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+
+
+def test_provider_client_reuses_connections(server):
+    client = ProviderClient('test', server, 'token')
+
+    for _ in range(5):
+        with client.get('/user', 'secret') as r:
+            assert r.status_code == 200
+            assert r.text == 'token secret'
+
+    stats = client.stats_to_json()
+    assert stats['requests'] == 5
+    assert stats['connections'] == 1
+    assert stats['connection_reuses'] == 4
+    assert stats['errors'] == 0
+    assert 0 < stats['mean_time'] <= stats['max_time']
+
+
+def test_provider_client_retries_unavailable(server):
+    client = ProviderClient('test', server, 'token', backoff_factor=0)
+    Handler.paths.clear()
+
+    with client.get('/unavailable') as r:
+        assert r.status_code == 503
+        assert r.text == ''
+
+    assert Handler.paths == ['/unavailable'] * 4
+    assert client.stats.requests == 1
+    assert client.stats.errors == 1
+
+
+def test_provider_client_revalidates_cached_responses(server):
+    client = ProviderClient('test', server, 'token')
+    Handler.conditional.clear()
+
+    for _ in range(3):
+        with client.get('/etag', 'secret') as r:
+            assert r.status_code == 200
+            assert r.json() == {'version': 1}
+    with client.get('/etag', 'other') as r:
+        assert r.from_cache is False
+
+    assert Handler.conditional == [None, '"v1"', '"v1"', None]
+    assert client.stats.not_modified == 2
+
+
+def test_provider_client_response_cache_in_redis(app, server, fake_redis):
+    client = ProviderClient('test', server, 'token')
+    client.cache.maxsize = 2
+    Handler.conditional.clear()
+
+    for path in ('/etag?a', '/etag?b', '/etag?c', '/etag/large'):
+        with client.get(path, 'secret') as r:
+            assert r.status_code == 200
+    client.cache.clear()
+    # The least recently used entry was evicted and large bodies aren't cached.
+    for path in ('/etag?b', '/etag?c', '/etag?a', '/etag/large'):
+        with client.get(path, 'secret') as r:
+            assert r.json()['version'] == 1
+
+    assert Handler.conditional == [None] * 4 + ['"v1"', '"v1"', None, None]
+    assert fake_redis.zcard('armonaut:provider-responses:test:lru') == 2
+    assert client.stats.not_modified == 2
+
+
+def test_collect_provider_stats(app, fake_redis, monkeypatch):
+    def stats(requests, mean_time, delayed, mean_queue_time):
+        return {'requests': requests, 'errors': 1, 'not_modified': 0, 'connections': 1,
+                'connection_reuses': requests - 1, 'mean_time': mean_time, 'max_time': mean_time * 2,
+                'rate_limit': {'calls': requests, 'delayed': delayed, 'rejected': 0,
+                               'mean_queue_time': mean_queue_time, 'max_queue_time': mean_queue_time,
+                               'tokens': 1}}
+
+    now = time.time()
+    monkeypatch.setattr(providers, 'provider_stats', lambda: {'gh': stats(1, 0.4, 0, 0.0)})
+    fake_redis.hset(providers.STATS_KEY, mapping={
+        'worker:1': json.dumps({'time': now - 60, 'providers': {'gh': stats(3, 0.2, 1, 4.0),
+                                                                 'gl': stats(2, 0.1, 1, 1.0)}}),
+        'worker:2': json.dumps({'time': now - providers.STATS_MAX_AGE - 1, 'providers': {'gh': stats(5, 1, 1, 1)}})
+    })
+
+    collected = providers.collect_provider_stats()
+
+    assert collected['gh']['requests'] == 4
+    assert collected['gh']['errors'] == 2
+    assert collected['gh']['connection_reuses'] == 2
+    assert collected['gh']['mean_time'] == pytest.approx(0.25)
+    assert collected['gh']['max_time'] == pytest.approx(0.8)
+    assert collected['gh']['rate_limit']['delayed'] == 1
+    assert collected['gh']['rate_limit']['mean_queue_time'] == pytest.approx(4.0)
+    assert collected['gh']['rate_limit']['tokens'] == 2
+    assert collected['gl']['requests'] == 2
+    assert collected['bb']['requests'] == 0
+    # Stats of processes that haven't published for a while are dropped.
+    assert b'worker:2' not in fake_redis.hgetall(providers.STATS_KEY)
+    assert len(fake_redis.hgetall(providers.STATS_KEY)) == 2
+
+
+@pytest.mark.vcr()
+def test_github_sync_project_not_modified(app, session, account):
+    github.cache.clear()
+    not_modified = github.stats.not_modified
+    project = GithubProject(owner='armonaut', name='armonaut', remote_id=113254520,
+                            default_branch='master', private=True, account=account)
+    session.add(project)
+    session.commit()
+
+    project.sync_project()
+    assert project.private is False
+
+    project.sync_project()
+    assert project.private is False
+    assert project.default_branch == 'master'
+    assert github.stats.not_modified == not_modified + 1
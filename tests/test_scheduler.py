@@ -0,0 +1,92 @@
+import datetime
+import pytest
+from armonaut.scheduler import plan_jobs, dispatch_jobs, account_queue_stats
+
+
+def aged_jobs(statuses, age=0, now=None):
+    """Jobs created in order, the last one `age` seconds before `now`."""
+    if now is None:
+        now = datetime.datetime.utcnow()
+    return [{'status': status, 'create_time': now - datetime.timedelta(seconds=age + len(statuses) - i)}
+            for i, status in enumerate(statuses)]
+
+
+def test_plan_jobs_fair_share(app, session, project_factory, build_factory):
+    big = project_factory(1)
+    small = project_factory(2)
+    # The big matrix was queued first but mustn't starve the small account.
+    matrix = build_factory(big, jobs=aged_jobs(['queued'] * 20, age=60)).jobs
+    single = build_factory(small, jobs=aged_jobs(['queued'])).jobs
+
+    planned = plan_jobs(4)
+
+    assert planned[:2] == [matrix[0].id, single[0].id]
+    assert planned[2:] == [matrix[1].id, matrix[2].id]
+
+
+def test_plan_jobs_running_jobs_count_against_share(app, session, project_factory, build_factory):
+    busy = project_factory(1)
+    idle = project_factory(2)
+    build_factory(busy, jobs=aged_jobs(['running', 'running']))
+    busy_queued = build_factory(busy, jobs=aged_jobs(['queued'], age=600)).jobs
+    idle_queued = build_factory(idle, jobs=aged_jobs(['queued', 'queued'])).jobs
+
+    assert plan_jobs(3) == [idle_queued[0].id, idle_queued[1].id, busy_queued[0].id]
+
+
+def test_plan_jobs_account_weights(app, session, project_factory, build_factory, monkeypatch):
+    heavy = project_factory(1)
+    light = project_factory(2)
+    monkeypatch.setitem(app.config, 'SCHEDULER_ACCOUNT_WEIGHTS', {heavy.account_id: 3})
+    heavy_jobs = build_factory(heavy, jobs=aged_jobs(['queued'] * 4)).jobs
+    light_jobs = build_factory(light, jobs=aged_jobs(['queued'] * 4, age=60)).jobs
+
+    planned = plan_jobs(4)
+
+    assert sorted(planned) == sorted([light_jobs[0].id] + [job.id for job in heavy_jobs[:3]])
+
+
+@pytest.mark.parametrize('private,pull_request_number', [(False, None), (True, 1)])
+def test_plan_jobs_priority_within_account(app, session, project_factory, build_factory, private, pull_request_number):
+    project = project_factory(1)
+    other = project_factory(3, account=project.account, name='private', private=private)
+    pull_request = build_factory(project, jobs=aged_jobs(['queued'], age=60), pull_request_number=1).jobs
+    boosted = build_factory(other, jobs=aged_jobs(['queued']), pull_request_number=pull_request_number).jobs
+
+    assert plan_jobs(2) == [boosted[0].id, pull_request[0].id]
+
+
+def test_dispatch_jobs(app, session, project_factory, build_factory):
+    project = project_factory(1)
+    jobs = build_factory(project, jobs=aged_jobs(['queued', 'queued', 'queued'])).jobs
+
+    assert dispatch_jobs(2) == jobs[:2]
+    assert [job.status for job in jobs] == ['starting', 'starting', 'queued']
+    assert dispatch_jobs(2) == jobs[2:]
+    assert dispatch_jobs(2) == []
+
+
+def test_account_queue_stats(app, session, project_factory, build_factory):
+    project1 = project_factory(1)
+    project2 = project_factory(2)
+    now = datetime.datetime(2017, 1, 1, 12, 0, 0, 500000)
+    build_factory(project1, jobs=aged_jobs(['queued', 'running', 'success'], age=100, now=now))
+    build_factory(project2, jobs=aged_jobs(['queued', 'queued'], age=200, now=now))
+
+    stats = account_queue_stats(now=now)
+
+    assert stats == [{'account_id': project2.account_id, 'queued': 2, 'running': 0,
+                      'max_queue_time': 202, 'mean_queue_time': 201},
+                     {'account_id': project1.account_id, 'queued': 1, 'running': 1,
+                      'max_queue_time': 103, 'mean_queue_time': 103}]
+
+
+def test_job_queue_time(app, session, project_factory, build_factory):
+    project = project_factory(1)
+    job, = build_factory(project, jobs=aged_jobs(['queued'])).jobs
+    job.create_time = datetime.datetime.utcnow() - datetime.timedelta(seconds=30, microseconds=500000)
+
+    assert job.queue_time == 30
+    assert job.start_time is None
+    job.start_time = job.create_time + datetime.timedelta(seconds=5)
+    assert job.queue_time == 5
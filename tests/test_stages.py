@@ -0,0 +1,68 @@
+from armonaut.leases import claim_job, release_job
+from armonaut.matrix import expand_matrix, create_jobs
+from armonaut.models import Build
+from armonaut.scheduler import plan_jobs
+
+CONFIG = {'python': ['3.6', '3.7'],
+          'env': ['TOX=py', 'TOX=docs'],
+          'stages': ['lint', 'test', {'name': 'deploy'}],
+          'matrix': {'include': [{'stage': 'deploy', 'env': 'DEPLOY=1'},
+                                 {'stage': 'lint', 'env': 'TOX=flake8'},
+                                 {'stage': 'lint', 'env': 'TOX=mypy'}],
+                     'allow_failures': [{'stage': 'lint', 'env': 'TOX=mypy'}]}}
+
+
+def test_expand_matrix_stages():
+    cells = expand_matrix(CONFIG)
+
+    assert [(cell['stage'], cell['stage_number']) for cell in cells] == [('lint', 0)] * 2 + [('test', 1)] * 4 + \
+        [('deploy', 2)]
+    assert [cell['env'] for cell in cells[:2]] == [{'TOX': 'flake8'}, {'TOX': 'mypy'}]
+    assert [cell['allow_failure'] for cell in cells] == [False, True] + [False] * 5
+
+
+def test_expand_matrix_unlisted_stages():
+    cells = expand_matrix({'matrix': {'include': [{'stage': 'deploy'}, {'stage': 'lint'}]},
+                           'stages': ['lint']})
+
+    assert [(cell['stage'], cell['stage_number']) for cell in cells] == [('lint', 0), ('test', 1), ('deploy', 2)]
+
+
+def finish(job, status):
+    claim_job(job.id, 'worker')
+    release_job(job, status)
+
+
+def test_downstream_jobs_wait_for_upstream_stage(app, session, project, build_factory):
+    build = build_factory(project)
+    create_jobs(build, expand_matrix(CONFIG))
+    session.commit()
+    lint, allowed = build.jobs[:2]
+    tests = build.jobs[2:6]
+
+    assert plan_jobs(10) == [lint.id, allowed.id]
+
+    finish(lint, 'success')
+    assert plan_jobs(10) == [allowed.id]
+
+    finish(allowed, 'failure')
+    assert plan_jobs(10) == [job.id for job in tests]
+    assert build.determine_status() == 'queued'
+
+
+def test_failed_stage_skips_downstream_jobs(app, session, project, build_factory):
+    build = build_factory(project)
+    create_jobs(build, expand_matrix(CONFIG))
+    session.commit()
+    lint, allowed = build.jobs[:2]
+
+    finish(lint, 'failure')
+
+    assert [job.status for job in build.jobs] == ['failure', 'queued'] + ['skipped'] * 5
+    assert build.stage_metrics() == {'skipped_jobs': 5, 'skipped_container_units': 5}
+    assert build.build_to_json()['metrics'] == build.stage_metrics()
+    assert plan_jobs(10) == [allowed.id]
+
+    finish(allowed, 'success')
+    assert build.determine_status() == 'failure'
+    assert Build.aggregate_jobs([build.id])[build.id][0] == 'failure'
@@ -0,0 +1,271 @@
+import datetime
+import json
+import threading
+import time
+import pytest
+import requests
+from armonaut import statuses, worker
+from armonaut.models import Account, github as github_models
+from armonaut.models.bitbucket import BitbucketProject
+from armonaut.models.github import GithubProject
+from armonaut.models.gitlab import GitlabProject
+from armonaut.providers import gitlab, bitbucket
+from armonaut.statuses import STATUSES_KEY, SCHEDULED_KEY, COMMIT_STATUS_ATTEMPTS, flush_commit_statuses
+
+
+@pytest.fixture(scope='function')
+def github_project(session, account):
+    account.github_access_token = 'token'
+    project = GithubProject(owner='armonaut', name='armonaut', remote_id=1,
+                            default_branch='master', private=False, account=account)
+    session.add(project)
+    session.commit()
+    statuses._local_statuses.clear()
+    return project
+
+
+@pytest.fixture(scope='function')
+def posted(monkeypatch):
+    calls = []
+    lock = threading.Lock()
+    state = {'active': 0, 'max_active': 0, 'status_code': 201}
+
+    def post_commit_status(self, commit, status, url, context):
+        with lock:
+            calls.append((self.slug, commit, status, url, context))
+            state['active'] += 1
+            state['max_active'] = max(state['max_active'], state['active'])
+        time.sleep(0.02)
+        with lock:
+            state['active'] -= 1
+        return state['status_code']
+
+    monkeypatch.setattr(GithubProject, 'post_commit_status', post_commit_status)
+    return calls, state
+
+
+def test_commit_statuses_are_coalesced(app, session, github_project, build_factory, posted):
+    calls, _ = posted
+    build = build_factory(github_project, 1, ['queued'] * 3, commit_sha='abc')
+    for job in build.jobs:
+        job.status = 'running'
+        session.commit()
+    for job in build.jobs:
+        job.status = 'success'
+        session.commit()
+
+    assert calls == []
+    assert flush_commit_statuses() == 1
+    assert calls == [('armonaut/armonaut', 'abc', 'success', 'https://armonaut.io/gh/armonaut/armonaut/builds/1',
+                      'continuous-integration/armonaut')]
+    assert flush_commit_statuses() == 0
+
+
+def test_commit_statuses_rolled_back_are_discarded(app, session, github_project, build_factory, posted):
+    calls, _ = posted
+    build = build_factory(github_project, 1, ['queued'] * 3, commit_sha='abc')
+    flush_commit_statuses()
+    del calls[:]
+
+    build.jobs[0].status = 'running'
+    session.flush()
+    # A savepoint keeps the test's outer transaction intact.
+    savepoint = session.begin_nested()
+    build.jobs[1].status = 'failure'
+    session.flush()
+    savepoint.rollback()
+    session.commit()
+
+    assert flush_commit_statuses() == 1
+    assert [call[2] for call in calls] == ['running']
+
+    savepoint = session.begin_nested()
+    build.jobs[1].status = 'failure'
+    session.flush()
+    savepoint.rollback()
+    session.commit()
+
+    assert flush_commit_statuses() == 0
+
+
+def test_commit_statuses_are_sent_concurrently(app, session, github_project, build_factory, posted):
+    calls, state = posted
+    for number in range(1, 6):
+        build_factory(github_project, number, ['queued'], commit_sha=f'commit{number}')
+
+    concurrency = app.config['COMMIT_STATUS_CONCURRENCY']
+    app.config['COMMIT_STATUS_CONCURRENCY'] = 2
+    try:
+        assert flush_commit_statuses() == 5
+    finally:
+        app.config['COMMIT_STATUS_CONCURRENCY'] = concurrency
+
+    assert sorted(call[1] for call in calls) == [f'commit{number}' for number in range(1, 6)]
+    assert state['max_active'] == 2
+
+
+def test_commit_statuses_unauthorized_token(app, session, github_project, build_factory, posted):
+    _, state = posted
+    state['status_code'] = 401
+    build_factory(github_project, 1, ['queued'] * 3, commit_sha='abc')
+
+    flush_commit_statuses()
+
+    assert github_project.account.github_access_token is None
+
+
+@pytest.mark.parametrize('status_code', [None, 502])
+def test_commit_statuses_failed_are_retried(app, session, github_project, build_factory, posted, monkeypatch,
+                                            status_code):
+    calls, state = posted
+    if status_code is None:
+        def post_commit_status(self, commit, status, url, context):
+            calls.append((self.slug, commit, status, url, context))
+            raise requests.ConnectionError()
+
+        monkeypatch.setattr(GithubProject, 'post_commit_status', post_commit_status)
+    else:
+        state['status_code'] = status_code
+    build_factory(github_project, 1, ['queued'], commit_sha='abc')
+
+    for _ in range(COMMIT_STATUS_ATTEMPTS):
+        assert flush_commit_statuses() == 0
+    assert len(calls) == COMMIT_STATUS_ATTEMPTS
+    assert flush_commit_statuses() == 0
+    assert len(calls) == COMMIT_STATUS_ATTEMPTS
+
+
+def test_commit_statuses_retried_are_replaced_by_newer(app, session, github_project, build_factory, posted,
+                                                       fake_redis, monkeypatch):
+    calls, state = posted
+    queue = FakeQueue()
+    monkeypatch.setattr(worker, 'get_queue', lambda name: queue)
+    build = build_factory(github_project, 1, ['queued'], commit_sha='abc')
+    state['status_code'] = 503
+
+    def post_commit_status(self, commit, status, url, context):
+        calls.append((self.slug, commit, status, url, context))
+        # The job finishes while its status is being sent.
+        if status == 'queued':
+            with app.app_context():
+                statuses.publish_commit_status(github_project.id, 'abc', 'success', 1)
+        return state['status_code']
+
+    monkeypatch.setattr(GithubProject, 'post_commit_status', post_commit_status)
+    assert flush_commit_statuses() == 0
+    assert len(queue.scheduled) == 2
+
+    state['status_code'] = 201
+    assert flush_commit_statuses() == 1
+    assert [call[2] for call in calls] == ['queued', 'success']
+    assert fake_redis.exists(STATUSES_KEY) == 0
+
+
+class FakeQueue(object):
+    def __init__(self):
+        self.scheduled = []
+
+    def enqueue_in(self, delay, func, *args):
+        self.scheduled.append((delay, func, args))
+
+
+def test_commit_statuses_in_redis(app, session, github_project, build_factory, posted, fake_redis, monkeypatch):
+    calls, _ = posted
+    queue = FakeQueue()
+    monkeypatch.setattr(worker, 'get_queue', lambda name: queue)
+    build = build_factory(github_project, 1, ['queued'] * 2, commit_sha='abc')
+    for job in build.jobs:
+        job.status = 'running'
+        session.commit()
+
+    # Only the first update of a window schedules a flush.
+    assert queue.scheduled == [(datetime.timedelta(seconds=app.config['COMMIT_STATUS_WINDOW']),
+                                'armonaut.tasks.flush_commit_statuses', ())]
+    field = json.dumps([github_project.id, 'abc', 'continuous-integration/armonaut']).encode('utf-8')
+    assert json.loads(fake_redis.hgetall(STATUSES_KEY)[field]) == {'status': 'running', 'build_number': 1}
+
+    assert flush_commit_statuses() == 1
+    assert [call[2] for call in calls] == ['running']
+    assert fake_redis.exists(STATUSES_KEY, SCHEDULED_KEY) == 0
+
+    build.jobs[0].status = 'success'
+    session.commit()
+    assert len(queue.scheduled) == 2
+
+
+def test_commit_statuses_redis_down(app, session, github_project, build_factory, posted, fake_redis, monkeypatch):
+    calls, _ = posted
+    monkeypatch.setattr(worker, 'get_queue', lambda name: FakeQueue())
+    build = build_factory(github_project, 1, ['queued'] * 3, commit_sha='abc')
+    fake_redis.fail = True
+
+    # Job transitions are committed even if their status can't be recorded.
+    build.jobs[0].status = 'running'
+    session.commit()
+    session.expire_all()
+
+    assert build.jobs[0].status == 'running'
+    assert flush_commit_statuses() == 0
+    assert calls == []
+
+
+class FakeResponse(object):
+    status_code = 201
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+@pytest.mark.parametrize('status,state,description',
+                         [('queued', 'pending', 'The Armonaut build is queued'),
+                          ('running', 'pending', 'The Armonaut build is running'),
+                          ('success', 'success', 'The Armonaut build passed'),
+                          ('failure', 'failure', 'The Armonaut build failed'),
+                          ('error', 'error', 'The Armonaut build encountered an error'),
+                          ('canceled', 'error', 'The Armonaut build was canceled'),
+                          ('skipped', 'error', 'The Armonaut build was skipped')])
+def test_github_post_commit_status(app, session, github_project, monkeypatch, status, state, description):
+    sent = []
+
+    def post(url, token, json):
+        sent.append((url, token, json))
+        return FakeResponse()
+
+    monkeypatch.setattr(github_models.github, 'post', post)
+
+    assert github_project.post_commit_status('abc', status, 'https://url', 'ci') == 201
+    assert sent == [('/repos/armonaut/armonaut/statuses/abc', 'token',
+                         {'state': state, 'target_url': 'https://url', 'description': description,
+                          'context': 'ci'})]
+
+
+@pytest.mark.parametrize('project_class,client,token_attr,url,body',
+                         [(GitlabProject, gitlab, 'gitlab_access_token', '/projects/7/statuses/abc',
+                           {'state': 'failed', 'target_url': 'https://url',
+                            'description': 'The Armonaut build failed', 'name': 'ci'}),
+                          (BitbucketProject, bitbucket, 'bitbucket_access_token',
+                           '/repositories/armonaut/armonaut/commit/abc/statuses/build',
+                           {'state': 'FAILED', 'key': 'ci', 'name': 'Armonaut', 'url': 'https://url',
+                            'description': 'The Armonaut build failed'})])
+def test_post_commit_status(app, session, monkeypatch, project_class, client, token_attr, url, body):
+    account = Account(**{token_attr: 'token'})
+    project = project_class(owner='armonaut', name='armonaut', remote_id=7, default_branch='master',
+                            private=False, account=account)
+    session.add(project)
+    session.commit()
+    sent = []
+
+    def post(url, token, json):
+        sent.append((url, token, json))
+        return FakeResponse()
+
+    monkeypatch.setattr(client, 'post', post)
+
+    assert project.post_commit_status('abc', 'failure', 'https://url', 'ci') == 201
+    assert sent == [(url, 'token', body)]
+
+    project.invalidate_access_token()
+    assert getattr(account, token_attr) is None
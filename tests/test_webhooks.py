@@ -0,0 +1,252 @@
+import hashlib
+import hmac
+import json
+import uuid
+import pytest
+import redis
+from flask import url_for
+from sqlalchemy import event
+from armonaut import webhook
+from armonaut.deliveries import BloomFilter, DeliveryStore
+from armonaut.models import Build
+from armonaut.tasks import process_webhook
+
+
+GITHUB_PUSH = {
+    'ref': 'refs/heads/master',
+    'deleted': False,
+    'head_commit': {'id': 'abc123',
+                    'url': 'https://github.com/armonaut/armonaut/commit/abc123',
+                    'author': {'name': 'Seth Michael Larson', 'username': 'SethMichaelLarson'}},
+    'repository': {'full_name': 'armonaut/armonaut', 'default_branch': 'master'}
+}
+
+
+@pytest.fixture(scope='function')
+def enqueued(monkeypatch):
+    deliveries = []
+    monkeypatch.setattr(webhook, 'enqueue_webhook', lambda *args: deliveries.append(args))
+    return deliveries
+
+
+@pytest.fixture(scope='function')
+def webhook_project(session, project, config_files):
+    files, _ = config_files
+    files['abc123'] = files['def456'] = 'script: pytest\n'
+    project.active = True
+    project.webhook_secret = 'secret'
+    session.commit()
+    return project
+
+
+def github_signature(secret, data):
+    return 'sha1=' + hmac.new(secret.encode('utf-8'), data, hashlib.sha1).hexdigest()
+
+
+def test_github_webhook_accepted(app, client, webhook_project, enqueued):
+    delivery_id = str(uuid.uuid4())
+    data = json.dumps(GITHUB_PUSH).encode('utf-8')
+    r = client.post(url_for('webhooks.github_webhooks'), data=data,
+                    headers={'X-GitHub-Event': 'push',
+                             'X-GitHub-Delivery': delivery_id,
+                             'X-Hub-Signature': github_signature('secret', data)})
+
+    assert r.status_code == 202
+    assert enqueued == [('gh', webhook_project.id, 'push', delivery_id, data.decode('utf-8'))]
+
+
+def test_github_webhook_duplicate_delivery(app, client, db, webhook_project, enqueued):
+    statements = []
+
+    def count_statements(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    data = json.dumps(GITHUB_PUSH).encode('utf-8')
+    headers = {'X-GitHub-Event': 'push',
+               'X-GitHub-Delivery': str(uuid.uuid4()),
+               'X-Hub-Signature': github_signature('secret', data)}
+    assert client.post(url_for('webhooks.github_webhooks'), data=data, headers=headers).status_code == 202
+
+    event.listen(db.engine, 'before_cursor_execute', count_statements)
+    try:
+        r = client.post(url_for('webhooks.github_webhooks'), data=data, headers=headers)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count_statements)
+
+    assert r.status_code == 200
+    assert r.json['message'] == 'Duplicate delivery ignored'
+    assert statements == []
+    assert len(enqueued) == 1
+
+
+def test_github_webhook_bad_signature_not_recorded(app, client, webhook_project, enqueued):
+    data = json.dumps(GITHUB_PUSH).encode('utf-8')
+    delivery_id = str(uuid.uuid4())
+    for signature, status_code in ((github_signature('not-secret', data), 403),
+                                   (github_signature('secret', data), 202)):
+        r = client.post(url_for('webhooks.github_webhooks'), data=data,
+                        headers={'X-GitHub-Event': 'push',
+                                 'X-GitHub-Delivery': delivery_id,
+                                 'X-Hub-Signature': signature})
+        assert r.status_code == status_code
+    assert len(enqueued) == 1
+
+
+@pytest.mark.parametrize('use_redis', [False, True])
+def test_github_webhook_enqueue_failure_releases_claim(request, app, client, webhook_project, monkeypatch,
+                                                       use_redis):
+    if use_redis:
+        request.getfixturevalue('fake_redis')
+    enqueued = []
+
+    def enqueue_webhook(*args):
+        if not enqueued:
+            enqueued.append(None)
+            raise redis.ConnectionError('Redis is down')
+        enqueued.append(args)
+
+    monkeypatch.setattr(webhook, 'enqueue_webhook', enqueue_webhook)
+    data = json.dumps(GITHUB_PUSH).encode('utf-8')
+    headers = {'X-GitHub-Event': 'push',
+               'X-GitHub-Delivery': str(uuid.uuid4()),
+               'X-Hub-Signature': github_signature('secret', data)}
+    with pytest.raises(redis.ConnectionError):
+        client.post(url_for('webhooks.github_webhooks'), data=data, headers=headers)
+
+    r = client.post(url_for('webhooks.github_webhooks'), data=data, headers=headers)
+    assert r.status_code == 202
+    assert len(enqueued) == 2
+    assert client.post(url_for('webhooks.github_webhooks'), data=data, headers=headers).status_code == 200
+
+
+def test_delivery_store_redis(app, fake_redis):
+    store = DeliveryStore('test-deliveries')
+    assert not store.seen('gh:1')
+    assert store.claim('gh:1')
+    assert store.seen('gh:1')
+    assert not store.claim('gh:1')
+    assert not any(key.startswith('armonaut:test-deliveries-bloom:') for key in fake_redis.data)
+
+    store.record('gh:1')
+    # Once the exact key expires the Bloom filter still knows the delivery.
+    fake_redis.delete('armonaut:test-deliveries:gh:1')
+    assert store.seen('gh:1')
+    assert not store.claim('gh:1')
+
+    assert store.claim('gh:2')
+    store.release('gh:2')
+    assert not store.seen('gh:2')
+    assert store.claim('gh:2')
+
+
+def test_delivery_store_redis_down(app, fake_redis):
+    store = DeliveryStore('test-deliveries')
+    fake_redis.fail = True
+    assert store.claim('gh:1')
+    assert not store.claim('gh:1')
+    store.record('gh:1')
+    assert store.seen('gh:1')
+    assert not store.claim('gh:1')
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(1000, 0.001)
+    keys = [f'gh:{i}' for i in range(1000)]
+
+    assert not any(bloom.add(key) for key in keys)
+    assert all(key in bloom for key in keys)
+    assert all(bloom.add(key) for key in keys)
+    assert sum(f'gl:{i}' in bloom for i in range(1000)) < 10
+
+
+@pytest.mark.parametrize('signature', [None, 'sha1=\u00e9'])
+def test_github_webhook_bad_signature(app, client, webhook_project, enqueued, signature):
+    data = json.dumps(GITHUB_PUSH).encode('utf-8')
+    r = client.post(url_for('webhooks.github_webhooks'), data=data,
+                    headers={'X-GitHub-Event': 'push',
+                             'X-Hub-Signature': signature or github_signature('not-secret', data)})
+
+    assert r.status_code == 403
+    assert enqueued == []
+
+
+def test_github_webhook_ignored_event(app, client, webhook_project, enqueued):
+    r = client.post(url_for('webhooks.github_webhooks'), data=b'{}',
+                    headers={'X-GitHub-Event': 'watch'})
+
+    assert r.status_code == 200
+    assert enqueued == []
+
+
+@pytest.mark.parametrize('data', [b'not json', b'{}', json.dumps({
+    'repository': {'full_name': 'armonaut/unknown'}}).encode('utf-8')])
+def test_github_webhook_unknown_project(app, client, webhook_project, enqueued, data):
+    r = client.post(url_for('webhooks.github_webhooks'), data=data,
+                    headers={'X-GitHub-Event': 'push',
+                             'X-Hub-Signature': github_signature('secret', data)})
+
+    assert r.status_code == 404
+    assert enqueued == []
+
+
+def test_gitlab_webhook_token(app, client, session, webhook_project, enqueued):
+    webhook_project.remote_host = 'gl'
+    session.commit()
+
+    data = json.dumps({'project': {'path_with_namespace': 'armonaut/armonaut'}})
+    for token, status_code in (('not-secret', 403), ('s\u00e9cret', 403), ('secret', 202)):
+        r = client.post(url_for('webhooks.gitlab_webhooks'), data=data,
+                        headers={'X-Gitlab-Event': 'Push Hook', 'X-Gitlab-Token': token})
+        assert r.status_code == status_code
+    assert len(enqueued) == 1
+
+
+def test_bitbucket_webhook_secret(app, client, session, webhook_project, enqueued):
+    webhook_project.remote_host = 'bb'
+    session.commit()
+
+    data = json.dumps({'repository': {'full_name': 'armonaut/armonaut'}})
+    for secret, status_code in (('not-secret', 403), ('s\u00e9cret', 403), ('secret', 202)):
+        r = client.post(url_for('webhooks.bitbucket_webhooks', secret=secret), data=data,
+                        headers={'X-Event-Key': 'repo:push'})
+        assert r.status_code == status_code
+    assert len(enqueued) == 1
+
+
+def test_process_webhook_creates_builds(app, session, webhook_project):
+    for _ in range(2):
+        process_webhook('gh', webhook_project.id, 'push', 'delivery', json.dumps(GITHUB_PUSH))
+
+    builds = Build.query.filter_by(project_id=webhook_project.id).order_by(Build.number).all()
+    assert [build.number for build in builds] == [1, 2]
+    assert builds[0].commit_sha == 'abc123'
+    assert builds[0].commit_branch == 'master'
+    assert builds[0].commit_author == 'SethMichaelLarson'
+    assert [build.status for build in builds] == ['canceled', 'queued']
+    assert webhook_project.latest_build is builds[1]
+
+
+def test_process_webhook_github_pull_request(app, session, webhook_project):
+    payload = {'action': 'synchronize',
+               'pull_request': {'number': 7,
+                                'html_url': 'https://github.com/armonaut/armonaut/pull/7',
+                                'user': {'login': 'contributor'},
+                                'base': {'ref': 'master'},
+                                'head': {'ref': 'feature', 'sha': 'def456',
+                                         'repo': {'full_name': 'contributor/armonaut',
+                                                  'html_url': 'https://github.com/contributor/armonaut'}}}}
+    process_webhook('gh', webhook_project.id, 'pull_request', 'delivery', json.dumps(payload))
+
+    build = webhook_project.latest_build
+    assert build.pull_request_number == 7
+    assert build.pull_request_branch == 'master'
+    assert build.pull_request_slug == 'contributor/armonaut'
+    assert build.commit_branch == 'feature'
+    assert build.commit_url == 'https://github.com/contributor/armonaut/commit/def456'
+
+
+def test_process_webhook_ignores_deleted_branches(app, session, webhook_project):
+    payload = dict(GITHUB_PUSH, deleted=True, head_commit=None)
+    process_webhook('gh', webhook_project.id, 'push', 'delivery', json.dumps(payload))
+
+    assert Build.query.filter_by(project_id=webhook_project.id).count() == 0
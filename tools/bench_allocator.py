@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# Copyright (C) 2017 Seth Michael Larson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares the allocation strategies of `armonaut.allocator` on a simulated
+fleet. Jobs with random container units and durations arrive at a fixed
+rate and are placed in arrival order, jobs that don't fit wait for capacity.
+Reports utilization, fragmentation and queue times of each strategy.
+
+    python tools/bench_allocator.py --hosts 20 --host-units 8 --jobs 20000
+"""
+
+import argparse
+import heapq
+import os
+import random
+import statistics
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from armonaut.allocator import Host, STRATEGIES, place, fleet_metrics  # noqa: E402
+
+
+def simulate(strategy, arrivals, hosts, host_units):
+    fleet = [Host(f'host-{i}', host_units) for i in range(hosts)]
+    running = []  # (finish time, units, host)
+    waiting = []
+    waits, utilization, fragmentation = [], [], []
+    min_units = min(units for _, units, _ in arrivals)
+
+    def start(now):
+        while waiting:
+            arrival, units, duration = waiting[0]
+            host = place(fleet, units, strategy)
+            if host is None:
+                break
+            waiting.pop(0)
+            waits.append(now - arrival)
+            heapq.heappush(running, (now + duration, id(host), units, host))
+
+    for arrival, units, duration in arrivals:
+        while running and running[0][0] <= arrival:
+            finish, _, finished_units, host = heapq.heappop(running)
+            host.used -= finished_units
+            start(finish)
+        waiting.append((arrival, units, duration))
+        start(arrival)
+        metrics = fleet_metrics(fleet, min_units=min_units)
+        utilization.append(metrics['utilization'])
+        fragmentation.append(metrics['fragmentation'])
+
+    return {'utilization': statistics.mean(utilization),
+            'fragmentation': statistics.mean(fragmentation),
+            'mean wait': statistics.mean(waits) if waits else 0.0,
+            'p95 wait': sorted(waits)[int(len(waits) * 0.95)] if waits else 0.0,
+            'unstarted': len(waiting)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--hosts', type=int, default=20)
+    parser.add_argument('--host-units', type=int, default=8)
+    parser.add_argument('--jobs', type=int, default=20000)
+    parser.add_argument('--units', default='1,2,2,4,4,8',
+                        help='Comma separated container units that jobs are drawn from')
+    parser.add_argument('--load', type=float, default=0.9,
+                        help='Offered load as a fraction of the fleet capacity')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    units = [int(x) for x in args.units.split(',')]
+    mean_duration = 300.0
+    mean_units = statistics.mean(units)
+    rate = args.load * args.hosts * args.host_units / (mean_units * mean_duration)
+
+    arrivals, now = [], 0.0
+    for _ in range(args.jobs):
+        now += rng.expovariate(rate)
+        arrivals.append((now, rng.choice(units), rng.expovariate(1 / mean_duration)))
+
+    print(f'{args.jobs} jobs on {args.hosts} hosts of {args.host_units} units at {args.load:.0%} load')
+    print(f'{"strategy":>10} {"util":>6} {"frag":>6} {"mean wait":>10} {"p95 wait":>10} {"unstarted":>10}')
+    for strategy in STRATEGIES:
+        result = simulate(strategy, arrivals, args.hosts, args.host_units)
+        print(f'{strategy:>10} {result["utilization"]:6.1%} {result["fragmentation"]:6.1%} '
+              f'{result["mean wait"]:9.1f}s {result["p95 wait"]:9.1f}s {result["unstarted"]:>10}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# Copyright (C) 2017 Seth Michael Larson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Measures compiling the `.armonaut.yml` files in `tools/configs/` (or the
+given files) with libyaml's `CSafeLoader` and the pure Python `SafeLoader`.
+
+    APP_SETTINGS=config.TestingConfig python tools/bench_config.py --iterations 500
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from armonaut import buildconfig  # noqa: E402
+
+LOADERS = [('SafeLoader', yaml.SafeLoader)]
+if hasattr(yaml, 'CSafeLoader'):
+    LOADERS.insert(0, ('CSafeLoader', yaml.CSafeLoader))
+
+
+def measure(text: str, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        buildconfig.compile_config(text)
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    default = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'configs', '*.yml')
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('paths', nargs='*')
+    parser.add_argument('--iterations', type=int, default=500)
+    args = parser.parse_args()
+
+    paths = args.paths or sorted(glob.glob(default))
+    texts = {}
+    for path in paths:
+        with open(path) as f:
+            texts[os.path.basename(path)] = f.read()
+
+    print(f'{"config":<16} {"cells":>5} ' + ' '.join(f'{name:>12}' for name, _ in LOADERS))
+    totals = [0.0] * len(LOADERS)
+    for name, text in texts.items():
+        cells = len(buildconfig.compile_config(text)['cells'])
+        times = []
+        for i, (_, loader) in enumerate(LOADERS):
+            buildconfig.Loader = loader
+            times.append(measure(text, args.iterations))
+            totals[i] += times[-1]
+        print(f'{name:<16} {cells:>5} ' + ' '.join(f'{t * 1e6:>9.0f} us' for t in times))
+    print(f'{"total":<16} {"":>5} ' + ' '.join(f'{t * 1e6:>9.0f} us' for t in totals))
+
+
+if __name__ == '__main__':
+    main()
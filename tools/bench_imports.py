@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# Copyright (C) 2017 Seth Michael Larson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures importing an account's repositories from a local stub of the
+GitHub repository listing that answers each page after `--latency` ms,
+against an in-memory database by default or `--database-url` for PostgreSQL.
+
+    APP_SETTINGS=config.TestingConfig python tools/bench_imports.py --repositories 5000 --concurrency 1 8
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from armonaut import create_app, db  # noqa: E402
+from armonaut import imports  # noqa: E402
+from armonaut.models import Account, Project  # noqa: E402
+from armonaut.providers import ProviderClient  # noqa: E402
+
+
+def make_handler(repositories: int, latency: float):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            query = parse_qs(url.query)
+            page, per_page = int(query['page'][0]), int(query['per_page'][0])
+            last = (repositories + per_page - 1) // per_page
+            repos = [{'id': i, 'name': f'repo{i}', 'owner': {'login': 'bench'},
+                      'default_branch': 'master', 'private': i % 3 == 0}
+                     for i in range((page - 1) * per_page, min(page * per_page, repositories))]
+            body = json.dumps(repos).encode('utf-8')
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Link', f'<http://{self.headers["Host"]}{url.path}?per_page={per_page}&page={last}>; '
+                                     f'rel="last"')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repositories', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=300, help='Latency of each page in ms')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--database-url', default='sqlite://')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(args.repositories, args.latency / 1000))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = ProviderClient('bench', f'http://127.0.0.1:{server.server_port}', 'token')
+    imports.LISTINGS['gh'] = imports.LISTINGS['gh']._replace(client=client)
+
+    app = create_app()
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database_url
+    with app.app_context():
+        db.create_all()
+        account = Account(github_access_token='token')
+        db.session.add(account)
+        db.session.commit()
+
+        print(f'{args.repositories} repositories, {args.latency:.0f} ms per page')
+        for concurrency in args.concurrency:
+            Project.query.delete()
+            db.session.commit()
+            client.cache.clear()
+
+            start = time.perf_counter()
+            imported = imports.import_projects(account, 'gh', concurrency=concurrency)
+            fresh = time.perf_counter() - start
+            start = time.perf_counter()
+            imports.import_projects(account, 'gh', concurrency=concurrency)
+            again = time.perf_counter() - start
+            print(f'concurrency {concurrency:>3}: {imported["pages"]} pages, import {fresh:7.2f} s, '
+                  f're-import {again:7.2f} s')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# Copyright (C) 2017 Seth Michael Larson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures expanding a large build matrix and persisting its jobs, against
+an in-memory database by default or `--database-url` for PostgreSQL.
+
+    APP_SETTINGS=config.TestingConfig python tools/bench_matrix.py --pythons 5 --envs 40
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from armonaut import create_app, db  # noqa: E402
+from armonaut.matrix import expand_matrix, create_jobs  # noqa: E402
+from armonaut.models import Account, Project, Build  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--pythons', type=int, default=5)
+    parser.add_argument('--envs', type=int, default=40)
+    parser.add_argument('--builds', type=int, default=10)
+    parser.add_argument('--database-url', default='sqlite://')
+    args = parser.parse_args()
+
+    app = create_app()
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database_url
+    config = {'python': [f'3.{i}' for i in range(args.pythons)],
+              'env': {'global': ['CI=true'], 'matrix': [f'TOX_ENV=env{i} SHARD={i}' for i in range(args.envs)]},
+              'matrix': {'allow_failures': [{'python': '3.0'}]}}
+
+    with app.app_context():
+        db.create_all()
+        project = Project(account=Account(), remote_host='gh', remote_id=1, owner='armonaut',
+                          name='bench-matrix', private=False)
+        db.session.add(project)
+        db.session.commit()
+
+        expand_times, persist_times = [], []
+        for number in range(1, args.builds + 1):
+            start = time.perf_counter()
+            cells = expand_matrix(config)
+            expanded = time.perf_counter()
+
+            build = Build(project=project, number=number, commit_branch='master', commit_sha=str(number),
+                          commit_author='bench', commit_url='https://url')
+            db.session.add(build)
+            db.session.flush()
+            create_jobs(build, cells)
+            db.session.commit()
+            persist_times.append(time.perf_counter() - expanded)
+            expand_times.append(expanded - start)
+
+    print(f'{len(cells)} jobs per build, {args.builds} builds')
+    for label, times in (('expand', expand_times), ('persist', persist_times)):
+        times = sorted(times)
+        print(f'{label:>8}: median {times[len(times) // 2] * 1000:8.2f} ms, max {times[-1] * 1000:8.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# Copyright (C) 2017 Seth Michael Larson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures the latency of the webhook receivers by posting a burst of
+signed GitHub push deliveries through the test client against an in-memory
+database. Deliveries are enqueued onto the `REDIS_URL` queues unless
+`--no-enqueue` is given, in which case only verification is measured.
+
+    APP_SETTINGS=config.TestingConfig python tools/bench_webhooks.py -n 1000
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from armonaut import create_app, db, webhook  # noqa: E402
+from armonaut.models import Account, Project  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', '--deliveries', type=int, default=500)
+    parser.add_argument('--payload-size', type=int, default=20,
+                        help='Number of commits in each push payload')
+    parser.add_argument('--no-enqueue', action='store_true')
+    args = parser.parse_args()
+
+    app = create_app()
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['CACHE_REDIS_URL'] = None
+    if args.no_enqueue:
+        webhook.enqueue_webhook = lambda *args: None
+
+    with app.app_context():
+        db.create_all()
+        account = Account(github_id=1, github_login='bench', github_access_token='')
+        project = Project(account=account, remote_host='gh', remote_id=1, owner='armonaut',
+                          name='armonaut', default_branch='master', private=False,
+                          active=True, webhook_secret='secret')
+        db.session.add(project)
+        db.session.commit()
+
+        commits = [{'id': f'{i:040x}', 'message': 'x' * 200,
+                    'url': f'https://github.com/armonaut/armonaut/commit/{i:040x}',
+                    'author': {'name': 'Bench', 'username': 'bench'}}
+                   for i in range(args.payload_size)]
+        data = json.dumps({'ref': 'refs/heads/master', 'deleted': False,
+                           'head_commit': commits[-1], 'commits': commits,
+                           'repository': {'full_name': 'armonaut/armonaut',
+                                          'default_branch': 'master'}}).encode('utf-8')
+        signature = 'sha1=' + hmac.new(b'secret', data, hashlib.sha1).hexdigest()
+
+        client = app.test_client()
+        timings = []
+        for i in range(args.deliveries):
+            start = time.perf_counter()
+            r = client.post('/webhooks/github', data=data,
+                            headers={'X-GitHub-Event': 'push',
+                                     'X-GitHub-Delivery': str(i),
+                                     'X-Hub-Signature': signature})
+            timings.append((time.perf_counter() - start) * 1000)
+            if r.status_code != 202:
+                parser.error(f'Delivery {i} was answered with {r.status_code}')
+
+    timings.sort()
+    print(f'{args.deliveries} deliveries of {len(data)} bytes')
+    for label, value in (('mean', statistics.mean(timings)),
+                         ('p50', timings[len(timings) // 2]),
+                         ('p95', timings[int(len(timings) * 0.95)]),
+                         ('p99', timings[int(len(timings) * 0.99)]),
+                         ('max', timings[-1])):
+        print(f'{label:>5}: {value:8.3f} ms')
+
+
+if __name__ == '__main__':
+    main()